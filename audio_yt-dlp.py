@@ -1,28 +1,116 @@
 from yt_dlp import YoutubeDL
 from dotenv import load_dotenv
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import argparse
 import os
 
 load_dotenv()
 
 OPERA_COOKIES_PATH = os.getenv("OPERA_COOKIES_PATH")
+# Przeglądarka, z której brać ciasteczka; pusta wartość = bez ciasteczek (np. lokalny serwer testowy)
+COOKIES_BROWSER = os.getenv("YTDLP_COOKIES_BROWSER", "opera")
 AUDIO_SET = os.getenv("AUDIO_SET", "audio")
 path_template = f"{AUDIO_SET}/%(title)s.%(ext)s"
+# Lista pobranych już ID - ponowne uruchomienie pomija je bez odpytywania serwisu
+DOWNLOAD_ARCHIVE = os.getenv("YTDLP_ARCHIVE", os.path.join(AUDIO_SET, "download_archive.txt"))
+# Równoległość: fragmenty jednego pliku (DASH/HLS) i pozycje playlisty naraz
+CONCURRENT_FRAGMENTS = int(os.getenv("YTDLP_FRAGMENTS", "4"))
+PLAYLIST_WORKERS = int(os.getenv("YTDLP_WORKERS", "3"))
+# Whisper i tak resampluje do 16 kHz, więc natywny strumień (opus/m4a) wystarcza
+KEEP_NATIVE = os.getenv("AUDIO_KEEP_NATIVE", "0") == "1"
 
-def audio_yt_dlp(yt_link):
+DEFAULT_PLAYLIST = "https://www.youtube.com/playlist?list=PLHtUOYOPwzJGGZkjR-FspIL17YtSBGaCR"
+
+
+def _ydl_opts(keep_native: bool = KEEP_NATIVE):
     ydl_opts = {
         "format": "bestaudio/best",
         "outtmpl": path_template,
-        "cookiesfrombrowser": ('opera', OPERA_COOKIES_PATH),
-        "postprocessors": [{
+        "download_archive": DOWNLOAD_ARCHIVE,
+        "concurrent_fragment_downloads": CONCURRENT_FRAGMENTS,
+    }
+    if COOKIES_BROWSER:
+        ydl_opts["cookiesfrombrowser"] = (COOKIES_BROWSER, OPERA_COOKIES_PATH)
+    if not keep_native:
+        # Tryb zgodny wstecz: transkodowanie do mp3 192 kbps (kosztuje CPU i jakość)
+        ydl_opts["postprocessors"] = [{
             "key": "FFmpegExtractAudio",
             "preferredcodec": "mp3",
             "preferredquality": "192",
         }]
-    }
+    return ydl_opts
+
+
+def _read_archive():
+    if not os.path.exists(DOWNLOAD_ARCHIVE):
+        return set()
+    with open(DOWNLOAD_ARCHIVE, "r", encoding="utf-8") as f:
+        return {line.strip() for line in f if line.strip()}
+
+
+def list_items(link, ydl_opts):
+    """
+    Rozwija playlistę do listy adresów pozycji (bez pobierania), pomijając ID z archiwum.
+    Pojedynczy film albo bezpośredni plik zwraca jako jedyną pozycję.
+    """
+    opts = dict(ydl_opts, extract_flat="in_playlist", quiet=True)
+    with YoutubeDL(opts) as ydl:
+        info = ydl.extract_info(link, download=False)
 
+    entries = info.get("entries") if info else None
+    if entries is None:
+        return [link]
+
+    archived = _read_archive()
+    items = []
+    for entry in entries:
+        if not entry:
+            continue
+        extractor = (entry.get("ie_key") or entry.get("extractor_key") or "").lower()
+        if extractor and f"{extractor} {entry.get('id')}" in archived:
+            continue
+        items.append(entry.get("url") or entry.get("webpage_url"))
+    skipped = len([e for e in entries if e]) - len(items)
+    if skipped:
+        print(f"Pomijam {skipped} pozycji z archiwum {DOWNLOAD_ARCHIVE}.")
+    return items
+
+
+def _download_one(url, ydl_opts):
+    # Osobna instancja na wątek - YoutubeDL nie jest bezpieczny dla wątków
     with YoutubeDL(ydl_opts) as ydl:
-        ydl.download([yt_link])
+        return ydl.download([url])
+
+
+def audio_yt_dlp(yt_link, keep_native=KEEP_NATIVE, workers=PLAYLIST_WORKERS):
+    os.makedirs(AUDIO_SET, exist_ok=True)
+    ydl_opts = _ydl_opts(keep_native)
+    items = list_items(yt_link, ydl_opts)
+    print(f"Do pobrania: {len(items)} pozycji ({workers} naraz, "
+          f"{'natywny strumień audio' if keep_native else 'mp3 192 kbps'}).")
+
+    failed = 0
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(_download_one, url, ydl_opts): url for url in items}
+        for future in as_completed(futures):
+            try:
+                if future.result():
+                    failed += 1
+            except Exception as e:
+                print(f"Błąd pobierania {futures[future]}: {e}")
+                failed += 1
+    return failed
+
 
 if __name__ == "__main__":
-    link = "https://www.youtube.com/playlist?list=PLHtUOYOPwzJGGZkjR-FspIL17YtSBGaCR"
-    audio_yt_dlp(link)
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Pobieranie audio odcinków (yt-dlp).")
+    parser.add_argument("links", nargs="*", default=[DEFAULT_PLAYLIST],
+                        help="Playlisty, filmy albo bezpośrednie adresy plików (np. lokalny serwer HTTP).")
+    parser.add_argument("--keep-native", action="store_true", default=KEEP_NATIVE,
+                        help="Zachowaj oryginalny strumień (opus/m4a) zamiast transkodować do mp3.")
+    parser.add_argument("--workers", type=int, default=PLAYLIST_WORKERS,
+                        help="Ile pozycji playlisty pobierać równolegle.")
+    args = parser.parse_args()
+
+    for link in args.links:
+        audio_yt_dlp(link, keep_native=args.keep_native, workers=args.workers)
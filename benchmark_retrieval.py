@@ -0,0 +1,218 @@
+import argparse
+import json
+import os
+import random
+import statistics
+import time
+from typing import Any, Dict, List, Optional
+
+import chromadb
+
+import rag_retrieval
+from bm25_index import QUOTED_TEXT_RE
+from chroma_utils import iter_collection
+
+# --- KONFIGURACJA ---
+BENCHMARK_DIR = "benchmarks"
+GOLD_QUERIES_FILE = os.path.join(BENCHMARK_DIR, "gold_queries.jsonl")
+RESULTS_DIR = os.path.join(BENCHMARK_DIR, "results")
+MANIFEST_FILE = rag_retrieval.MANIFEST_FILE
+# Ile zapytań z każdego typu losujemy do zbioru wzorcowego
+QUERIES_PER_TYPE = 100
+# Zapytanie to początek cytatu/faktu (jak użytkownik, który pamięta tylko fragment)
+QUERY_MAX_WORDS = 10
+K_VALUES = (1, 3, 5, 10)
+SEED = 1234
+
+
+def _first_words(text: str, max_words: int = QUERY_MAX_WORDS) -> str:
+    return " ".join(text.split()[:max_words])
+
+
+def build_gold_queries(collection, per_type: int = QUERIES_PER_TYPE, seed: int = SEED) -> List[Dict[str, Any]]:
+    """
+    Zapytania wzorcowe z metadanych węzłów: cytaty ze znanym mówcą i fakty ze znanym odcinkiem.
+    Odpowiedzią wzorcową jest węzeł, z którego zapytanie powstało.
+    """
+    quotes, facts = [], []
+    for page in iter_collection(collection, include=["documents", "metadatas"]):
+        for node_id, text, meta in zip(page["ids"], page["documents"], page["metadatas"]):
+            meta = meta or {}
+            if meta.get("type") == "quote" and meta.get("speaker") not in (None, "Unknown"):
+                match = QUOTED_TEXT_RE.search(text or "")
+                if match and len(match.group(1).split()) >= 3:
+                    quotes.append({
+                        "type": "quote_speaker",
+                        "query": f"Kto powiedział: \"{_first_words(match.group(1))}\"?",
+                        "gold_id": node_id,
+                        "speaker": meta["speaker"],
+                    })
+            elif meta.get("type") == "lore_fact" and meta.get("episode_id") not in (None, "Unknown"):
+                content = (text or "").split(": ", 1)[-1]
+                if len(content.split()) >= 3:
+                    facts.append({
+                        "type": "fact_episode",
+                        "query": _first_words(content),
+                        "gold_id": node_id,
+                        "episode_id": meta["episode_id"],
+                    })
+
+    rng = random.Random(seed)
+    gold = []
+    for items in (quotes, facts):
+        items.sort(key=lambda item: item["gold_id"])  # niezależnie od kolejności stron w Chromie
+        gold.extend(rng.sample(items, min(per_type, len(items))))
+    return gold
+
+
+def load_or_build_gold(collection, path: str, rebuild: bool, per_type: int) -> List[Dict[str, Any]]:
+    """
+    Zbiór wzorcowy jest zapisywany, żeby kolejne przebiegi (inne ustawienia) mierzyły te same zapytania.
+    """
+    if os.path.exists(path) and not rebuild:
+        with open(path, "r", encoding="utf-8") as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+    gold = build_gold_queries(collection, per_type)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        for item in gold:
+            f.write(json.dumps(item, ensure_ascii=False) + "\n")
+    print(f"Zapisano {len(gold)} zapytań wzorcowych -> {path}")
+    return gold
+
+
+def _percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+
+def _latency_summary(values: List[float]) -> Dict[str, float]:
+    return {
+        "p50_ms": round(_percentile(values, 0.50) * 1000, 2),
+        "p95_ms": round(_percentile(values, 0.95) * 1000, 2),
+        "mean_ms": round(statistics.fmean(values) * 1000, 2) if values else 0.0,
+    }
+
+
+def evaluate(retriever, gold: List[Dict[str, Any]], k_values=K_VALUES) -> Dict[str, Any]:
+    """
+    Recall@k i MRR (po ID węzła) ogółem i per typ zapytania oraz opóźnienia etapów.
+    """
+    per_type: Dict[str, Dict[str, List[float]]] = {}
+    timings: Dict[str, List[float]] = {"embed_s": [], "search_s": [], "rerank_s": [], "total_s": []}
+
+    for item in gold:
+        started = time.perf_counter()
+        results = retriever.retrieve(item["query"])
+        timings["total_s"].append(time.perf_counter() - started)
+        for stage, seconds in retriever.last_timings.items():
+            timings[stage].append(seconds)
+
+        ranked_ids = [r.node.node_id for r in results]
+        rank = ranked_ids.index(item["gold_id"]) + 1 if item["gold_id"] in ranked_ids else None
+
+        bucket = per_type.setdefault(item["type"], {"rr": [], **{f"recall@{k}": [] for k in k_values}})
+        bucket["rr"].append(1.0 / rank if rank else 0.0)
+        for k in k_values:
+            bucket[f"recall@{k}"].append(1.0 if rank and rank <= k else 0.0)
+
+    def aggregate(buckets: List[Dict[str, List[float]]]) -> Dict[str, float]:
+        merged = {key: [v for b in buckets for v in b[key]] for key in buckets[0]}
+        summary = {key: round(statistics.fmean(vals), 4) for key, vals in merged.items() if key != "rr"}
+        summary["mrr"] = round(statistics.fmean(merged["rr"]), 4)
+        summary["queries"] = len(merged["rr"])
+        return summary
+
+    return {
+        "overall": aggregate(list(per_type.values())) if per_type else {},
+        "per_type": {t: aggregate([b]) for t, b in sorted(per_type.items())},
+        "latency": {stage: _latency_summary(values) for stage, values in timings.items() if values},
+    }
+
+
+def _last_build_info() -> Optional[Dict[str, Any]]:
+    if not os.path.exists(MANIFEST_FILE):
+        return None
+    with open(MANIFEST_FILE, "r", encoding="utf-8") as f:
+        return json.load(f).get("last_build")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark jakości i opóźnień retrievera bomba_lore.")
+    parser.add_argument("--gold", default=GOLD_QUERIES_FILE, help="Plik JSONL ze zbiorem wzorcowym.")
+    parser.add_argument("--rebuild-gold", action="store_true", help="Wygeneruj zbiór wzorcowy od nowa.")
+    parser.add_argument("--per-type", type=int, default=QUERIES_PER_TYPE)
+    parser.add_argument("--build", action="store_true",
+                        help="Najpierw przebuduj indeks (build_rag_index.py) i zmierz czas budowy.")
+    parser.add_argument("--lexical-only", action="store_true", help="Bez modelu embeddingów (tylko BM25).")
+    parser.add_argument("--no-router", action="store_true")
+    parser.add_argument("--rerank", action="store_true")
+    parser.add_argument("--label", default="", help="Opis przebiegu zapisywany w wyniku (np. 'top_k=5').")
+    parser.add_argument("--output", help="Plik wynikowy JSON (domyślnie benchmarks/results/<czas>.json).")
+    args = parser.parse_args()
+
+    build_seconds = None
+    if args.build:
+        from build_rag_index import build_index
+        started = time.perf_counter()
+        build_index()
+        build_seconds = time.perf_counter() - started
+
+    db = chromadb.PersistentClient(path=rag_retrieval.DB_DIRECTORY)
+    collection = db.get_collection(rag_retrieval.COLLECTION_NAME)
+    gold = load_or_build_gold(collection, args.gold, args.rebuild_gold, args.per_type)
+    if not gold:
+        print("Brak zapytań wzorcowych (kolekcja bez cytatów z mówcą i faktów z odcinkiem).")
+        return
+
+    retriever = rag_retrieval.load_retriever(
+        use_embeddings=not args.lexical_only, top_k=max(K_VALUES),
+        use_router=not args.no_router, use_reranker=args.rerank,
+    )
+    # Rozgrzewka: pierwsze zapytanie ładuje leniwie wagi i alokuje bufory
+    retriever.retrieve(gold[0]["query"])
+
+    print(f"Uruchamiam {len(gold)} zapytań...")
+    metrics = evaluate(retriever, gold)
+
+    result = {
+        "label": args.label,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "config": {
+            "embed_model": None if args.lexical_only else rag_retrieval.EMBED_MODEL_NAME,
+            # Retriever zwraca max(K_VALUES) wyników, niezależnie od SIMILARITY_TOP_K czatu
+            "top_k": max(K_VALUES),
+            "candidate_top_k": rag_retrieval.CANDIDATE_TOP_K,
+            "rrf_k": rag_retrieval.RRF_K,
+            "router": not args.no_router,
+            "reranker": rag_retrieval.RERANK_MODEL_NAME if args.rerank else None,
+            "quantized": rag_retrieval.USE_QUANTIZED_INDEX,
+            "collection_size": collection.count(),
+            "gold_file": args.gold,
+        },
+        "index_build": {"seconds": round(build_seconds, 2)} if build_seconds is not None else _last_build_info(),
+        **metrics,
+    }
+
+    output = args.output or os.path.join(RESULTS_DIR, time.strftime("%Y%m%d-%H%M%S") + ".json")
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+
+    overall = metrics["overall"]
+    print("\n--- WYNIKI ---")
+    print("  ".join(f"{key}: {value}" for key, value in overall.items()))
+    for query_type, summary in metrics["per_type"].items():
+        print(f"  {query_type:<14} " + "  ".join(f"{key}: {value}" for key, value in summary.items()))
+    for stage, summary in metrics["latency"].items():
+        print(f"  {stage:<9} p50 {summary['p50_ms']:.1f} ms | p95 {summary['p95_ms']:.1f} ms")
+    if result["index_build"]:
+        print(f"  budowa indeksu: {result['index_build']['seconds']} s")
+    print(f"Wynik zapisany: {output}")
+
+
+if __name__ == "__main__":
+    main()
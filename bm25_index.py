@@ -0,0 +1,201 @@
+import gzip
+import json
+import math
+import os
+import re
+import unicodedata
+from collections import Counter
+from typing import Any, Dict, List, Optional, Tuple
+
+from chroma_utils import iter_collection
+
+# Parametry Okapi BM25
+BM25_K1 = 1.2
+BM25_B = 0.75
+# Polska fleksja: "Kurvinox", "Kurvinoxa", "Kurvinoxów" -> wspólny prefiks
+STEM_PREFIX_LEN = 6
+
+# Pola metadanych kopiowane do indeksu, żeby BM25 respektował filtry routera zapytań
+FILTER_METADATA_KEYS = ("type", "episode_id", "speaker", "character")
+# Flagi odcinków "ep_<id>": True - węzeł scalony z duplikatów ma flagę każdego swojego odcinka
+# (metadane ChromaDB muszą być skalarami, więc po liście odcinków nie da się filtrować)
+EPISODE_FLAG_PREFIX = "ep_"
+# Treść cytatu w tekście węzła (szablony build_rag_index.py: 'X powiedział: "..." (Kontekst: ...)',
+# 'Cytat z uniwersum: "..."'). Cudzysłów zamykający to ten, po którym jest kontekst albo koniec
+# tekstu - cudzysłowy w kontekście się nie liczą. Współdzielone z benchmark_retrieval.py.
+QUOTED_TEXT_RE = re.compile(r'"(.*?)"(?= \(Kontekst: |\Z)', re.DOTALL)
+
+TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+STOPWORDS = {
+    "a", "aby", "ale", "bo", "by", "byl", "byla", "bylo", "co", "czy", "do", "i", "ich", "jak",
+    "jest", "jej", "jego", "juz", "ktory", "ktora", "ktore", "kto", "na", "nie", "o", "od", "po",
+    "przez", "sie", "sa", "ta", "tak", "te", "ten", "to", "tu", "w", "we", "z", "za", "ze",
+}
+
+
+def _strip_diacritics(text: str) -> str:
+    # "ł" nie rozkłada się w NFKD, więc zamieniamy ją ręcznie
+    text = text.replace("ł", "l").replace("Ł", "L")
+    return "".join(c for c in unicodedata.normalize("NFKD", text) if not unicodedata.combining(c))
+
+
+def episode_flag(episode_id) -> str:
+    return f"{EPISODE_FLAG_PREFIX}{episode_id}"
+
+
+def filter_metadata(metadata: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Metadane, po których filtruje router: FILTER_METADATA_KEYS oraz flagi odcinków.
+    """
+    return {k: v for k, v in (metadata or {}).items()
+            if k in FILTER_METADATA_KEYS or k.startswith(EPISODE_FLAG_PREFIX)}
+
+
+def matches_where(metadata: Dict[str, Any], where: Optional[Dict[str, Any]]) -> bool:
+    """
+    Minimalny ewaluator filtrów w składni ChromaDB (`$and`, `$or`, `$in`, `$eq`, równość).
+    """
+    if not where:
+        return True
+    for key, condition in where.items():
+        if key == "$and":
+            if not all(matches_where(metadata, sub) for sub in condition):
+                return False
+        elif key == "$or":
+            if not any(matches_where(metadata, sub) for sub in condition):
+                return False
+        elif isinstance(condition, dict):
+            value = metadata.get(key)
+            if "$in" in condition and value not in condition["$in"]:
+                return False
+            if "$eq" in condition and value != condition["$eq"]:
+                return False
+        elif metadata.get(key) != condition:
+            return False
+    return True
+
+
+def normalize_tokens(text: str) -> List[str]:
+    """
+    Słowa tekstu małymi literami i bez polskich znaków diakrytycznych.
+    """
+    return TOKEN_RE.findall(_strip_diacritics(text.lower()))
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    Normalizacja pod polskie teksty: małe litery, bez diakrytyków, bez stopwordów,
+    obcięcie do prefiksu (tani zamiennik stemmera).
+    """
+    return [t[:STEM_PREFIX_LEN] for t in normalize_tokens(text) if t not in STOPWORDS]
+
+
+class BM25Index:
+    """
+    Zwarty odwrócony indeks BM25 nad węzłami kolekcji `bomba_lore`.
+    Listy postingów trzymają pary (indeks_dokumentu, tf) z kodowaniem delta na dysku.
+    """
+
+    def __init__(self, doc_ids: List[str], doc_lens: List[int], postings: Dict[str, List[Tuple[int, int]]],
+                 doc_meta: Optional[List[Dict[str, Any]]] = None, k1: float = BM25_K1, b: float = BM25_B):
+        self.doc_ids = doc_ids
+        self.doc_meta = doc_meta or [{} for _ in doc_ids]
+        self.doc_lens = doc_lens
+        self.postings = postings
+        self.k1 = k1
+        self.b = b
+        self.avg_doc_len = (sum(doc_lens) / len(doc_lens)) if doc_lens else 0.0
+        n_docs = len(doc_ids)
+        self.idf = {
+            term: math.log(1 + (n_docs - len(plist) + 0.5) / (len(plist) + 0.5))
+            for term, plist in postings.items()
+        }
+
+    def __len__(self) -> int:
+        return len(self.doc_ids)
+
+    @classmethod
+    def build(cls, items) -> "BM25Index":
+        """
+        Buduje indeks z iterowalnej kolekcji trójek (id_węzła, tekst, metadane).
+        """
+        doc_ids: List[str] = []
+        doc_lens: List[int] = []
+        doc_meta: List[Dict[str, Any]] = []
+        postings: Dict[str, List[Tuple[int, int]]] = {}
+        for doc_id, text, metadata in items:
+            doc_idx = len(doc_ids)
+            tokens = tokenize(text or "")
+            doc_ids.append(doc_id)
+            doc_lens.append(len(tokens))
+            doc_meta.append(filter_metadata(metadata))
+            for term, tf in Counter(tokens).items():
+                postings.setdefault(term, []).append((doc_idx, tf))
+        return cls(doc_ids, doc_lens, postings, doc_meta)
+
+    @classmethod
+    def build_from_collection(cls, collection) -> "BM25Index":
+        def items():
+            for page in iter_collection(collection, include=["documents", "metadatas"]):
+                yield from zip(page["ids"], page["documents"], page["metadatas"])
+        return cls.build(items())
+
+    def search(self, query: str, top_k: int, where: Optional[Dict[str, Any]] = None) -> List[Tuple[str, float]]:
+        """
+        Zwraca listę (id_węzła, wynik_bm25) posortowaną malejąco.
+        `where` (składnia ChromaDB) zawęża wyniki do pasujących metadanych.
+        """
+        scores: Dict[int, float] = {}
+        for term in set(tokenize(query)):
+            plist = self.postings.get(term)
+            if not plist:
+                continue
+            idf = self.idf[term]
+            for doc_idx, tf in plist:
+                if where and not matches_where(self.doc_meta[doc_idx], where):
+                    continue
+                norm = self.k1 * (1 - self.b + self.b * self.doc_lens[doc_idx] / (self.avg_doc_len or 1.0))
+                scores[doc_idx] = scores.get(doc_idx, 0.0) + idf * tf * (self.k1 + 1) / (tf + norm)
+
+        best = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:top_k]
+        return [(self.doc_ids[doc_idx], score) for doc_idx, score in best]
+
+    # --- Zapis / odczyt ---
+
+    def save(self, path: str):
+        encoded = {}
+        for term, plist in self.postings.items():
+            flat, prev = [], 0
+            for doc_idx, tf in plist:
+                flat.extend((doc_idx - prev, tf))
+                prev = doc_idx
+            encoded[term] = flat
+
+        payload = {
+            "k1": self.k1,
+            "b": self.b,
+            "doc_ids": self.doc_ids,
+            "doc_lens": self.doc_lens,
+            "doc_meta": self.doc_meta,
+            "postings": encoded,
+        }
+        tmp_path = path + ".tmp"
+        with gzip.open(tmp_path, "wt", encoding="utf-8") as f:
+            json.dump(payload, f, ensure_ascii=False, separators=(",", ":"))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> "BM25Index":
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            payload = json.load(f)
+
+        postings = {}
+        for term, flat in payload["postings"].items():
+            plist, doc_idx = [], 0
+            for i in range(0, len(flat), 2):
+                doc_idx += flat[i]
+                plist.append((doc_idx, flat[i + 1]))
+            postings[term] = plist
+
+        return cls(payload["doc_ids"], payload["doc_lens"], postings,
+                   payload.get("doc_meta"), payload["k1"], payload["b"])
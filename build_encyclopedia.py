@@ -1,13 +1,17 @@
+import argparse
 import os
 import json
-import time
 import re
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
 from google import genai
 from google.genai import types
 from dotenv import load_dotenv
 from pydantic import BaseModel, Field
-from typing import Literal
+from typing import Dict, List, Literal, Optional
+
+from gemini_cache import ResponseCache, cache_key, open_cache
+from gemini_utils import GEMINI_MAX_WORKERS, RateLimiter, call_with_retry, estimate_tokens
 
 load_dotenv()
 
@@ -51,13 +55,13 @@ class EpisodeAnalysis(BaseModel):
 
 INPUT_DIR = "transcriptions_clean"
 OUTPUT_DIR = "lore_extracted"
+MODEL_NAME = "gemini-2.5-flash"
 
-api_key = os.getenv("GEMINI_API_KEY")
-if not api_key:
-    print("No API key set.")
-    exit(1)
-
-client = genai.Client(api_key=api_key)
+# Tryb okienkowy (--windowed): długie odcinki dzielimy na zachodzące na siebie okna czasowe
+WINDOW_SECONDS = 300.0
+WINDOW_OVERLAP_SECONDS = 30.0
+# Szacowany rozmiar odpowiedzi (JSON encyklopedii) do limitu tokenów/min
+RESPONSE_TOKEN_ESTIMATE = 2000
 
 safety_settings = [
     types.SafetySetting(category="HARM_CATEGORY_HARASSMENT", threshold="BLOCK_NONE"),
@@ -82,9 +86,171 @@ Otrzymasz plik JSON z segmentami transkrypcji. Przeanalizuj całość.
 """
 
 
+# --- WINDOWED EXTRACTION ---
+
+def split_into_windows(segments: List[dict], window_s: float = WINDOW_SECONDS,
+                       overlap_s: float = WINDOW_OVERLAP_SECONDS) -> List[List[dict]]:
+    """
+    Dzieli segmenty transkrypcji na okna czasowe (po `start`/`end`) zachodzące na siebie o `overlap_s`.
+    Segment trafia do każdego okna, z którym się przecina, więc wypowiedzi na granicy nie giną.
+    """
+    if not segments:
+        return []
+    episode_end = max(seg["end"] for seg in segments)
+    step = max(window_s - overlap_s, 1.0)
+
+    windows = []
+    window_start = 0.0
+    while window_start < episode_end:
+        window_end = window_start + window_s
+        window = [seg for seg in segments if seg["start"] < window_end and seg["end"] > window_start]
+        if window:
+            windows.append(window)
+        if window_end >= episode_end:
+            break
+        window_start += step
+    return windows
+
+
+def _norm(text: Optional[str]) -> str:
+    return re.sub(r"[^\w]+", " ", (text or "").lower()).strip()
+
+
+def _append_unique(target: List[str], values: List[str]):
+    seen = {_norm(v) for v in target}
+    for value in values:
+        if value and _norm(value) not in seen:
+            seen.add(_norm(value))
+            target.append(value)
+
+
+def merge_analyses(parts: List[EpisodeAnalysis]) -> EpisodeAnalysis:
+    """
+    Scala wyniki z kolejnych okien w jedną analizę odcinka - deterministycznie, w kolejności okien.
+    Postacie łączymy po imieniu, fakty po (kategoria, treść), cytaty po treści (po normalizacji).
+    Cytat "gem" znika, jeśli w innym oknie ten sam tekst został przypisany mówcy.
+    """
+    synopses: List[str] = []
+    characters: Dict[str, CharacterAction] = {}
+    facts: Dict[tuple, LoreFact] = {}
+    vocabulary: List[str] = []
+    attributed: Dict[str, AttributedQuote] = {}
+    gems: List[str] = []
+
+    for part in parts:
+        _append_unique(synopses, [part.synopsis])
+
+        for char in part.character_actions:
+            key = _norm(char.name)
+            if key not in characters:
+                characters[key] = char.model_copy(deep=True)
+                continue
+            merged = characters[key]
+            if _norm(char.role_in_episode) not in _norm(merged.role_in_episode):
+                merged.role_in_episode = f"{merged.role_in_episode} {char.role_in_episode}".strip()
+            _append_unique(merged.traits_exhibited, char.traits_exhibited)
+
+        for fact in part.lore_facts:
+            facts.setdefault((_norm(fact.category), _norm(fact.fact)), fact)
+
+        _append_unique(vocabulary, part.quotes.episode_vocabulary)
+        for quote in part.quotes.attributed_quotes:
+            key = _norm(quote.text)
+            # Przy powtórzeniu w strefie nakładania wygrywa pewniejsze przypisanie
+            if key not in attributed or (quote.confidence == "High" and attributed[key].confidence != "High"):
+                attributed[key] = quote
+        _append_unique(gems, part.quotes.unattributed_gems)
+
+    first = parts[0]
+    return EpisodeAnalysis(
+        episode_id=first.episode_id,
+        title=first.title,
+        synopsis=" ".join(synopses),
+        character_actions=list(characters.values()),
+        lore_facts=list(facts.values()),
+        quotes=QuotesAnalysis(
+            episode_vocabulary=vocabulary,
+            attributed_quotes=list(attributed.values()),
+            unattributed_gems=[gem for gem in gems if _norm(gem) not in attributed],
+        ),
+    )
+
+
+def extract_analysis(client, limiter: RateLimiter, segments: List[dict], window_note: Optional[str] = None,
+                     cache: Optional[ResponseCache] = None) -> Optional[EpisodeAnalysis]:
+    """
+    Jedno wywołanie API ze schematem `EpisodeAnalysis` (z ponawianiem przy 429/5xx).
+    Identyczne wejście (model, prompt, dane, schemat, konfiguracja) jest obsługiwane z cache bez kosztu API.
+    """
+    raw_transcription_text = json.dumps(segments, ensure_ascii=False)
+    contents = [SYSTEM_PROMPT, raw_transcription_text]
+    if window_note:
+        contents.insert(1, window_note)
+
+    config = types.GenerateContentConfig(
+        response_mime_type="application/json",
+        response_schema=EpisodeAnalysis,
+        safety_settings=safety_settings,
+        temperature=0.2
+    )
+    key = cache_key(MODEL_NAME, SYSTEM_PROMPT + (window_note or ""), raw_transcription_text, EpisodeAnalysis,
+                    config.model_dump(mode="json", exclude={"response_schema"}))
+    cached = cache.get(key) if cache else None
+    if cached is not None:
+        return EpisodeAnalysis.model_validate_json(cached)
+
+    response = call_with_retry(
+        lambda: client.models.generate_content(model=MODEL_NAME, contents=contents, config=config),
+        limiter,
+        tokens=estimate_tokens(SYSTEM_PROMPT + raw_transcription_text) + RESPONSE_TOKEN_ESTIMATE,
+    )
+    if not response.text:
+        return None
+
+    # Do cache trafia tylko odpowiedź zgodna ze schematem - błędna zostanie odpytana ponownie
+    parsed = EpisodeAnalysis.model_validate_json(response.text)
+    if cache:
+        cache.put(key, response.text)
+    return parsed
+
+
+def _format_ts(seconds: float) -> str:
+    return f"{int(seconds // 60):02d}:{int(seconds % 60):02d}"
+
+
+def extract_windowed(client, limiter: RateLimiter, pool: ThreadPoolExecutor, filename: str,
+                     segments: List[dict], cache: Optional[ResponseCache] = None) -> Optional[EpisodeAnalysis]:
+    """
+    Wysyła okna równolegle i scala wyniki. Błąd jednego okna (po wyczerpaniu ponowień)
+    unieważnia tylko ten plik w tym przebiegu, a pozostałe okna nie czekają na niego w kolejce.
+    Udane okna zostają w cache, więc ponowny przebieg odpytuje tylko te, które zawiodły.
+    """
+    windows = split_into_windows(segments)
+    futures = []
+    for i, window in enumerate(windows):
+        note = (f"UWAGA: To fragment {i + 1}/{len(windows)} odcinka "
+                f"({_format_ts(window[0]['start'])}-{_format_ts(window[-1]['end'])}). "
+                f"Analizuj tylko ten fragment; streszczenie ma dotyczyć fragmentu.") if len(windows) > 1 else None
+        futures.append(pool.submit(extract_analysis, client, limiter, window, note, cache))
+
+    parts = []
+    for i, future in enumerate(futures):
+        try:
+            part = future.result()
+        except Exception as e:
+            print(f"API Error dla {filename} (okno {i + 1}/{len(windows)}): {e}")
+            return None
+        if not part:
+            print(f"Błąd: Model zwrócił pustą odpowiedź dla {filename} (okno {i + 1}/{len(windows)})")
+            return None
+        parts.append(part)
+    return merge_analyses(parts)
+
+
 # --- PROCESSING FUNCTION ---
 
-def process_file(filename):
+def process_file(filename, client, limiter: RateLimiter, pool: Optional[ThreadPoolExecutor] = None,
+                 cache: Optional[ResponseCache] = None):
     input_path = os.path.join(INPUT_DIR, filename)
     output_path = os.path.join(OUTPUT_DIR, filename)
 
@@ -110,23 +276,16 @@ def process_file(filename):
     with open(input_path, 'r', encoding='utf-8') as f:
         data = json.load(f)
 
-    raw_transcription_text = json.dumps(data, ensure_ascii=False)
-
-    # 3. Call API
+    # 3. Call API (w trybie okienkowym: okna równolegle w `pool`)
     try:
-        response = client.models.generate_content(
-            model='gemini-2.5-flash',
-            contents=[SYSTEM_PROMPT, raw_transcription_text],
-            config=types.GenerateContentConfig(
-                response_mime_type="application/json",
-                response_schema=EpisodeAnalysis,
-                safety_settings=safety_settings,
-                temperature=0.2
-            )
-        )
-
-        if response.parsed:
-            final_data = response.parsed
+        if pool is not None:
+            final_data = extract_windowed(client, limiter, pool, filename, data, cache)
+            if final_data is None:
+                return False
+        else:
+            final_data = extract_analysis(client, limiter, data, cache=cache)
+
+        if final_data:
             final_data.episode_id = real_episode_id
             final_data.title = real_title
 
@@ -145,6 +304,24 @@ def process_file(filename):
 # --- MAIN PRODUCTION LOOP ---
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Ekstrakcja encyklopedii lore z oczyszczonych transkrypcji.")
+    parser.add_argument("--windowed", action="store_true",
+                        help=f"Dziel odcinki na okna {WINDOW_SECONDS:.0f} s (zakładka {WINDOW_OVERLAP_SECONDS:.0f} s) "
+                             f"i analizuj je równolegle.")
+    args = parser.parse_args()
+
+    api_key = os.getenv("GEMINI_API_KEY")
+    if not api_key:
+        print("No API key set.")
+        exit(1)
+
+    client = genai.Client(api_key=api_key)
+    # Rate Limiting: wspólny token bucket zamiast stałej pauzy między żądaniami
+    limiter = RateLimiter()
+    # Cache odpowiedzi: zmiana post-processingu albo restart po awarii nie kosztuje ponownych wywołań
+    cache = open_cache()
+    pool = ThreadPoolExecutor(max_workers=GEMINI_MAX_WORKERS) if args.windowed else None
+
     if not os.path.exists(OUTPUT_DIR):
         os.makedirs(OUTPUT_DIR)
 
@@ -156,7 +333,7 @@ if __name__ == "__main__":
 
     print(f"--- ROZPOCZYNAM BUDOWĘ ENCYKLOPEDII ---")
     print(f"Znaleziono plików: {len(files)}")
-    print(f"Model: Gemini 2.5 Flash | Output: {OUTPUT_DIR}/")
+    print(f"Model: Gemini 2.5 Flash | Output: {OUTPUT_DIR}/ | Tryb: {'okienkowy' if args.windowed else 'cały plik'}")
 
     success_count = 0
     fail_count = 0
@@ -170,19 +347,21 @@ if __name__ == "__main__":
         if os.path.exists(os.path.join(OUTPUT_DIR, filename)):
             continue
 
-        success = process_file(filename)
+        success = process_file(filename, client, limiter, pool, cache)
 
         if success:
             success_count += 1
-            # Rate Limiting: 4 sekundy przerwy między żądaniami (Free Tier ~15 RPM)
-            # Jeśli masz płatne API, możesz zmniejszyć do 0.5s lub 1s
-            time.sleep(4)
         else:
             fail_count += 1
             # Zapiszmy błędy do logu, żeby wiedzieć co powtórzyć
             with open("failed_files.txt", "a") as log:
                 log.write(f"{filename}\n")
 
+    if pool is not None:
+        pool.shutdown()
+    if cache is not None:
+        print(cache.summary())
+
     print(f"\n--- ZAKOŃCZONO ---")
     print(f"Sukcesy: {success_count}")
     print(f"Błędy: {fail_count}")
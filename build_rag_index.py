@@ -1,20 +1,60 @@
+import argparse
+import bisect
 import chromadb
+import hashlib
+import itertools
 import json
+import multiprocessing
 import os
+import re
 import shutil
 import sys
+import time
 import torch
 from tqdm import tqdm
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Iterable, Iterator, Optional
+from transformers import AutoTokenizer
 
-from llama_index.core import VectorStoreIndex, Document, StorageContext
+from llama_index.core import Document
+from llama_index.core.schema import MetadataMode, TextNode
 from llama_index.vector_stores.chroma import ChromaVectorStore
 from llama_index.embeddings.huggingface import HuggingFaceEmbedding
 
+from bm25_index import QUOTED_TEXT_RE, BM25Index, episode_flag
+from chroma_utils import collection_content_hash, hnsw_metadata, hnsw_structure, iter_collection, set_search_ef
+from near_dedup import find_duplicate_groups_hashed, shingle_hashes
+from quantized_index import QUANTIZATION_MODES, QUANTIZED_DIR, QuantizedIndex
+
 # --- KONFIGURACJA ---
 INPUT_DIR = "lore_extracted"
 DB_DIRECTORY = "./chroma_db"
 EMBED_MODEL_NAME = "sdadas/mmlw-retrieval-roberta-large"
+# Tokenizer modelu czatu (adapter LoRA dziedziczy go z modelu bazowego)
+LLM_TOKENIZER_NAME = "speakleash/bielik-7b-instruct-v0.1"
+COLLECTION_NAME = "bomba_lore"
+# Hashe plików źródłowych z ostatniego przebiegu (tryb --incremental)
+MANIFEST_FILE = os.path.join(DB_DIRECTORY, "index_manifest.json")
+EMBED_BATCH_SIZE = 64
+# Odwrócony indeks BM25 (wyszukiwanie leksykalne w chat.py)
+BM25_INDEX_FILE = os.path.join(DB_DIRECTORY, "bm25_index.json.gz")
+# Słownik postaci i odcinków dla routera zapytań w chat.py
+LORE_CATALOG_FILE = os.path.join(DB_DIRECTORY, "lore_catalog.json")
+
+# Metadane techniczne dla chat.py - nie mogą trafić do tekstu embeddingu ani promptu
+TOKEN_METADATA_KEYS = ["llm_token_count", "char_len", "sentence_splits"]
+HASH_METADATA_KEYS = ["doc_hash"]
+# Deduplikacja prawie identycznych cytatów i faktów między odcinkami.
+# Cytaty przypisane i "gems" porównujemy razem - to te same powiedzonka z serialu.
+DEDUP_FAMILIES = {"quote": "quote", "quote_unattributed": "quote", "lore_fact": "lore_fact"}
+# Lista wszystkich odcinków zduplikowanego węzła (string, bo metadane ChromaDB muszą być skalarami);
+# filtrowanie po odcinku idzie przez flagi bm25_index.episode_flag, ustawiane każdemu węzłowi
+DEDUP_METADATA_KEYS = ["episode_ids"]
+# Wersja układu metadanych węzłów - węzły starszej wersji (np. bez flag odcinków) wymagają pełnej przebudowy
+NODE_METADATA_VERSION = 2
+# Wersja odcisków w manifeście - zmiana sposobu ich liczenia unieważnia zapisane odciski
+DEDUP_FINGERPRINT_VERSION = 2
+# Koniec zdania: znak interpunkcyjny (+ ewentualny cudzysłów/nawias) przed białym znakiem
+SENTENCE_END_RE = re.compile(r"[.!?…]+[\"'”)]*(?=\s)")
 
 
 def get_optimal_device() -> str:
@@ -45,117 +85,618 @@ def _create_doc(text: str, specific_metadata: Dict[str, Any], base_metadata: Dic
     return Document(text=text, metadata=meta)
 
 
-def load_documents_from_json(directory: str) -> List[Document]:
+def compute_token_metadata(texts: List[str], tokenizer) -> List[Dict[str, Any]]:
     """
-    Wczytuje pliki JSON i konwertuje je na semantyczne dokumenty LlamaIndex.
-    Zawiera obsługę błędów (try-except) i bezpieczny dostęp do danych (.get).
+    Liczy tokeny LLM dla każdego tekstu oraz punkty podziału na granicach zdań.
+    `sentence_splits` to JSON z parami [koniec_zdania_w_znakach, liczba_tokenów_do_tego_miejsca],
+    bo metadane ChromaDB muszą być skalarami.
     """
-    llama_documents = []
+    encodings = tokenizer(texts, add_special_tokens=False, return_offsets_mapping=True)
 
-    # Sprawdzenie czy katalog istnieje
-    if not os.path.exists(directory):
-        print(f"BŁĄD: Katalog {directory} nie istnieje.")
-        return []
+    results = []
+    for text, offsets in zip(texts, encodings["offset_mapping"]):
+        token_ends = [end for _, end in offsets]
+        splits = []
+        for match in SENTENCE_END_RE.finditer(text):
+            char_end = match.end()
+            splits.append([char_end, bisect.bisect_right(token_ends, char_end)])
 
-    files = [f for f in os.listdir(directory) if f.endswith(".json")]
-    print(f"Przetwarzanie {len(files)} plików JSON na semantyczne dokumenty...")
+        results.append({
+            "llm_token_count": len(offsets),
+            "char_len": len(text),
+            "sentence_splits": json.dumps(splits, separators=(",", ":")),
+        })
+    return results
 
-    for filename in tqdm(files):
-        path = os.path.join(directory, filename)
 
-        try:
-            with open(path, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-
-            # Bezpieczne pobieranie metadanych podstawowych
-            base_metadata = {
-                "episode_id": data.get("episode_id", "Unknown"),
-                "title": data.get("title", "Unknown"),
-                "source_file": filename
-            }
-
-            # 1. SYNOPSIS
-            synopsis_text = data.get("synopsis")
-            if synopsis_text:
-                llama_documents.append(_create_doc(
-                    text=synopsis_text,
-                    specific_metadata={"type": "synopsis"},
-                    base_metadata=base_metadata
-                ))
+def annotate_token_metadata(documents: List[Document], tokenizer):
+    """
+    Dopisuje do dokumentów metadane tokenów, żeby chat.py nie tokenizował kontekstu przy każdym pytaniu.
+    """
+    for doc, token_meta in zip(documents, compute_token_metadata([d.text for d in documents], tokenizer)):
+        doc.metadata.update(token_meta)
+        doc.excluded_embed_metadata_keys.extend(TOKEN_METADATA_KEYS)
+        doc.excluded_llm_metadata_keys.extend(TOKEN_METADATA_KEYS)
+
+
+def file_content_hash(path: str) -> str:
+    """
+    Hash SHA-256 zawartości pliku źródłowego (do wykrywania zmian między przebiegami).
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 16), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _assign_ids(documents: List[Document], filename: str):
+    """
+    Nadaje dokumentom deterministyczne ID (plik + typ + treść) oraz hash treści.
+    Dzięki temu ten sam fakt/cytat zachowuje ID między przebiegami i nie jest embedowany ponownie.
+    """
+    occurrences: Dict[str, int] = {}
+    for doc in documents:
+        key = f"{filename}|{doc.metadata.get('type')}|{doc.text}"
+        n = occurrences.get(key, 0)
+        occurrences[key] = n + 1
+
+        doc.id_ = hashlib.sha256(f"{key}|{n}".encode("utf-8")).hexdigest()[:32]
+        _assign_doc_hash(doc)
+        doc.excluded_embed_metadata_keys.extend(HASH_METADATA_KEYS)
+        doc.excluded_llm_metadata_keys.extend(HASH_METADATA_KEYS)
+
+
+def _assign_doc_hash(doc: Document):
+    metadata = {k: v for k, v in doc.metadata.items() if k != "doc_hash"}
+    payload = doc.text + json.dumps(metadata, sort_keys=True, ensure_ascii=False)
+    doc.metadata["doc_hash"] = hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def _set_episode_flags(doc: Document, episode_ids: List[Any]):
+    """
+    Flaga "ep_<id>": True dla każdego odcinka węzła - po niej filtruje router zapytań.
+    """
+    for episode_id in episode_ids:
+        if episode_id in (None, "", "Unknown"):
+            continue
+        key = episode_flag(episode_id)
+        doc.metadata[key] = True
+        if key not in doc.excluded_embed_metadata_keys:
+            doc.excluded_embed_metadata_keys.append(key)
+            doc.excluded_llm_metadata_keys.append(key)
+
+
+def _dedup_text(doc: Document) -> str:
+    """
+    Sama treść cytatu/faktu, bez szablonu ("X powiedział:", "Fakt (kategoria):", kontekst).
+    """
+    if doc.metadata.get("type") == "lore_fact":
+        return doc.text.split(": ", 1)[-1]
+    match = QUOTED_TEXT_RE.search(doc.text)
+    return match.group(1) if match else doc.text
+
+
+def _apply_dedup_plan(documents: List[Document], file_plan: Dict[str, Optional[str]]) -> List[Document]:
+    """
+    Usuwa duplikaty wskazane w planie (None) i dopisuje reprezentantom listę odcinków.
+    """
+    kept = []
+    for doc in documents:
+        if doc.id_ not in file_plan:
+            kept.append(doc)
+            continue
+        episode_ids = file_plan[doc.id_]
+        if episode_ids is None:
+            continue
+        doc.metadata["episode_ids"] = episode_ids
+        doc.excluded_embed_metadata_keys.extend(DEDUP_METADATA_KEYS)
+        _set_episode_flags(doc, episode_ids.split(","))
+        _assign_doc_hash(doc)
+        kept.append(doc)
+    return kept
+
 
-            # 2. LORE FACTS
-            for fact in data.get("lore_facts", []):
-                # Używamy .get() dla bezpieczeństwa
-                cat = fact.get("category", "General")
-                content = fact.get("fact", "")
-
-                if content:
-                    llama_documents.append(_create_doc(
-                        text=f"Fakt ({cat}): {content}",
-                        specific_metadata={"type": "lore_fact", "category": cat},
-                        base_metadata=base_metadata
-                    ))
-
-            # 3. CHARACTER ACTIONS
-            for char in data.get("character_actions", []):
-                name = char.get("name", "Unknown")
-                role = char.get("role_in_episode", "")
-                traits = ", ".join(char.get("traits_exhibited", []))
-
-                text_content = f"Postać: {name}. Rola: {role} Cechy: {traits}."
-
-                llama_documents.append(_create_doc(
-                    text=text_content,
-                    specific_metadata={"type": "character_profile", "character": name},
+def documents_from_file(directory: str, filename: str,
+                        dedup_plan: Optional[Dict[str, Optional[str]]] = None) -> Optional[List[Document]]:
+    """
+    Zamienia jeden plik JSON odcinka na listę dokumentów.
+    `dedup_plan` (z `plan_dedup`) usuwa duplikaty z innych odcinków i scala ich `episode_id`.
+    Zwraca None, jeśli pliku nie da się wczytać (błąd jest logowany).
+    """
+    path = os.path.join(directory, filename)
+    documents = []
+
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+
+        # Bezpieczne pobieranie metadanych podstawowych
+        base_metadata = {
+            "episode_id": data.get("episode_id", "Unknown"),
+            "title": data.get("title", "Unknown"),
+            "source_file": filename
+        }
+
+        # 1. SYNOPSIS
+        synopsis_text = data.get("synopsis")
+        if synopsis_text:
+            documents.append(_create_doc(
+                text=synopsis_text,
+                specific_metadata={"type": "synopsis"},
+                base_metadata=base_metadata
+            ))
+
+        # 2. LORE FACTS
+        for fact in data.get("lore_facts", []):
+            # Używamy .get() dla bezpieczeństwa
+            cat = fact.get("category", "General")
+            content = fact.get("fact", "")
+
+            if content:
+                documents.append(_create_doc(
+                    text=f"Fakt ({cat}): {content}",
+                    specific_metadata={"type": "lore_fact", "category": cat},
                     base_metadata=base_metadata
                 ))
 
-            # 4. QUOTES
-            quotes_data = data.get("quotes", {})
-
-            # Attributed Quotes
-            for quote in quotes_data.get("attributed_quotes", []):
-                speaker = quote.get("speaker", "Unknown")
-                text = quote.get("text", "")
-                context = quote.get("context", "")
-                confidence = quote.get("confidence", "Medium")
-
-                text_content = f"{speaker} powiedział: \"{text}\""
-                if context:
-                    text_content += f" (Kontekst: {context})"
-
-                llama_documents.append(_create_doc(
-                    text=text_content,
-                    specific_metadata={
-                        "type": "quote",
-                        "speaker": speaker,
-                        "confidence": confidence
-                    },
+        # 3. CHARACTER ACTIONS
+        for char in data.get("character_actions", []):
+            name = char.get("name", "Unknown")
+            role = char.get("role_in_episode", "")
+            traits = ", ".join(char.get("traits_exhibited", []))
+
+            text_content = f"Postać: {name}. Rola: {role} Cechy: {traits}."
+
+            documents.append(_create_doc(
+                text=text_content,
+                specific_metadata={"type": "character_profile", "character": name},
+                base_metadata=base_metadata
+            ))
+
+        # 4. QUOTES
+        quotes_data = data.get("quotes", {})
+
+        # Attributed Quotes
+        for quote in quotes_data.get("attributed_quotes", []):
+            speaker = quote.get("speaker", "Unknown")
+            text = quote.get("text", "")
+            context = quote.get("context", "")
+            confidence = quote.get("confidence", "Medium")
+
+            text_content = f"{speaker} powiedział: \"{text}\""
+            if context:
+                text_content += f" (Kontekst: {context})"
+
+            documents.append(_create_doc(
+                text=text_content,
+                specific_metadata={
+                    "type": "quote",
+                    "speaker": speaker,
+                    "confidence": confidence
+                },
+                base_metadata=base_metadata
+            ))
+
+        # Unattributed Gems
+        for gem in quotes_data.get("unattributed_gems", []):
+            if gem:  # Ignoruj puste stringi
+                documents.append(_create_doc(
+                    text=f"Cytat z uniwersum: \"{gem}\"",
+                    specific_metadata={"type": "quote_unattributed"},
                     base_metadata=base_metadata
                 ))
 
-            # Unattributed Gems
-            for gem in quotes_data.get("unattributed_gems", []):
-                if gem:  # Ignoruj puste stringi
-                    llama_documents.append(_create_doc(
-                        text=f"Cytat z uniwersum: \"{gem}\"",
-                        specific_metadata={"type": "quote_unattributed"},
-                        base_metadata=base_metadata
-                    ))
-
-        except json.JSONDecodeError:
-            print(f"\nBŁĄD: Plik {filename} jest uszkodzonym JSON-em. Pomijam.", file=sys.stderr)
+    except json.JSONDecodeError:
+        print(f"\nBŁĄD: Plik {filename} jest uszkodzonym JSON-em. Pomijam.", file=sys.stderr)
+        return None
+    except Exception as e:
+        print(f"\nBŁĄD: Nieoczekiwany problem z plikiem {filename}: {e}", file=sys.stderr)
+        return None
+
+    for doc in documents:
+        _set_episode_flags(doc, [doc.metadata.get("episode_id")])
+    _assign_ids(documents, filename)
+    if dedup_plan:
+        documents = _apply_dedup_plan(documents, dedup_plan)
+    return documents
+
+
+def list_source_files(directory: str) -> List[str]:
+    return sorted(f for f in os.listdir(directory) if f.endswith(".json"))
+
+
+def file_dedup_fingerprints(directory: str, filename: str) -> Optional[List[list]]:
+    """
+    Odciski cytatów i faktów jednego pliku: [id, typ, odcinek, mówca, hashe_shingli].
+    Zwraca None, jeśli pliku nie da się wczytać (nie trafia wtedy do cache).
+    """
+    documents = documents_from_file(directory, filename)
+    if documents is None:
+        return None
+    entries = []
+    for doc in documents:
+        if doc.metadata.get("type") not in DEDUP_FAMILIES:
+            continue
+        speaker = doc.metadata.get("speaker")
+        entries.append([
+            doc.id_, doc.metadata.get("type"), doc.metadata.get("episode_id"),
+            speaker if speaker not in (None, "Unknown") else None,
+            shingle_hashes(_dedup_text(doc)),
+        ])
+    return entries
+
+
+def plan_dedup(directory: str, files: List[str], file_hashes: Optional[Dict[str, str]] = None,
+               fingerprint_cache: Optional[Dict[str, Dict[str, Any]]] = None) -> Dict[str, Dict[str, Optional[str]]]:
+    """
+    Szuka prawie identycznych cytatów i faktów w całym korpusie (MinHash/LSH).
+    Zwraca plan per plik: {id_dokumentu: None} dla duplikatów do pominięcia
+    oraz {id_reprezentanta: "odcinek1,odcinek2"} dla węzła, który zostaje.
+    Reprezentantem jest pierwsze wystąpienie, przy cytatach - najlepiej z przypisanym mówcą.
+
+    `fingerprint_cache` ({plik: {"file_hash", "version", "entries"}}, z manifestu) jest aktualizowany w miejscu:
+    parsowane są tylko pliki, których hash się zmienił - reszta korpusu to same odciski z manifestu.
+    """
+    cache = fingerprint_cache if fingerprint_cache is not None else {}
+    for filename in set(cache) - set(files):
+        del cache[filename]
+
+    parsed = 0
+    entries: Dict[str, List[tuple]] = {family: [] for family in set(DEDUP_FAMILIES.values())}
+    for filename in files:
+        file_hash = (file_hashes or {}).get(filename)
+        cached = cache.get(filename)
+        if (file_hash is None or cached is None or cached.get("file_hash") != file_hash
+                or cached.get("version") != DEDUP_FINGERPRINT_VERSION):
+            fingerprints = file_dedup_fingerprints(directory, filename)
+            parsed += 1
+            if fingerprints is None:
+                cache.pop(filename, None)
+                continue
+            if file_hash is not None:
+                cache[filename] = {"file_hash": file_hash, "version": DEDUP_FINGERPRINT_VERSION,
+                                   "entries": fingerprints}
+        else:
+            fingerprints = cached["entries"]
+        for doc_id, doc_type, episode_id, speaker, hashes in fingerprints:
+            entries[DEDUP_FAMILIES[doc_type]].append((filename, doc_id, doc_type, episode_id, hashes, speaker))
+
+    plan: Dict[str, Dict[str, Optional[str]]] = {}
+    removed = 0
+    for family in sorted(entries):
+        items = entries[family]
+        groups = find_duplicate_groups_hashed([item[4] for item in items], [item[5] for item in items])
+        for members in groups:
+            canonical = next((i for i in members if items[i][2] == "quote"), members[0])
+            episode_ids = []
+            for i in members:
+                if items[i][3] not in episode_ids:
+                    episode_ids.append(items[i][3])
+                filename, doc_id = items[i][0], items[i][1]
+                plan.setdefault(filename, {})[doc_id] = None
+            filename, doc_id = items[canonical][0], items[canonical][1]
+            plan[filename][doc_id] = ",".join(str(e) for e in episode_ids)
+            removed += len(members) - 1
+
+    print(f"Deduplikacja: {removed} prawie identycznych cytatów/faktów scalonych z innymi odcinkami "
+          f"(sparsowane pliki: {parsed}/{len(files)}, reszta z odcisków w manifeście).")
+    return plan
+
+
+def dedup_signature(file_plan: Optional[Dict[str, Optional[str]]]) -> Optional[str]:
+    """
+    Hash planu deduplikacji pliku - zmiana (np. nowy duplikat w innym odcinku) wymusza ponowny diff pliku.
+    """
+    if not file_plan:
+        return None
+    payload = json.dumps(file_plan, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def iter_documents_from_json(directory: str,
+                             dedup_plan: Optional[Dict[str, Dict[str, Optional[str]]]] = None) -> Iterator[Document]:
+    """
+    Leniwie wczytuje pliki JSON (jeden na raz) i zwraca dokumenty po kolei.
+    W pamięci jest naraz tylko jeden odcinek, niezależnie od wielkości korpusu.
+    """
+    # Sprawdzenie czy katalog istnieje
+    if not os.path.exists(directory):
+        print(f"BŁĄD: Katalog {directory} nie istnieje.")
+        return
+
+    dedup_plan = dedup_plan or {}
+    for filename in list_source_files(directory):
+        documents = documents_from_file(directory, filename, dedup_plan.get(filename))
+        if documents:
+            yield from documents
+
+
+def load_documents_from_json(directory: str, dedup: bool = True) -> List[Document]:
+    """
+    Wczytuje pliki JSON i konwertuje je na semantyczne dokumenty LlamaIndex.
+    Zawiera obsługę błędów (try-except) i bezpieczny dostęp do danych (.get).
+    Przy `dedup=True` prawie identyczne cytaty i fakty z różnych odcinków zostają jednym dokumentem.
+    """
+    if not os.path.exists(directory):
+        print(f"BŁĄD: Katalog {directory} nie istnieje.")
+        return []
+    dedup_plan = plan_dedup(directory, list_source_files(directory)) if dedup else None
+    return list(iter_documents_from_json(directory, dedup_plan))
+
+
+def _load_manifest() -> Dict[str, Any]:
+    if not os.path.exists(MANIFEST_FILE):
+        return {}
+    try:
+        with open(MANIFEST_FILE, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError) as e:
+        print(f"Nie udało się wczytać manifestu {MANIFEST_FILE}: {e}", file=sys.stderr)
+        return {}
+
+
+def _save_manifest(manifest: Dict[str, Any]):
+    # Zapis atomowy - przerwany przebieg nie zostawi uszkodzonego manifestu
+    tmp_path = MANIFEST_FILE + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, MANIFEST_FILE)
+
+
+def _existing_doc_hashes(chroma_collection, filename: str) -> Dict[str, Optional[str]]:
+    """
+    Zwraca {id_węzła: doc_hash} dla węzłów pochodzących z danego pliku.
+    """
+    existing = chroma_collection.get(where={"source_file": filename}, include=["metadatas"])
+    return {
+        node_id: (meta or {}).get("doc_hash")
+        for node_id, meta in zip(existing["ids"], existing["metadatas"])
+    }
+
+
+def _to_node(doc: Document) -> TextNode:
+    return TextNode(
+        id_=doc.id_,
+        text=doc.text,
+        metadata=doc.metadata,
+        excluded_embed_metadata_keys=list(doc.excluded_embed_metadata_keys),
+        excluded_llm_metadata_keys=list(doc.excluded_llm_metadata_keys),
+    )
+
+
+def _embed_nodes(documents: List[Document], embed_model, llm_tokenizer) -> List[TextNode]:
+    """
+    Liczy metadane tokenów i embeddingi dla jednej paczki dokumentów.
+    """
+    annotate_token_metadata(documents, llm_tokenizer)
+    nodes = [_to_node(doc) for doc in documents]
+    embeddings = embed_model.get_text_embedding_batch(
+        [node.get_content(metadata_mode=MetadataMode.EMBED) for node in nodes]
+    )
+    for node, embedding in zip(nodes, embeddings):
+        node.embedding = embedding
+    return nodes
+
+
+def embed_and_store(documents: Iterable[Document], embed_model, llm_tokenizer, vector_store,
+                    batch_size: int = EMBED_BATCH_SIZE) -> int:
+    """
+    Liczy metadane tokenów i embeddingi w paczkach, po czym zapisuje węzły do ChromaDB.
+    Każda paczka trafia do bazy, zanim zostanie wczytana następna (stałe zużycie pamięci).
+    Jeden dokument = jeden węzeł (dokumenty są krótkie), więc ID węzła = deterministyczne ID dokumentu.
+    Zwraca liczbę zapisanych węzłów.
+    """
+    documents = iter(documents)
+    total = 0
+    started = time.perf_counter()
+
+    with tqdm(desc="Embedding", unit="doc") as pbar:
+        while True:
+            batch = list(itertools.islice(documents, batch_size))
+            if not batch:
+                break
+
+            vector_store.add(_embed_nodes(batch, embed_model, llm_tokenizer))
+            total += len(batch)
+            pbar.update(len(batch))
+
+    elapsed = time.perf_counter() - started
+    if total:
+        print(f"Zapisano {total} węzłów w {elapsed:.1f} s ({total / elapsed:.1f} docs/s).")
+    return total
+
+
+def _diff_file_documents(filename: str, existing: Dict[str, Optional[str]],
+                         file_plan: Optional[Dict[str, Optional[str]]] = None):
+    """
+    Porównuje dokumenty pliku z węzłami w bazie.
+    Zwraca (do_embedowania, nieaktualne_id, liczba_bez_zmian) albo None dla uszkodzonego pliku.
+    """
+    documents = documents_from_file(INPUT_DIR, filename, file_plan)
+    if documents is None:
+        return None
+
+    new_ids = set()
+    stale_ids = []
+    to_embed = []
+    kept = 0
+    for doc in documents:
+        new_ids.add(doc.id_)
+        if existing.get(doc.id_, "missing") == doc.metadata["doc_hash"]:
+            kept += 1
             continue
-        except Exception as e:
-            print(f"\nBŁĄD: Nieoczekiwany problem z plikiem {filename}: {e}", file=sys.stderr)
+        if doc.id_ in existing:
+            stale_ids.append(doc.id_)  # zmienione metadane - usuń i dodaj ponownie
+        to_embed.append(doc)
+    stale_ids.extend(node_id for node_id in existing if node_id not in new_ids)
+    return to_embed, stale_ids, kept
+
+
+def _iter_changed_documents(chroma_collection, changed_files: List[str], file_hashes: Dict[str, str],
+                            known_hashes: Dict[str, str], incremental: bool, stats: Dict[str, int],
+                            dedup_plan: Dict[str, Dict[str, Optional[str]]]) -> Iterator[Document]:
+    """
+    Dla każdego zmienionego pliku usuwa nieaktualne węzły i zwraca dokumenty do (ponownego) embedowania.
+    Aktualizuje `known_hashes` oraz liczniki w `stats`.
+    """
+    for filename in changed_files:
+        existing = _existing_doc_hashes(chroma_collection, filename) if incremental else {}
+        diff = _diff_file_documents(filename, existing, dedup_plan.get(filename))
+        if diff is None:
+            # Uszkodzony plik - zostawiamy stare węzły, spróbujemy przy następnym przebiegu
             continue
 
-    return llama_documents
+        to_embed, stale_ids, kept = diff
+        stats["kept"] += kept
+        if stale_ids:
+            chroma_collection.delete(ids=stale_ids)
+            stats["deleted"] += len(stale_ids)
+        known_hashes[filename] = file_hashes[filename]
+
+        yield from to_embed
+
 
+# --- TRYB RÓWNOLEGŁY (wiele procesów CPU) ---
 
-def build_index():
-    # 0. Safety Clean
-    if os.path.exists(DB_DIRECTORY):
+# Stan procesu roboczego: każdy worker ma własną instancję modelu embeddingów
+_worker_state: Dict[str, Any] = {}
+
+
+def _init_worker(torch_threads: int, batch_size: int):
+    torch.set_num_threads(torch_threads)
+    _worker_state["embed_model"] = HuggingFaceEmbedding(
+        model_name=EMBED_MODEL_NAME,
+        device="cpu",
+        embed_batch_size=batch_size
+    )
+    _worker_state["llm_tokenizer"] = AutoTokenizer.from_pretrained(LLM_TOKENIZER_NAME)
+    _worker_state["batch_size"] = batch_size
+
+
+def _process_file_in_worker(task):
+    """
+    Parsuje i embeduje jeden plik w procesie roboczym. Zapis do ChromaDB robi wyłącznie proces główny.
+    """
+    filename, existing, file_plan = task
+    diff = _diff_file_documents(filename, existing, file_plan)
+    if diff is None:
+        return filename, None, [], 0
+
+    to_embed, stale_ids, kept = diff
+    batch_size = _worker_state["batch_size"]
+    nodes = []
+    for start in range(0, len(to_embed), batch_size):
+        nodes.extend(_embed_nodes(
+            to_embed[start:start + batch_size],
+            _worker_state["embed_model"],
+            _worker_state["llm_tokenizer"],
+        ))
+    return filename, nodes, stale_ids, kept
+
+
+def _build_parallel(chroma_collection, vector_store, changed_files: List[str], file_hashes: Dict[str, str],
+                    known_hashes: Dict[str, str], incremental: bool, stats: Dict[str, int],
+                    dedup_plan: Dict[str, Dict[str, Optional[str]]], workers: int, batch_size: int) -> int:
+    """
+    Rozdziela pliki między pulę procesów (każdy z własnym modelem na CPU) i scala
+    wyniki w jednej kolekcji. Deterministyczne ID sprawiają, że kolejność nie ma znaczenia.
+    """
+    torch_threads = max(1, (os.cpu_count() or 1) // workers)
+    print(f"Tryb równoległy: {workers} procesów x {torch_threads} wątków torch (CPU).")
+
+    # Stan bazy pobieramy z góry - ChromaDB dotyka tylko proces główny
+    tasks = [
+        (filename, _existing_doc_hashes(chroma_collection, filename) if incremental else {},
+         dedup_plan.get(filename))
+        for filename in changed_files
+    ]
+
+    total = 0
+    started = time.perf_counter()
+    ctx = multiprocessing.get_context("spawn")
+    with ctx.Pool(workers, initializer=_init_worker, initargs=(torch_threads, batch_size)) as pool, \
+            tqdm(total=len(tasks), desc="Pliki", unit="plik") as pbar:
+        for filename, nodes, stale_ids, kept in pool.imap_unordered(_process_file_in_worker, tasks):
+            pbar.update(1)
+            if nodes is None:
+                continue
+
+            stats["kept"] += kept
+            if stale_ids:
+                chroma_collection.delete(ids=stale_ids)
+                stats["deleted"] += len(stale_ids)
+            for start in range(0, len(nodes), batch_size):
+                vector_store.add(nodes[start:start + batch_size])
+            known_hashes[filename] = file_hashes[filename]
+
+            total += len(nodes)
+            elapsed = time.perf_counter() - started
+            pbar.set_postfix(docs_per_s=f"{total / elapsed:.1f}")
+
+    elapsed = time.perf_counter() - started
+    if total:
+        print(f"Zapisano {total} węzłów w {elapsed:.1f} s ({total / elapsed:.1f} docs/s).")
+    return total
+
+
+def build_lore_catalog(chroma_collection) -> Dict[str, Any]:
+    """
+    Zbiera z metadanych kolekcji znane postacie (character/speaker) i numery odcinków.
+    `episode_flags` mówi routerowi, że węzły mają flagi odcinków (starsze indeksy ich nie mają).
+    """
+    characters = set()
+    episodes = set()
+    for page in iter_collection(chroma_collection, include=["metadatas"]):
+        for meta in page["metadatas"]:
+            meta = meta or {}
+            for key in ("character", "speaker"):
+                name = meta.get(key)
+                if name and name != "Unknown":
+                    characters.add(name)
+            if meta.get("episode_id") not in (None, "Unknown"):
+                episodes.add(meta["episode_id"])
+
+    return {"characters": sorted(characters), "episodes": sorted(episodes), "episode_flags": True}
+
+
+def build_index(incremental: bool = False, batch_size: int = EMBED_BATCH_SIZE, workers: int = 1,
+                quantize: Optional[str] = None, dedup: bool = True):
+    build_started = time.perf_counter()
+    manifest = _load_manifest() if incremental else {}
+    if incremental and manifest.get("embed_model") not in (None, EMBED_MODEL_NAME):
+        print(f"Model embeddingów zmienił się ({manifest.get('embed_model')} -> {EMBED_MODEL_NAME}). "
+              f"Wymuszam pełną przebudowę.")
+        incremental = False
+        manifest = {}
+
+    # llm_token_count/sentence_splits nie wchodzą do doc_hash - bez przebudowy zostałyby z poprzedniego tokenizera
+    if incremental and manifest.get("llm_tokenizer") not in (None, LLM_TOKENIZER_NAME):
+        print(f"Tokenizer LLM zmienił się ({manifest.get('llm_tokenizer')} -> {LLM_TOKENIZER_NAME}). "
+              f"Wymuszam pełną przebudowę.")
+        incremental = False
+        manifest = {}
+
+    if incremental and manifest.get("node_metadata_version", 1) != NODE_METADATA_VERSION:
+        print(f"Układ metadanych węzłów zmienił się (wersja {manifest.get('node_metadata_version', 1)} -> "
+              f"{NODE_METADATA_VERSION}). Wymuszam pełną przebudowę.")
+        incremental = False
+        manifest = {}
+
+    # Metryki, M i construction_ef nie da się zmienić w istniejącej kolekcji
+    hnsw = hnsw_metadata()
+    if incremental and hnsw_structure(manifest.get("hnsw")) != hnsw_structure(hnsw):
+        print(f"Parametry HNSW zmieniły się ({hnsw_structure(manifest.get('hnsw'))} -> {hnsw_structure(hnsw)}). "
+              f"Wymuszam pełną przebudowę.")
+        incremental = False
+        manifest = {}
+
+    # Skwantyzowane kopie wektorów odświeżamy, jeśli o nie poproszono albo już istnieją
+    if quantize is None and os.path.exists(QUANTIZED_DIR):
+        quantize = QuantizedIndex.load(QUANTIZED_DIR).mode
+
+    # 0. Safety Clean (tylko w trybie pełnym)
+    if not incremental and os.path.exists(DB_DIRECTORY):
         print(f"Czyszczenie starego indeksu w '{DB_DIRECTORY}'...")
         try:
             shutil.rmtree(DB_DIRECTORY)
@@ -168,45 +709,130 @@ def build_index():
         print(f"BŁĄD KRYTYCZNY: Nie znaleziono folderu {INPUT_DIR}.")
         sys.exit(1)
 
-    # 1. Device Selection
-    device = get_optimal_device()
-    print(f"Wybrane urządzenie obliczeniowe: {device.upper()}")
-
-    # 2. Load Embeddings
-    print(f"Ładowanie modelu embeddingów: {EMBED_MODEL_NAME}...")
-    embed_model = HuggingFaceEmbedding(
-        model_name=EMBED_MODEL_NAME,
-        device=device
-    )
-
-    # 3. Prepare ChromaDB
+    # 1. Prepare ChromaDB
     print("Inicjalizacja ChromaDB...")
     db = chromadb.PersistentClient(path=DB_DIRECTORY)
-    chroma_collection = db.get_or_create_collection("bomba_lore")
+    chroma_collection = db.get_or_create_collection(COLLECTION_NAME, metadata=hnsw)
+    if incremental:
+        # Istniejąca kolekcja: search_ef jest jedynym parametrem, który może się zmienić
+        set_search_ef(chroma_collection, hnsw["hnsw:search_ef"])
+    print(f"HNSW: metryka {hnsw['hnsw:space']}, M = {hnsw['hnsw:M']}, "
+          f"construction_ef = {hnsw['hnsw:construction_ef']}, search_ef = {hnsw['hnsw:search_ef']}")
     vector_store = ChromaVectorStore(chroma_collection=chroma_collection)
-    storage_context = StorageContext.from_defaults(vector_store=vector_store)
 
-    # 4. Load & Process Data
-    documents = load_documents_from_json(INPUT_DIR)
-
-    if not documents:
+    # 2. Diff plików źródłowych względem manifestu
+    files = list_source_files(INPUT_DIR)
+    file_hashes = {filename: file_content_hash(os.path.join(INPUT_DIR, filename)) for filename in files}
+    known_hashes: Dict[str, str] = manifest.get("files", {})
+
+    # Deduplikacja wymaga widoku całego korpusu: nowy odcinek może zmienić reprezentanta
+    # w pliku, który sam się nie zmienił - taki plik też trafia do diffu.
+    # Odciski plików bez zmian pochodzą z manifestu - parsujemy tylko zmienione pliki
+    dedup_fingerprints: Dict[str, Dict[str, Any]] = manifest.get("dedup_fingerprints", {})
+    dedup_plan = plan_dedup(INPUT_DIR, files, file_hashes, dedup_fingerprints) if dedup else {}
+    signatures = {filename: dedup_signature(dedup_plan.get(filename)) for filename in files}
+    known_signatures: Dict[str, Optional[str]] = manifest.get("dedup_signatures", {})
+
+    removed_files = sorted(set(known_hashes) - set(file_hashes))
+    changed_files = [
+        f for f in files
+        if known_hashes.get(f) != file_hashes[f] or known_signatures.get(f) != signatures[f]
+    ]
+    print(f"Pliki: {len(files)} | zmienione/nowe: {len(changed_files)} | "
+          f"usunięte: {len(removed_files)} | bez zmian: {len(files) - len(changed_files)}")
+
+    for filename in removed_files:
+        chroma_collection.delete(where={"source_file": filename})
+        known_hashes.pop(filename, None)
+
+    # 3. Strumieniowy diff dokumentów + embedding tylko nowych/zmienionych
+    stats = {"kept": 0, "deleted": 0}
+    embedded = 0
+    if changed_files and workers > 1:
+        embedded = _build_parallel(
+            chroma_collection, vector_store, changed_files, file_hashes, known_hashes,
+            incremental, stats, dedup_plan, workers, batch_size
+        )
+    elif changed_files:
+        device = get_optimal_device()
+        print(f"Wybrane urządzenie obliczeniowe: {device.upper()}")
+
+        print(f"Ładowanie modelu embeddingów: {EMBED_MODEL_NAME}...")
+        embed_model = HuggingFaceEmbedding(
+            model_name=EMBED_MODEL_NAME,
+            device=device,
+            embed_batch_size=batch_size
+        )
+
+        print(f"Ładowanie tokenizera LLM: {LLM_TOKENIZER_NAME}...")
+        llm_tokenizer = AutoTokenizer.from_pretrained(LLM_TOKENIZER_NAME)
+
+        print(f"Budowanie indeksu wektorowego (paczki po {batch_size} dokumentów)...")
+        documents = _iter_changed_documents(
+            chroma_collection, changed_files, file_hashes, known_hashes, incremental, stats, dedup_plan
+        )
+        embedded = embed_and_store(documents, embed_model, llm_tokenizer, vector_store, batch_size)
+
+    print(f"Węzły: zaembedowane {embedded} | usunięte/zmienione {stats['deleted']} | "
+          f"bez zmian {stats['kept']}")
+
+    if not incremental and not embedded:
         print("Nie znaleziono żadnych poprawnych dokumentów do zaindeksowania.")
         return
 
-    print(f"Wygenerowano {len(documents)} semantycznych fragmentów (chunks).")
-
-    # 5. Indexing
-    print("Budowanie indeksu wektorowego...")
-    index = VectorStoreIndex.from_documents(
-        documents,
-        storage_context=storage_context,
-        embed_model=embed_model,
-        show_progress=True
-    )
+    # 4. Indeks BM25 budujemy zawsze z aktualnej zawartości kolekcji (tani - bez embeddingów)
+    print("Budowanie indeksu BM25...")
+    bm25 = BM25Index.build_from_collection(chroma_collection)
+    bm25.save(BM25_INDEX_FILE)
+    print(f"Indeks BM25: {len(bm25)} węzłów, {len(bm25.postings)} termów "
+          f"({os.path.getsize(BM25_INDEX_FILE) / 1024:.0f} KiB) -> {BM25_INDEX_FILE}")
+
+    if quantize:
+        quantized = QuantizedIndex.build_from_collection(chroma_collection, quantize, QUANTIZED_DIR)
+        print(f"Kody {quantize}: {quantized.nbytes / 2**20:.1f} MiB -> {QUANTIZED_DIR}")
+
+    catalog = build_lore_catalog(chroma_collection)
+    with open(LORE_CATALOG_FILE, 'w', encoding='utf-8') as f:
+        json.dump(catalog, f, ensure_ascii=False, indent=2)
+    print(f"Katalog lore: {len(catalog['characters'])} postaci, {len(catalog['episodes'])} odcinków.")
+
+    _save_manifest({
+        "embed_model": EMBED_MODEL_NAME,
+        "llm_tokenizer": LLM_TOKENIZER_NAME,
+        "node_metadata_version": NODE_METADATA_VERSION,
+        "hnsw": hnsw,
+        # Hash treści kolekcji - rag_retrieval.py sprawdza nim aktualność skwantyzowanych kodów
+        "content_hash": collection_content_hash(chroma_collection),
+        "files": known_hashes,
+        # Podpis planu tylko dla plików przetworzonych poprawnie (uszkodzone spróbujemy ponownie)
+        "dedup_signatures": {f: signatures[f] for f in known_hashes if signatures.get(f)},
+        "dedup_fingerprints": dedup_fingerprints if dedup else {},
+        # Czas ostatniej budowy (raportowany przez benchmark_retrieval.py)
+        "last_build": {
+            "seconds": round(time.perf_counter() - build_started, 2),
+            "incremental": incremental,
+            "embedded": embedded,
+            "finished_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        },
+    })
 
     print("\n--- SUKCES ---")
-    print(f"Baza wiedzy została zapisana w: {DB_DIRECTORY}")
+    print(f"Baza wiedzy została zapisana w: {DB_DIRECTORY} ({chroma_collection.count()} węzłów)")
 
 
 if __name__ == "__main__":
-    build_index()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Budowa indeksu RAG (ChromaDB) z plików lore_extracted/.")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Zaktualizuj istniejącą kolekcję zamiast budować ją od zera.")
+    parser.add_argument("--batch-size", type=int, default=EMBED_BATCH_SIZE,
+                        help="Ile dokumentów embedować i zapisywać naraz (ogranicza szczytowe zużycie RAM).")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Liczba procesów budujących indeks równolegle na CPU (1 = tryb jednoprocesowy).")
+    parser.add_argument("--quantize", choices=QUANTIZATION_MODES,
+                        help="Zapisz też skwantyzowane kopie wektorów (int8/binary) do pierwszego przejścia wyszukiwania.")
+    parser.add_argument("--no-dedup", action="store_true",
+                        help="Nie scalaj prawie identycznych cytatów i faktów z różnych odcinków.")
+    args = parser.parse_args()
+
+    build_index(incremental=args.incremental, batch_size=args.batch_size, workers=args.workers,
+                quantize=args.quantize, dedup=not args.no_dedup)
@@ -1,55 +1,36 @@
-import torch
-from unsloth import FastLanguageModel
-import chromadb
-from llama_index.core import VectorStoreIndex, QueryBundle
-from llama_index.vector_stores.chroma import ChromaVectorStore
-from llama_index.embeddings.huggingface import HuggingFaceEmbedding
-from llama_index.core.retrievers import VectorIndexRetriever
+import json
+import os
 import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from functools import lru_cache
+from typing import Callable, Dict, Iterator, List, Optional
+
+# Ciężkie importy (unsloth, torch, transformers, llama_index, chromadb) są odroczone do funkcji
+# ładujących - startup() wykonuje je równolegle i mierzy każdą fazę.
 
 # --- 1. Konfiguracja ---
 MODEL_DO_ZALADOWANIA = "./lora_adapter"
-DB_DIRECTORY = "./chroma_db"
-EMBED_MODEL_NAME = "sdadas/mmlw-retrieval-roberta-large"
-SIMILARITY_TOP_K = 3
-
-print("--- 🚀 Startowanie Bota Bomby (Tryb Debugowania) ---")
-print("To może potrwać kilka minut, model musi załadować się do VRAM.")
-
-# --- 2. Ładowanie modelu LoRA (na GPU) ---
-print(f"Ładowanie modelu i adaptera z: {MODEL_DO_ZALADOWANIA}")
-model, tokenizer = FastLanguageModel.from_pretrained(
-    model_name = MODEL_DO_ZALADOWANIA,
-    max_seq_length = 2048,
-    dtype = None,
-    load_in_4bit = True,
-)
-print("✅ Model i adapter LoRA załadowane na GPU.")
-
-# --- 3. Ładowanie bazy RAG (na CPU) ---
-print(f"Ładowanie bazy wektorowej RAG z: {DB_DIRECTORY}")
-db = chromadb.PersistentClient(path=DB_DIRECTORY)
-chroma_collection = db.get_collection("bomba_lore")
-vector_store = ChromaVectorStore(chroma_collection=chroma_collection)
-
-print(f"Ładowanie modelu embeddingów (na CPU): {EMBED_MODEL_NAME}")
-embed_model = HuggingFaceEmbedding(model_name=EMBED_MODEL_NAME, device="cpu")
-
-index = VectorStoreIndex.from_vector_store(
-    vector_store,
-    embed_model=embed_model,
-)
-
-print(f"Inicjalizacja retrievera RAG z top_k = {SIMILARITY_TOP_K}")
-retriever = VectorIndexRetriever(
-    index=index,
-    similarity_top_k=SIMILARITY_TOP_K,
-    embed_model=embed_model,
-)
-print("✅ Baza RAG gotowa.")
-
-# --- 4. Formatka Promptu ---
-prompt_template = """<s>### Instrukcja:
+# Tryb awaryjny: sam BM25, bez ładowania modelu embeddingów
+RAG_LEXICAL_ONLY = os.getenv("RAG_LEXICAL_ONLY", "0") == "1"
+# Zapytanie próbne po starcie: ładuje segment HNSW, rozgrzewa embeddingi i kernele CUDA
+CHAT_WARMUP = os.getenv("CHAT_WARMUP", "1") == "1"
+WARMUP_QUESTION = "Kim jest Kapitan Bomba?"
+WARMUP_NEW_TOKENS = 8
+
+MAX_MODEL_TOKENS = 2048
+RESERVED_FOR_PROMPT_AND_GEN = 512
+# Krótszych resztek nie opłaca się doklejać do kontekstu
+MIN_PARTIAL_CONTEXT_TOKENS = 20
+MAX_NEW_TOKENS = 256
+TEMPERATURE = 0.7
+TOP_P = 0.9
+
+# --- Formatka Promptu ---
+PROMPT_TEMPLATE = """<s>### Instrukcja:
 Na podstawie poniższego kontekstu, odpowiedz na pytanie.
 Użyj wulgarnego i bezpośredniego stylu Kapitana Bomby.
 
@@ -62,75 +43,416 @@ Pytanie:
 ### Odpowiedź:
 """
 
-# --- 5. Pętla Czat-bota ---
-print("\n--- ✅ Bot gotowy. Zadaj pytanie. Wpisz 'wyjscie' aby zakończyć. ---")
 
-while True:
-    try:
-        pytanie_uzytkownika = input("\nTy: ")
-        if pytanie_uzytkownika.lower() in ["wyjscie", "exit", "quit", "koniec"]:
-            print("--- 🛑 Zamykanie bota. ---")
+def import_llm_stack():
+    """
+    Import unsloth (razem z torch). Musi nastąpić przed pierwszym importem transformers,
+    inaczej łatki unsloth nie zostaną nałożone.
+    """
+    from unsloth import FastLanguageModel
+    return FastLanguageModel
+
+
+def load_llm():
+    """
+    Ładuje model bazowy z adapterem LoRA (4-bit, na GPU) oraz jego tokenizer.
+    """
+    FastLanguageModel = import_llm_stack()
+    print(f"Ładowanie modelu i adaptera z: {MODEL_DO_ZALADOWANIA}")
+    model, tokenizer = FastLanguageModel.from_pretrained(
+        model_name = MODEL_DO_ZALADOWANIA,
+        max_seq_length = MAX_MODEL_TOKENS,
+        dtype = None,
+        load_in_4bit = True,
+    )
+    print("✅ Model i adapter LoRA załadowane na GPU.")
+    return model, tokenizer
+
+
+def load_retriever(**kwargs):
+    # rag_retrieval importuje transformers (przez llama_index) - dopiero po unsloth
+    from rag_retrieval import load_retriever as _load_retriever
+    return _load_retriever(**kwargs)
+
+
+def require_token_metadata(retriever):
+    """
+    Sprawdzane raz przy starcie: indeks musi mieć metadane tokenów z build_rag_index.py.
+    Liczenie ich w locie wymagałoby importu build_rag_index (torch, chromadb, llama_index)
+    na ścieżce zapytania.
+    """
+    sample = retriever.chroma_collection.get(limit=1, include=["metadatas"])
+    metadatas = sample["metadatas"] or []
+    if metadatas and "llm_token_count" not in (metadatas[0] or {}):
+        print("⚠️ Indeks RAG nie ma metadanych tokenów (starsza wersja build_rag_index.py).", file=sys.stderr)
+        raise RuntimeError("Przebuduj indeks: python build_rag_index.py")
+
+
+def _token_info(tokenizer, txt: str, metadata: dict):
+    """
+    Zwraca (liczba_tokenów, punkty_podziału) z metadanych węzła.
+    Węzeł bez zgodnych metadanych liczymy samym tokenizerem, bez punktów podziału.
+    """
+    if metadata.get("char_len") == len(txt) and "llm_token_count" in metadata:
+        return metadata["llm_token_count"], json.loads(metadata.get("sentence_splits", "[]"))
+    return len(tokenizer(txt, add_special_tokens=False)["input_ids"]), []
+
+
+def _token_char_end(tokenizer, txt: str, n_tokens: int) -> int:
+    """
+    Pozycja (w znakach) końca `n_tokens`-tego tokena - do twardego cięcia fragmentu.
+    """
+    offsets = tokenizer(txt, add_special_tokens=False, return_offsets_mapping=True)["offset_mapping"]
+    if not offsets or n_tokens <= 0:
+        return 0
+    return offsets[min(n_tokens, len(offsets)) - 1][1]
+
+
+def pack_context(fragments, allowed_context_tokens: int,
+                 hard_cut: Optional[Callable[[str, int], int]] = None) -> str:
+    """
+    Pakuje fragmenty (tekst, liczba_tokenów, punkty_podziału) do budżetu tokenów.
+    Czysta arytmetyka - ostatni fragment jest przycinany na granicy zdania. Jeśli nawet
+    pierwsze zdanie się nie mieści, `hard_cut(tekst, n_tokenów)` wskazuje cięcie na granicy tokena.
+    """
+    kontekst_rag = ""
+    current_tokens = 0
+    for txt, tlen, splits in fragments:
+        if current_tokens + tlen <= allowed_context_tokens:
+            kontekst_rag += txt + "\n\n"
+            current_tokens += tlen
+        else:
+            remaining = allowed_context_tokens - current_tokens
+            if remaining > MIN_PARTIAL_CONTEXT_TOKENS:
+                cut = max((char_end for char_end, n_tokens in splits if n_tokens <= remaining), default=0)
+                if not cut and hard_cut is not None:
+                    cut = hard_cut(txt, remaining)
+                if cut:
+                    kontekst_rag += txt[:cut] + "\n\n"
             break
 
-        # Krok A: Znajdź kontekst w bazie RAG
-        print("...myślę (szukam w bazie RAG)...")
-        wyniki_retrievera = retriever.retrieve(pytanie_uzytkownika)
-        retrieved_texts = [wynik.get_text() for wynik in wyniki_retrievera]
-
-        max_model_tokens = 2048
-        reserved_for_prompt_and_gen = 512
-        allowed_context_tokens = max_model_tokens - reserved_for_prompt_and_gen
-
-        kontekst_rag = ""
-        current_tokens = 0
-        for txt in retrieved_texts:
-            token_ids = tokenizer.encode(txt, add_special_tokens=False)
-            tlen = len(token_ids)
-            if current_tokens + tlen <= allowed_context_tokens:
-                kontekst_rag += txt + "\n\n"
-                current_tokens += tlen
-            else:
-                remaining = allowed_context_tokens - current_tokens
-                if remaining > 20:
-                    toks = token_ids[:remaining]
-                    part_text = tokenizer.decode(toks, skip_special_tokens=True)
-                    kontekst_rag += part_text + "\n\n"
-                break
+    return kontekst_rag
 
 
-        # Krok B: Zbuduj pełny prompt
-        finalny_prompt = prompt_template.format(
-            kontekst=kontekst_rag,
-            pytanie=pytanie_uzytkownika
-        )
+def build_context(retriever, tokenizer, pytanie: str) -> str:
+    """
+    Pobiera fragmenty z bazy RAG i przycina je do budżetu tokenów kontekstu.
+    """
+    wyniki_retrievera = retriever.retrieve(pytanie)
+
+    fragments = []
+    for wynik in wyniki_retrievera:
+        txt = wynik.get_text()
+        tlen, splits = _token_info(tokenizer, txt, wynik.node.metadata)
+        fragments.append((txt, tlen, splits))
+
+    return pack_context(
+        fragments, MAX_MODEL_TOKENS - RESERVED_FOR_PROMPT_AND_GEN,
+        hard_cut=lambda txt, n_tokens: _token_char_end(tokenizer, txt, n_tokens),
+    )
 
-        # Krok C: Wygeneruj odpowiedź za pomocą modelu LoRA
-        print("...myślę (generuję odpowiedź LoRA)...")
 
-        # Teraz tokenizujemy finalny prompt - mamy gwarancję, że jest < 2048
-        inputs = tokenizer([finalny_prompt], return_tensors="pt").to("cuda")
+def build_prompt(kontekst: str, pytanie: str) -> str:
+    return PROMPT_TEMPLATE.format(kontekst=kontekst, pytanie=pytanie)
 
-        outputs = model.generate(
-            **inputs,
-            max_new_tokens=256,
-            do_sample=True,
-            temperature=0.7,
-            top_p=0.9,
-            pad_token_id=tokenizer.eos_token_id
+
+@dataclass
+class GenerationStats:
+    """
+    Metryki opóźnień jednej odpowiedzi (czasy w sekundach).
+    """
+    prompt_tokens: int = 0
+    started_at: float = 0.0
+    token_times: List[float] = field(default_factory=list)
+
+    @property
+    def completion_tokens(self) -> int:
+        return len(self.token_times)
+
+    @property
+    def time_to_first_token(self) -> Optional[float]:
+        if not self.token_times:
+            return None
+        return self.token_times[0] - self.started_at
+
+    @property
+    def inter_token_latencies(self) -> List[float]:
+        return [b - a for a, b in zip(self.token_times, self.token_times[1:])]
+
+    @property
+    def mean_inter_token_latency(self) -> Optional[float]:
+        gaps = self.inter_token_latencies
+        return sum(gaps) / len(gaps) if gaps else None
+
+    def summary(self) -> str:
+        if not self.token_times:
+            return "brak wygenerowanych tokenów"
+        total = self.token_times[-1] - self.started_at
+        itl = self.mean_inter_token_latency
+        itl_text = f"{itl * 1000:.1f} ms" if itl is not None else "n/d"
+        return (
+            f"TTFT: {self.time_to_first_token * 1000:.0f} ms | "
+            f"ITL (średnio): {itl_text} | "
+            f"tokeny: {self.completion_tokens} | "
+            f"{self.completion_tokens / total:.1f} tok/s"
         )
 
-        # Krok D: Zdekoduj i wydrukuj odpowiedź
-        odpowiedz = tokenizer.decode(outputs[0], skip_special_tokens=True)
 
+@lru_cache(maxsize=None)
+def _timed_streamer_class():
+    # Klasa tworzona przy pierwszym użyciu, żeby import chat.py nie ciągnął transformers
+    from transformers import TextIteratorStreamer
+
+    class _TimedStreamer(TextIteratorStreamer):
+        """
+        Streamer, który pomija prompt, dekoduje przyrostowo tylko nowe tokeny
+        i zapisuje moment pojawienia się każdego z nich.
+        """
+
+        def __init__(self, tokenizer, stats: GenerationStats, **kwargs):
+            super().__init__(tokenizer, skip_prompt=True, skip_special_tokens=True, **kwargs)
+            self.stats = stats
+
+        def put(self, value):
+            if not self.next_tokens_are_prompt:
+                now = time.perf_counter()
+                self.stats.token_times.extend([now] * value.numel())
+            super().put(value)
+
+    return _TimedStreamer
+
+
+@lru_cache(maxsize=None)
+def _event_stopping_criteria_class():
+    # Jak wyżej - transformers (i torch) importowane dopiero przy pierwszym użyciu
+    import torch
+    from transformers import StoppingCriteria
+
+    class _EventStoppingCriteria(StoppingCriteria):
+        """
+        Przerywa model.generate po ustawieniu zdarzenia - np. gdy konsument strumienia
+        przestał czytać i nie ma sensu generować reszty odpowiedzi.
+        """
+
+        def __init__(self, event: threading.Event):
+            self.event = event
+
+        def __call__(self, input_ids, scores, **kwargs):
+            return torch.full((input_ids.shape[0],), self.event.is_set(), dtype=torch.bool, device=input_ids.device)
+
+    return _EventStoppingCriteria
+
+
+def stream_answer(model, tokenizer, finalny_prompt: str,
+                  stats: Optional[GenerationStats] = None) -> Iterator[str]:
+    """
+    Generator zwracający kolejne fragmenty odpowiedzi w miarę ich powstawania.
+    Jeśli podano `stats`, zostaną w nim zapisane TTFT i opóźnienia między tokenami.
+    """
+    if stats is None:
+        stats = GenerationStats()
+
+    # Teraz tokenizujemy finalny prompt - mamy gwarancję, że jest < 2048
+    inputs = tokenizer([finalny_prompt], return_tensors="pt").to(model.device)
+    stats.prompt_tokens = inputs["input_ids"].shape[1]
+    stats.started_at = time.perf_counter()
+
+    streamer = _timed_streamer_class()(tokenizer, stats)
+    # Ustawiane w `finally` - przerwana pętla konsumenta zatrzymuje generowanie po bieżącym tokenie
+    stop_generation = threading.Event()
+    from transformers import StoppingCriteriaList
+    generation_kwargs = dict(
+        **inputs,
+        streamer=streamer,
+        stopping_criteria=StoppingCriteriaList([_event_stopping_criteria_class()(stop_generation)]),
+        max_new_tokens=MAX_NEW_TOKENS,
+        do_sample=True,
+        temperature=TEMPERATURE,
+        top_p=TOP_P,
+        pad_token_id=tokenizer.eos_token_id
+    )
+
+    # model.generate blokuje, więc puszczamy go w tle i czytamy streamer
+    errors: List[BaseException] = []
+
+    def generate():
+        try:
+            model.generate(**generation_kwargs)
+        except BaseException as e:
+            # Bez end() konsument czekałby na kolejce streamera w nieskończoność
+            errors.append(e)
+            streamer.end()
+
+    thread = threading.Thread(target=generate, daemon=True)
+    thread.start()
+    try:
+        for fragment in streamer:
+            if fragment:
+                yield fragment
+    finally:
+        # Bez tego join() czekałby, aż model wygeneruje wszystkie MAX_NEW_TOKENS
+        stop_generation.set()
+        thread.join()
+    # Błąd z wątku (np. CUDA OOM) trafia do wywołującego jak przy zwykłym wywołaniu
+    if errors:
+        raise errors[0]
+
+
+def generate_answer(model, tokenizer, finalny_prompt: str,
+                    stats: Optional[GenerationStats] = None) -> str:
+    """
+    Wersja nie-strumieniowa: zwraca całą odpowiedź (bez powtórzonego promptu).
+    """
+    return "".join(stream_answer(model, tokenizer, finalny_prompt, stats)).strip()
+
+
+# --- Start (równoległe ładowanie + rozgrzewka) ---
+
+# Nazwy etapów z retriever.load_timings w raporcie startu
+RETRIEVER_LOAD_PHASES = {
+    "stores_s": "  retriever: Chroma + BM25 + router",
+    "embed_model_s": "  retriever: model embeddingów",
+    "reranker_s": "  retriever: reranker",
+}
+
+
+@contextmanager
+def _timed_phase(timings: Dict[str, float], name: str):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[name] = time.perf_counter() - started
+
+
+def load_components(timings: Dict[str, float]):
+    """
+    Ładuje LLM (GPU) i retriever (Chroma, BM25, embeddingi na CPU) równolegle.
+    Jedyna sekwencja to import unsloth przed importem rag_retrieval - reszta się nakłada.
+    """
+    unsloth_imported = threading.Event()
+
+    def llm_job():
         try:
-            tylko_odpowiedz = odpowiedz.split("### Odpowiedź:")[1].strip()
-            print(f"\nBomba: {tylko_odpowiedz}")
-        except IndexError:
-            print(f"\nBomba (błąd dekodowania): {odpowiedz}")
+            with _timed_phase(timings, "import unsloth + torch"):
+                import_llm_stack()
+        finally:
+            unsloth_imported.set()
+        with _timed_phase(timings, "LLM + adapter LoRA"):
+            return load_llm()
+
+    def retriever_job():
+        unsloth_imported.wait()
+        with _timed_phase(timings, "import rag_retrieval"):
+            import rag_retrieval  # noqa: F401
+        with _timed_phase(timings, "retriever"):
+            retriever = load_retriever(use_embeddings=not RAG_LEXICAL_ONLY)
+        require_token_metadata(retriever)
+        for key, seconds in retriever.load_timings.items():
+            timings[RETRIEVER_LOAD_PHASES.get(key, key)] = seconds
+        return retriever
+
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        llm_future = pool.submit(llm_job)
+        retriever_future = pool.submit(retriever_job)
+        model, tokenizer = llm_future.result()
+        retriever = retriever_future.result()
+    return model, tokenizer, retriever
+
+
+def warm_up(model, tokenizer, retriever, timings: Dict[str, float]):
+    """
+    Zapytanie próbne przed pierwszym użytkownikiem: otwiera segment HNSW, wykonuje pierwszy
+    forward modelu embeddingów (i rerankera) oraz kompiluje kernele CUDA krótkim generowaniem.
+    Ścieżka RAG (CPU) i LLM (GPU) rozgrzewają się równolegle.
+    """
+    def retrieval_job():
+        with _timed_phase(timings, "rozgrzewka RAG"):
+            if retriever.reranker is not None:
+                # Bezpośrednio przez model - zimny pierwszy przebieg nie trafia do średniej opóźnień
+                retriever.reranker.model.predict([(WARMUP_QUESTION, WARMUP_QUESTION)], show_progress_bar=False)
+            # Bez tokenizera LLM - ten sam obiekt tokenizuje równolegle w llm_job
+            retriever.retrieve(WARMUP_QUESTION)
+
+    def llm_job():
+        with _timed_phase(timings, "rozgrzewka LLM"):
+            inputs = tokenizer([build_prompt("", WARMUP_QUESTION)], return_tensors="pt").to(model.device)
+            model.generate(**inputs, max_new_tokens=WARMUP_NEW_TOKENS, do_sample=False,
+                           pad_token_id=tokenizer.eos_token_id)
+
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        for future in [pool.submit(retrieval_job), pool.submit(llm_job)]:
+            future.result()
+
+
+def print_startup_report(timings: Dict[str, float], total_seconds: float):
+    print("\n--- ⏱️ Czas startu (fazy równoległe nakładają się) ---")
+    for phase, seconds in timings.items():
+        print(f"{phase:<40} {seconds:7.1f} s")
+    print(f"{'RAZEM (czas rzeczywisty)':<40} {total_seconds:7.1f} s")
+
+
+def startup(warmup: bool = CHAT_WARMUP):
+    """
+    Pełny start: równoległe ładowanie, opcjonalna rozgrzewka i raport czasów.
+    Zwraca (model, tokenizer, retriever).
+    """
+    started = time.perf_counter()
+    timings: Dict[str, float] = {}
+    model, tokenizer, retriever = load_components(timings)
+    if warmup:
+        warm_up(model, tokenizer, retriever, timings)
+    print_startup_report(timings, time.perf_counter() - started)
+    return model, tokenizer, retriever
+
+
+def chat_loop(model, tokenizer, retriever):
+    print("\n--- ✅ Bot gotowy. Zadaj pytanie. Wpisz 'wyjscie' aby zakończyć. ---")
+
+    while True:
+        try:
+            pytanie_uzytkownika = input("\nTy: ")
+            if pytanie_uzytkownika.lower() in ["wyjscie", "exit", "quit", "koniec"]:
+                print("--- 🛑 Zamykanie bota. ---")
+                break
+
+            # Krok A: Znajdź kontekst w bazie RAG
+            print("...myślę (szukam w bazie RAG)...")
+            kontekst_rag = build_context(retriever, tokenizer, pytanie_uzytkownika)
+            route = getattr(retriever, "last_route", None)
+            if route is not None:
+                print(f"...routing zapytania: {route.label} | reranking: {retriever.last_rerank}...")
+
+            # Krok B: Zbuduj pełny prompt
+            finalny_prompt = build_prompt(kontekst_rag, pytanie_uzytkownika)
+
+            # Krok C: Wygeneruj odpowiedź za pomocą modelu LoRA
+            print("...myślę (generuję odpowiedź LoRA)...")
+
+            # Krok D: Wypisuj odpowiedź token po tokenie
+            stats = GenerationStats()
+            print("\nBomba: ", end="", flush=True)
+            poczatek = True
+            for fragment in stream_answer(model, tokenizer, finalny_prompt, stats):
+                if poczatek:
+                    fragment = fragment.lstrip()
+                    if not fragment:
+                        continue
+                    poczatek = False
+                print(fragment, end="", flush=True)
+            print(f"\n[{stats.summary()}]")
+
+        except KeyboardInterrupt:
+            print("\n--- 🛑 Przerywanie. Wpisz 'wyjscie' aby zakończyć. ---")
+        except Exception as e:
+            print(f"Wystąpił błąd: {e}", file=sys.stderr)
+
+    print("Do widzenia, tępy chuju.")
+
 
-    except KeyboardInterrupt:
-        print("\n--- 🛑 Przerywanie. Wpisz 'wyjscie' aby zakończyć. ---")
-    except Exception as e:
-        print(f"Wystąpił błąd: {e}", file=sys.stderr)
+if __name__ == "__main__":
+    print("--- 🚀 Startowanie Bota Bomby (Tryb Debugowania) ---")
+    print("Model LLM, baza RAG i embeddingi ładują się równolegle.")
 
-print("Do widzenia, tępy chuju.")
+    model, tokenizer, retriever = startup()
+    chat_loop(model, tokenizer, retriever)
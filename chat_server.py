@@ -0,0 +1,504 @@
+import json
+import os
+import queue
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List, Optional
+
+import torch
+
+import chat
+
+# --- KONFIGURACJA ---
+SERVER_HOST = os.getenv("CHAT_SERVER_HOST", "0.0.0.0")
+SERVER_PORT = int(os.getenv("CHAT_SERVER_PORT", "8000"))
+# Ile sekwencji może jednocześnie siedzieć w jednym batchu dekodowania.
+MAX_BATCH_SIZE = int(os.getenv("CHAT_MAX_BATCH_SIZE", "8"))
+REQUEST_TIMEOUT_S = float(os.getenv("CHAT_REQUEST_TIMEOUT_S", "300"))
+
+
+class GenerationRequest:
+    """
+    Pojedyncze zapytanie w kolejce silnika. Wątek HTTP czeka na `done`,
+    a pętla batchera dopisuje kolejne tokeny do `generated`.
+    """
+
+    def __init__(self, prompt_ids: List[int], max_new_tokens: int, temperature: float, top_p: float):
+        self.prompt_ids = prompt_ids
+        self.max_new_tokens = max_new_tokens
+        self.temperature = temperature
+        self.top_p = top_p
+        self.generated: List[int] = []
+        self.token_times: List[float] = []
+        self.done = threading.Event()
+        self.error: Optional[str] = None
+        # Ustawiane przez wątek HTTP po przekroczeniu czasu - silnik usuwa zapytanie z batcha
+        self.cancelled = False
+        self.submitted_at = time.perf_counter()
+        self.first_token_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+
+
+def _to_legacy_cache(past):
+    # Nowsze transformers zwracają obiekt Cache, starsze krotkę (k, v) per warstwa.
+    if hasattr(past, "to_legacy_cache"):
+        return past.to_legacy_cache()
+    return past
+
+
+def _from_legacy_cache(legacy, like):
+    if hasattr(like, "to_legacy_cache"):
+        from transformers import DynamicCache
+        return DynamicCache.from_legacy_cache(legacy)
+    return legacy
+
+
+def _sample(logits: torch.Tensor, temperatures: torch.Tensor, top_ps: torch.Tensor) -> torch.Tensor:
+    """
+    Próbkowanie temperatura + top-p z osobnymi parametrami dla każdego wiersza batcha.
+    Temperatura <= 0 oznacza dekodowanie zachłanne.
+    """
+    logits = logits.float()
+    greedy = logits.argmax(dim=-1)
+
+    scaled = logits / temperatures.clamp(min=1e-5).unsqueeze(-1)
+    probs = torch.softmax(scaled, dim=-1)
+    sorted_probs, sorted_idx = probs.sort(dim=-1, descending=True)
+    cumulative = sorted_probs.cumsum(dim=-1)
+    sorted_probs[(cumulative - sorted_probs) > top_ps.unsqueeze(-1)] = 0.0
+    choice = torch.multinomial(sorted_probs, num_samples=1)
+    sampled = sorted_idx.gather(-1, choice).squeeze(-1)
+
+    return torch.where(temperatures > 0, sampled, greedy)
+
+
+def _left_pad(tensor: torch.Tensor, target_len: int, dim: int = 2) -> torch.Tensor:
+    missing = target_len - tensor.shape[dim]
+    if missing <= 0:
+        return tensor
+    pad_shape = list(tensor.shape)
+    pad_shape[dim] = missing
+    return torch.cat([tensor.new_zeros(pad_shape), tensor], dim=dim)
+
+
+def _merge_cache(cache, mask: torch.Tensor, new_cache, new_mask: torch.Tensor):
+    """
+    Dokleja KV-cache nowej sekwencji do batcha: wyrównuje długości lewym paddingiem
+    i skleja po osi batcha. Cache to krotka (k, v) per warstwa, kształt [B, H, L, D].
+    """
+    target_len = max(mask.shape[1], new_mask.shape[1])
+    merged = tuple(
+        (
+            torch.cat([_left_pad(bk, target_len), _left_pad(k, target_len)], dim=0),
+            torch.cat([_left_pad(bv, target_len), _left_pad(v, target_len)], dim=0),
+        )
+        for (bk, bv), (k, v) in zip(cache, new_cache)
+    )
+    merged_mask = torch.cat([
+        _left_pad(mask, target_len, dim=1),
+        _left_pad(new_mask, target_len, dim=1),
+    ], dim=0)
+    return merged, merged_mask
+
+
+def _select_rows(cache, mask: torch.Tensor, index: torch.Tensor):
+    """
+    Zostawia w batchu wiersze `index` i przycina kolumny, w których każda pozostała
+    sekwencja ma tylko padding.
+    """
+    mask = mask.index_select(0, index)
+    real_columns = mask.sum(dim=0).nonzero()
+    first_real = int(real_columns[0].item()) if len(real_columns) else 0
+    cache = tuple(
+        (k.index_select(0, index)[:, :, first_real:], v.index_select(0, index)[:, :, first_real:])
+        for k, v in cache
+    )
+    return cache, mask[:, first_real:]
+
+
+class ContinuousBatcher:
+    """
+    Silnik generowania z ciągłym batchowaniem (iteration-level scheduling).
+
+    Każde nowe zapytanie przechodzi osobny prefill, po czym jego KV-cache jest
+    doklejany (z lewym paddingiem) do wspólnego batcha dekodowania. Sekwencje,
+    które skończyły, są usuwane z batcha po każdym kroku, więc nowe zapytanie
+    nie czeka, aż najdłuższa odpowiedź w batchu się zakończy.
+    """
+
+    def __init__(self, model, tokenizer, max_batch_size: int = MAX_BATCH_SIZE):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_batch_size = max_batch_size
+        self.device = model.device
+        self.eos_token_id = tokenizer.eos_token_id
+
+        self._pending: "queue.Queue[GenerationRequest]" = queue.Queue()
+        self._active: List[GenerationRequest] = []
+        self._cache = None          # krotka (k, v) per warstwa, kształt [B, H, L, D]
+        self._cache_like = None     # oryginalny typ cache zwrócony przez model
+        self._mask = None           # [B, L] - 0 dla lewego paddingu
+        self._positions = None      # [B] - pozycja następnego tokena
+        self._next_tokens = None    # [B] - ostatnio wylosowany token
+
+        self.generated_tokens_total = 0
+        self.started_at = time.perf_counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="continuous-batcher", daemon=True)
+
+    # --- API publiczne ---
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def submit(self, prompt: str, max_new_tokens: int = chat.MAX_NEW_TOKENS,
+               temperature: float = chat.TEMPERATURE, top_p: float = chat.TOP_P) -> GenerationRequest:
+        """
+        Kolejkuje zapytanie. Za długi prompt odrzuca (ValueError), a limit nowych tokenów
+        przycina do MAX_NEW_TOKENS i do miejsca w oknie kontekstu - jedna sekwencja
+        wychodząca poza okno wywróciłaby krok dekodowania całego batcha.
+        """
+        prompt_ids = self.tokenizer(prompt)["input_ids"]
+        room = chat.MAX_MODEL_TOKENS - len(prompt_ids)
+        if room <= 0:
+            raise ValueError(f"Prompt ma {len(prompt_ids)} tokenów - limit modelu to {chat.MAX_MODEL_TOKENS}.")
+        max_new_tokens = max(1, min(max_new_tokens, chat.MAX_NEW_TOKENS, room))
+        request = GenerationRequest(prompt_ids, max_new_tokens, temperature, top_p)
+        self._pending.put(request)
+        return request
+
+    def cancel(self, request: GenerationRequest):
+        # Wątek silnika usunie zapytanie przy najbliższym kroku (albo nie przyjmie go z kolejki)
+        request.cancelled = True
+
+    def stats(self) -> dict:
+        elapsed = time.perf_counter() - self.started_at
+        return {
+            "active": len(self._active),
+            "pending": self._pending.qsize(),
+            "max_batch_size": self.max_batch_size,
+            "generated_tokens_total": self.generated_tokens_total,
+            "tokens_per_s": round(self.generated_tokens_total / elapsed, 2) if elapsed > 0 else 0.0,
+        }
+
+    # --- Pętla silnika ---
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                if not self._active:
+                    # Pusty batch - czekamy blokująco na pierwsze zapytanie
+                    try:
+                        self._admit_safely(self._pending.get(timeout=0.5))
+                    except queue.Empty:
+                        continue
+
+                # Dołączamy oczekujące zapytania do trwającego batcha
+                while len(self._active) < self.max_batch_size:
+                    try:
+                        self._admit_safely(self._pending.get_nowait())
+                    except queue.Empty:
+                        break
+
+                if self._active:
+                    self._decode_step()
+            except Exception as e:
+                print(f"Błąd silnika generowania: {e}", file=sys.stderr)
+                self._fail_all(str(e))
+
+    def _fail_all(self, message: str):
+        for request in self._active:
+            self._finish(request, error=message)
+        self._active = []
+        self._cache = self._mask = self._positions = self._next_tokens = None
+
+    def _finish(self, request: GenerationRequest, error: Optional[str] = None):
+        request.error = error
+        request.finished_at = time.perf_counter()
+        request.done.set()
+
+    def _is_finished(self, request: GenerationRequest, token_id: int) -> bool:
+        return (request.cancelled or token_id == self.eos_token_id
+                or len(request.generated) >= request.max_new_tokens)
+
+    def _admit_safely(self, request: GenerationRequest):
+        if request.cancelled:
+            self._finish(request, error="Anulowano.")
+            return
+        # Błąd prefillu (np. za długi prompt) psuje tylko to jedno zapytanie
+        try:
+            self._admit(request)
+        except Exception as e:
+            print(f"Błąd prefillu zapytania: {e}", file=sys.stderr)
+            self._finish(request, error=str(e))
+
+    @torch.inference_mode()
+    def _admit(self, request: GenerationRequest):
+        """
+        Prefill pojedynczego zapytania i doklejenie jego KV-cache do batcha.
+        """
+        input_ids = torch.tensor([request.prompt_ids], device=self.device)
+        outputs = self.model(input_ids=input_ids, use_cache=True)
+
+        first_token = _sample(
+            outputs.logits[:, -1, :],
+            torch.tensor([request.temperature], device=self.device),
+            torch.tensor([request.top_p], device=self.device),
+        )
+        token_id = int(first_token.item())
+        request.first_token_at = time.perf_counter()
+        request.token_times.append(request.first_token_at)
+        request.generated.append(token_id)
+        self.generated_tokens_total += 1
+
+        if self._is_finished(request, token_id):
+            self._finish(request)
+            return
+
+        self._cache_like = outputs.past_key_values
+        cache = _to_legacy_cache(outputs.past_key_values)
+        prompt_len = input_ids.shape[1]
+        mask = torch.ones((1, prompt_len), dtype=torch.long, device=self.device)
+
+        if not self._active:
+            self._cache = cache
+            self._mask = mask
+            self._positions = torch.tensor([prompt_len], device=self.device)
+            self._next_tokens = first_token
+        else:
+            self._cache, self._mask = _merge_cache(self._cache, self._mask, cache, mask)
+            self._positions = torch.cat([self._positions, torch.tensor([prompt_len], device=self.device)])
+            self._next_tokens = torch.cat([self._next_tokens, first_token])
+
+        self._active.append(request)
+
+    @torch.inference_mode()
+    def _decode_step(self):
+        """
+        Jeden krok dekodowania dla wszystkich aktywnych sekwencji naraz.
+        """
+        batch_size = len(self._active)
+        attention_mask = torch.cat(
+            [self._mask, torch.ones((batch_size, 1), dtype=self._mask.dtype, device=self.device)], dim=1
+        )
+
+        outputs = self.model(
+            input_ids=self._next_tokens.unsqueeze(-1),
+            attention_mask=attention_mask,
+            position_ids=self._positions.unsqueeze(-1),
+            past_key_values=_from_legacy_cache(self._cache, self._cache_like),
+            use_cache=True,
+        )
+
+        temperatures = torch.tensor([r.temperature for r in self._active], device=self.device)
+        top_ps = torch.tensor([r.top_p for r in self._active], device=self.device)
+        next_tokens = _sample(outputs.logits[:, -1, :], temperatures, top_ps)
+
+        self._cache_like = outputs.past_key_values
+        self._cache = _to_legacy_cache(outputs.past_key_values)
+        self._mask = attention_mask
+        self._positions = self._positions + 1
+        self._next_tokens = next_tokens
+
+        keep = []
+        now = time.perf_counter()
+        for row, (request, token_id) in enumerate(zip(self._active, next_tokens.tolist())):
+            request.generated.append(token_id)
+            request.token_times.append(now)
+            self.generated_tokens_total += 1
+            if self._is_finished(request, token_id):
+                self._finish(request, error="Anulowano." if request.cancelled else None)
+            else:
+                keep.append(row)
+
+        if len(keep) < batch_size:
+            self._evict(keep)
+
+    def _evict(self, keep: List[int]):
+        """
+        Usuwa zakończone sekwencje z batcha i przycina kolumny samego paddingu.
+        """
+        if not keep:
+            self._active = []
+            self._cache = self._mask = self._positions = self._next_tokens = None
+            return
+
+        index = torch.tensor(keep, device=self.device)
+        self._active = [self._active[i] for i in keep]
+        self._positions = self._positions.index_select(0, index)
+        self._next_tokens = self._next_tokens.index_select(0, index)
+        self._cache, self._mask = _select_rows(self._cache, self._mask, index)
+
+
+# --- SERWER HTTP ---
+
+class LockedCalls:
+    """
+    Przepuszcza wszystkie atrybuty obiektu, ale jego wywołanie i metody z `methods`
+    wykonuje pod blokadą. Tokenizery fast (Rust) nie znoszą równoległego użycia
+    z wielu wątków ("Already borrowed") - blokujemy same wywołania tokenizera/enkodera,
+    a nie całe zapytanie, więc BM25, wyszukiwanie i doczytywanie węzłów idą równolegle.
+    """
+
+    def __init__(self, target, methods=(), lock: Optional[threading.Lock] = None):
+        self._target = target
+        self._methods = frozenset(methods)
+        self._lock = lock or threading.Lock()
+
+    def __call__(self, *args, **kwargs):
+        with self._lock:
+            return self._target(*args, **kwargs)
+
+    def __getattr__(self, name):
+        attr = getattr(self._target, name)
+        if name not in self._methods:
+            return attr
+
+        def locked(*args, **kwargs):
+            with self._lock:
+                return attr(*args, **kwargs)
+        return locked
+
+
+def lock_retriever_encoders(retriever):
+    """
+    Model embeddingów zapytania i cross-encoder retrievera też tokenizują w Ruście -
+    ich wywołania idą pod własną blokadą, reszta retrievera działa współbieżnie.
+    """
+    if getattr(retriever, "embed_model", None) is not None:
+        retriever.embed_model = LockedCalls(
+            retriever.embed_model, ("get_query_embedding", "get_text_embedding_batch"))
+    if getattr(retriever, "reranker", None) is not None:
+        retriever.reranker.model = LockedCalls(retriever.reranker.model, ("predict",))
+    return retriever
+
+
+class ChatService:
+    """
+    Trzyma w pamięci model, tokenizer, retriever oraz silnik batchujący.
+    Tokenizer i enkodery retrievera muszą być opakowane w LockedCalls (patrz serve()).
+    """
+
+    def __init__(self, model, tokenizer, retriever, batcher: ContinuousBatcher):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.retriever = retriever
+        self.batcher = batcher
+
+    def answer(self, pytanie: str, max_new_tokens: int, temperature: float, top_p: float) -> dict:
+        started = time.perf_counter()
+        kontekst_rag = chat.build_context(self.retriever, self.tokenizer, pytanie)
+        retrieval_s = time.perf_counter() - started
+        request = self.batcher.submit(
+            chat.build_prompt(kontekst_rag, pytanie),
+            max_new_tokens=max_new_tokens,
+            temperature=temperature,
+            top_p=top_p,
+        )
+        if not request.done.wait(REQUEST_TIMEOUT_S):
+            self.batcher.cancel(request)
+            raise TimeoutError("Przekroczono czas oczekiwania na odpowiedź modelu.")
+        if request.error:
+            raise RuntimeError(request.error)
+
+        answer = self.tokenizer.decode(request.generated, skip_special_tokens=True).strip()
+        gaps = [b - a for a, b in zip(request.token_times, request.token_times[1:])]
+        return {
+            "answer": answer,
+            "prompt_tokens": len(request.prompt_ids),
+            "completion_tokens": len(request.generated),
+            "retrieval_s": round(retrieval_s, 4),
+            "time_to_first_token_s": round(request.first_token_at - request.submitted_at, 4),
+            "mean_inter_token_latency_s": round(sum(gaps) / len(gaps), 4) if gaps else None,
+            "generation_s": round(request.finished_at - request.submitted_at, 4),
+        }
+
+
+def make_handler(service: ChatService):
+    class ChatRequestHandler(BaseHTTPRequestHandler):
+        def _send_json(self, status: int, payload: dict):
+            body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == "/health":
+                self._send_json(200, {"status": "ok", **service.batcher.stats()})
+            else:
+                self._send_json(404, {"error": "Nieznany endpoint."})
+
+        def do_POST(self):
+            if self.path != "/chat":
+                self._send_json(404, {"error": "Nieznany endpoint."})
+                return
+
+            try:
+                length = int(self.headers.get("Content-Length", 0))
+                payload = json.loads(self.rfile.read(length) or b"{}")
+                if not isinstance(payload, dict):
+                    self._send_json(400, {"error": "Treść zapytania musi być obiektem JSON."})
+                    return
+                pytanie = str(payload.get("question", "")).strip()
+                if not pytanie:
+                    self._send_json(400, {"error": "Brak pola 'question'."})
+                    return
+
+                result = service.answer(
+                    pytanie,
+                    max_new_tokens=int(payload.get("max_new_tokens", chat.MAX_NEW_TOKENS)),
+                    temperature=float(payload.get("temperature", chat.TEMPERATURE)),
+                    top_p=float(payload.get("top_p", chat.TOP_P)),
+                )
+                self._send_json(200, result)
+            except json.JSONDecodeError:
+                self._send_json(400, {"error": "Niepoprawny JSON."})
+            except (TypeError, ValueError) as e:
+                # Niepoprawne parametry liczbowe albo za długi prompt (submit)
+                self._send_json(400, {"error": str(e)})
+            except TimeoutError as e:
+                self._send_json(504, {"error": str(e)})
+            except Exception as e:
+                print(f"Wystąpił błąd: {e}", file=sys.stderr)
+                self._send_json(500, {"error": str(e)})
+
+        def log_message(self, format, *args):
+            # Domyślny logger BaseHTTPRequestHandler pisze każde zapytanie na stderr
+            pass
+
+    return ChatRequestHandler
+
+
+def serve():
+    print("--- 🚀 Startowanie serwera Bota Bomby (continuous batching) ---")
+    model, tokenizer, retriever = chat.startup()
+    # Jedna blokada tokenizera LLM dla wątków HTTP (build_context, decode) i submit() batchera
+    tokenizer = LockedCalls(tokenizer, ("decode",))
+    lock_retriever_encoders(retriever)
+
+    batcher = ContinuousBatcher(model, tokenizer, max_batch_size=MAX_BATCH_SIZE)
+    batcher.start()
+    service = ChatService(model, tokenizer, retriever, batcher)
+
+    server = ThreadingHTTPServer((SERVER_HOST, SERVER_PORT), make_handler(service))
+    print(f"✅ Serwer nasłuchuje na http://{SERVER_HOST}:{SERVER_PORT} (POST /chat, GET /health)")
+    print(f"Maksymalny rozmiar batcha: {MAX_BATCH_SIZE}")
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("\n--- 🛑 Zamykanie serwera. ---")
+    finally:
+        batcher.stop()
+        server.server_close()
+
+
+if __name__ == "__main__":
+    serve()
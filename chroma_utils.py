@@ -0,0 +1,118 @@
+import hashlib
+import os
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+# Rozmiar strony przy przeglądaniu kolekcji - ogranicza szczytowe zużycie RAM
+DEFAULT_PAGE_SIZE = 1000
+
+# --- HNSW (indeks wektorowy kolekcji) ---
+# Metryka, M i construction_ef są ustalane przy tworzeniu kolekcji (zmiana = pełna przebudowa),
+# search_ef można zmienić na istniejącej kolekcji (Chroma >= 1.0). Wartości domyślne = domyślne Chromy.
+# Dobór pod własny punkt recall/opóźnienie: tune_hnsw.py.
+# Zmienne RAG_HNSW_* czyta budowa indeksu (build_rag_index.py); kolekcję zmieniają tylko budowa
+# i tune_hnsw.py --apply - procesy czytające (czat, serwer, benchmark) nigdy jej nie modyfikują.
+HNSW_SPACES = ("l2", "cosine", "ip")
+HNSW_SPACE = os.getenv("RAG_HNSW_SPACE", "l2")
+HNSW_M = int(os.getenv("RAG_HNSW_M", "16"))
+HNSW_CONSTRUCTION_EF = int(os.getenv("RAG_HNSW_CONSTRUCTION_EF", "100"))
+HNSW_SEARCH_EF = int(os.getenv("RAG_HNSW_SEARCH_EF", "10"))
+HNSW_STRUCTURE_KEYS = ("hnsw:space", "hnsw:M", "hnsw:construction_ef")
+CHROMA_DEFAULT_HNSW = {"hnsw:space": "l2", "hnsw:M": 16, "hnsw:construction_ef": 100, "hnsw:search_ef": 10}
+
+
+def iter_collection(collection, include: List[str], page_size: int = DEFAULT_PAGE_SIZE,
+                    where: Optional[Dict[str, Any]] = None) -> Iterator[Dict[str, Any]]:
+    """
+    Przegląda kolekcję ChromaDB stronami (limit/offset) zamiast pobierać wszystko naraz.
+    Zwraca kolejne strony w formacie `collection.get()` (słownik list).
+    """
+    offset = 0
+    while True:
+        page = collection.get(include=include, limit=page_size, offset=offset, where=where)
+        if not page["ids"]:
+            return
+        yield page
+        if len(page["ids"]) < page_size:
+            return
+        offset += page_size
+
+
+def content_hash(entries: Iterable[Tuple[str, Optional[str]]]) -> str:
+    """
+    Hash treści kolekcji z par (id_węzła, doc_hash), niezależny od kolejności stron.
+    Zmienia się przy każdej zmianie tekstu lub metadanych węzła, nawet jeśli liczba węzłów jest ta sama.
+    """
+    digest = hashlib.sha256()
+    for node_id, doc_hash in sorted((node_id, doc_hash or "") for node_id, doc_hash in entries):
+        digest.update(f"{node_id}:{doc_hash}\n".encode("utf-8"))
+    return digest.hexdigest()
+
+
+def collection_content_hash(collection) -> str:
+    return content_hash(
+        (node_id, (meta or {}).get("doc_hash"))
+        for page in iter_collection(collection, include=["metadatas"])
+        for node_id, meta in zip(page["ids"], page["metadatas"])
+    )
+
+
+def hnsw_metadata(space: str = HNSW_SPACE, m: int = HNSW_M, construction_ef: int = HNSW_CONSTRUCTION_EF,
+                  search_ef: int = HNSW_SEARCH_EF) -> Dict[str, Any]:
+    """
+    Parametry HNSW w formacie metadanych kolekcji ChromaDB (`get_or_create_collection(metadata=...)`).
+    """
+    if space not in HNSW_SPACES:
+        raise ValueError(f"Nieznana metryka HNSW: {space} (dostępne: {', '.join(HNSW_SPACES)})")
+    return {"hnsw:space": space, "hnsw:M": m, "hnsw:construction_ef": construction_ef, "hnsw:search_ef": search_ef}
+
+
+def hnsw_structure(metadata: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Parametry, których nie da się zmienić bez przebudowy (brak w metadanych = domyślne Chromy).
+    """
+    metadata = metadata or {}
+    return {key: metadata.get(key, CHROMA_DEFAULT_HNSW[key]) for key in HNSW_STRUCTURE_KEYS}
+
+
+# Nazwy parametrów w konfiguracji kolekcji Chromy >= 1.0 (`collection.configuration["hnsw"]`)
+_CONFIGURATION_KEYS = {"hnsw:space": "space", "hnsw:M": "max_neighbors",
+                       "hnsw:construction_ef": "ef_construction", "hnsw:search_ef": "ef_search"}
+
+
+def collection_hnsw(collection) -> Dict[str, Any]:
+    """
+    Parametry HNSW, z którymi kolekcja faktycznie działa, w formacie `hnsw_metadata`.
+    Chroma >= 1.0 trzyma je w konfiguracji kolekcji (metadane `hnsw:*` czyta tylko przy tworzeniu),
+    starsze wersje - w metadanych.
+    """
+    params = {**CHROMA_DEFAULT_HNSW, **{k: v for k, v in (collection.metadata or {}).items() if k in CHROMA_DEFAULT_HNSW}}
+    configuration = getattr(collection, "configuration", None) or {}
+    hnsw = configuration.get("hnsw") if isinstance(configuration, dict) else None
+    for key, config_key in _CONFIGURATION_KEYS.items():
+        if hnsw and hnsw.get(config_key) is not None:
+            params[key] = hnsw[config_key]
+    return params
+
+
+def set_search_ef(collection, search_ef: int) -> bool:
+    """
+    Zmienia search_ef istniejącej kolekcji (Chroma >= 1.0: jedyny parametr HNSW, który wolno zmienić).
+    Segment HNSW czyta go przy ładowaniu, czyli przy pierwszym zapytaniu danego klienta -
+    ustawienie obowiązuje od następnego otwarcia bazy (PersistentClient) albo od razu,
+    jeśli ten klient jeszcze nie pytał kolekcji.
+    Zwraca False, jeśli wersja Chromy na to nie pozwala - wtedy search_ef zmienia tylko przebudowa.
+    """
+    if collection_hnsw(collection)["hnsw:search_ef"] == search_ef:
+        return True
+    try:
+        collection.modify(configuration={"hnsw": {"ef_search": search_ef}})
+    except TypeError:
+        # Chroma < 1.0: modify() podmienia całe metadane i odrzuca hnsw:space, a segment HNSW
+        # i tak trzyma parametry z chwili utworzenia
+        print(f"Ta wersja Chromy nie zmienia search_ef istniejącej kolekcji - ustaw "
+              f"RAG_HNSW_SEARCH_EF={search_ef} i przebuduj indeks (build_rag_index.py).")
+        return False
+    except ValueError as e:
+        print(f"Nie udało się ustawić hnsw:search_ef = {search_ef}: {e}")
+        return False
+    return True
@@ -1,24 +1,16 @@
 import os
 import json
-import time
-import google.generativeai as genai
+import re
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from tqdm import tqdm
-from dotenv import load_dotenv
 
-load_dotenv()
+from gemini_cache import cache_key, open_cache
+from gemini_utils import GEMINI_MAX_WORKERS, RateLimiter, call_with_retry, estimate_tokens, make_text_client
 
 # --- KONFIGURACJA ---
 INPUT_DIR = "transcriptions"
 OUTPUT_DIR = "transcriptions_clean"
-
-api_key = os.getenv("GEMINI_API_KEY")
-
-if not api_key:
-    print("BŁĄD: Nie znaleziono zmiennej środowiskowej GEMINI_API_KEY.")
-    exit(1)
-
-# Konfiguracja klienta
-genai.configure(api_key=api_key)
+MODEL_NAME = "gemini-2.5-flash"
 
 # Ustawienia bezpieczeństwa - WYŁĄCZAMY BLOKADY
 # To jest kluczowe dla Kapitana Bomby. Bez tego model odrzuci 90% tekstów.
@@ -29,26 +21,63 @@ safety_settings = [
     {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_NONE"},
 ]
 
-# Inicjalizacja modelu
-model = genai.GenerativeModel('gemini-2.5-flash', safety_settings=safety_settings)
-
 # Prompt Systemowy - Instrukcja dla "Korektora"
 SYSTEM_PROMPT = """
 Jesteś profesjonalnym korektorem transkrypcji ASR (Automatic Speech Recognition) dla serialu "Kapitan Bomba".
-Twoim zadaniem jest poprawienie błędów w dostarczonym tekście JSON, zachowując 100% wulgarności i stylu oryginału.
+Twoim zadaniem jest poprawienie błędów w dostarczonych linijkach tekstu, zachowując 100% wulgarności i stylu oryginału.
 
 ZASADY:
 1. Popraw literówki i błędy fonetyczne (np. "dziadnięty" -> "dziabnięty", "Udasha" -> "Janusza", "koszmitów" -> "kosmitów").
 2. Popraw nazwy własne (np. "Sraturn", "Kurvinox", "RKS Huwdu", "Torpeda", "Kutanoid", "Skurwol").
 3. USUŃ CENZURĘ: Jeśli widzisz "k***a", "j*****e", zamień na pełne wulgaryzmy ("kurwa", "jebanie").
-4. NIE ZMIENIAJ struktury JSONA. Zwróć dokładnie taką samą listę obiektów, poprawiając tylko pole "text".
+4. NIE ZMIENIAJ formatu. Każda linijka to "numer|tekst". Zwróć dokładnie tyle samo linijek, z tymi samymi numerami
+   i w tej samej kolejności, poprawiając tylko tekst po "|". Nie łącz i nie dziel linijek. Bez komentarzy i bloków kodu.
 5. Nie dopisuj nic od siebie. Nie bądź kreatywny. Bądź precyzyjny.
 
-Oto surowy JSON z błędami:
+Oto surowe linijki z błędami:
 """
 
-
-def clean_file_with_gemini(filename):
+# Linijka odpowiedzi: "12|tekst" (tolerujemy spacje i dwukropek zamiast kreski)
+NUMBERED_LINE_RE = re.compile(r"^\s*(\d+)\s*[|:]\s?(.*)$")
+
+
+def to_numbered_lines(segments):
+    """
+    Kompaktowy format wysyłki: same teksty segmentów, po jednym na linijkę, z numerem.
+    Znaczniki czasu zostają lokalnie - model ich nie widzi i nie musi przepisywać.
+    """
+    return "\n".join(f"{i}|{' '.join(seg['text'].split())}" for i, seg in enumerate(segments, start=1))
+
+
+def from_numbered_lines(response_text, segments):
+    """
+    Dopasowuje poprawione linijki do oryginalnych segmentów po numerze i dokleja znaczniki czasu.
+    Rzuca ValueError, jeśli liczba lub numeracja linijek się nie zgadza.
+    """
+    corrected = {}
+    for line in response_text.splitlines():
+        match = NUMBERED_LINE_RE.match(line)
+        if not match:
+            continue  # np. resztki bloku ``` albo puste linijki
+        number = int(match.group(1))
+        if number in corrected:
+            raise ValueError(f"powtórzony numer linijki {number}")
+        corrected[number] = match.group(2).strip()
+
+    expected = set(range(1, len(segments) + 1))
+    if set(corrected) != expected:
+        missing = sorted(expected - set(corrected))
+        extra = sorted(set(corrected) - expected)
+        raise ValueError(f"niezgodne linijki (segmentów: {len(segments)}, odpowiedź: {len(corrected)}, "
+                         f"brakujące: {missing[:5]}, nadmiarowe: {extra[:5]})")
+
+    return [
+        {**seg, "text": corrected[i]}
+        for i, seg in enumerate(segments, start=1)
+    ]
+
+
+def clean_file_with_gemini(filename, client, limiter, cache=None):
     input_path = os.path.join(INPUT_DIR, filename)
     output_path = os.path.join(OUTPUT_DIR, filename)
 
@@ -57,24 +86,27 @@ def clean_file_with_gemini(filename):
         raw_data = json.load(f)
 
     # Optymalizacja: Wysyłamy cały plik jako jeden prompt (Flash ma duże okno kontekstowe)
-    # Konwertujemy JSON do stringa, żeby wysłać go jako tekst
-    json_string = json.dumps(raw_data, ensure_ascii=False)
+    # Zamiast JSON-a z kluczami i znacznikami czasu - same ponumerowane linijki tekstu
+    lines_payload = to_numbered_lines(raw_data)
+    prompt = SYSTEM_PROMPT + lines_payload
 
-    # 2. Wyślij do API
+    # 2. Wyślij do API (limiter liczy wejście + odpowiedź, która powtarza wszystkie linijki)
+    #    Identyczne wejście z poprzedniego przebiegu bierzemy z cache
+    key = cache_key(MODEL_NAME, SYSTEM_PROMPT, lines_payload, config={"safety_settings": safety_settings})
     try:
-        response = model.generate_content(SYSTEM_PROMPT + json_string)
-
-        # 3. Oczyść odpowiedź (czasami model dodaje ```json ... ```)
-        cleaned_text = response.text.strip()
-        if cleaned_text.startswith("```json"):
-            cleaned_text = cleaned_text[7:]
-        if cleaned_text.endswith("```"):
-            cleaned_text = cleaned_text[:-3]
-
-        # 4. Parsuj z powrotem do obiektu
-        corrected_data = json.loads(cleaned_text)
-
-        # 5. Zapisz
+        response_text = cache.get(key) if cache else None
+        if response_text is None:
+            response_text = call_with_retry(
+                lambda: client.generate(prompt), limiter,
+                tokens=estimate_tokens(prompt) + estimate_tokens(lines_payload)
+            )
+
+        # 3. Dopasuj linijki do segmentów i przywróć oryginalne znaczniki czasu
+        corrected_data = from_numbered_lines(response_text, raw_data)
+        if cache:
+            cache.put(key, response_text)
+
+        # 4. Zapisz
         with open(output_path, 'w', encoding='utf-8') as f:
             json.dump(corrected_data, f, ensure_ascii=False, indent=2)
 
@@ -93,20 +125,29 @@ if __name__ == "__main__":
 
     files = [f for f in os.listdir(INPUT_DIR) if f.endswith(".json")]
 
-    print(f"--- Rozpoczynam czyszczenie {len(files)} plików przy użyciu Gemini API ---")
-
-    for filename in tqdm(files):
-        # Sprawdź, czy już nie zrobione (oszczędność API)
+    # Sprawdź, czy już nie zrobione (oszczędność API)
+    pending = []
+    for filename in files:
         if os.path.exists(os.path.join(OUTPUT_DIR, filename)):
             print(filename, "istnieje.")
-            continue
-
-        success = clean_file_with_gemini(filename)
-
-        if success:
-            # Ważne: Rate Limiting dla Free Tier
-            time.sleep(7)
         else:
-            print(f"Pominięto plik {filename} z powodu błędu.")
-
-    print("\nZakończono proces czyszczenia.")
\ No newline at end of file
+            pending.append(filename)
+
+    print(f"--- Rozpoczynam czyszczenie {len(pending)} plików przy użyciu Gemini API ---")
+
+    # Konfiguracja klienta (prawdziwe API albo lokalny zastępnik z GEMINI_BASE_URL)
+    client = make_text_client(MODEL_NAME, safety_settings)
+    # Rate limiting: wspólny token bucket (RPM + TPM) zamiast stałej pauzy po każdym pliku
+    limiter = RateLimiter()
+    cache = open_cache()
+    print(f"Wątki: {GEMINI_MAX_WORKERS} | limit: {limiter.rpm:.0f} zapytań/min, {limiter.tpm:.0f} tokenów/min")
+
+    with ThreadPoolExecutor(max_workers=GEMINI_MAX_WORKERS) as pool:
+        futures = {pool.submit(clean_file_with_gemini, filename, client, limiter, cache): filename for filename in pending}
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            if not future.result():
+                print(f"Pominięto plik {futures[future]} z powodu błędu.")
+
+    if cache is not None:
+        print(cache.summary())
+    print("\nZakończono proces czyszczenia.")
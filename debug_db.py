@@ -1,69 +1,204 @@
+import argparse
 import chromadb
-from transformers import AutoTokenizer
+import json
+import os
 import sys
+from collections import Counter
+from transformers import AutoTokenizer
+from typing import Any, Dict, List
+
+from llama_index.core.schema import MetadataMode
+from llama_index.core.vector_stores.utils import metadata_dict_to_node
+
+from chroma_utils import DEFAULT_PAGE_SIZE, collection_hnsw, iter_collection
 
 # --- Konfiguracja (musi być taka sama jak w skryptach) ---
 DB_PATH = "./chroma_db"
-TOKENIZER_NAME = "sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2"
+COLLECTION_NAME = "bomba_lore"
+# Model embeddingów z build_rag_index.py (jego tokenizer decyduje o ucięciu chunka)
+EMBED_MODEL_NAME = "sdadas/mmlw-retrieval-roberta-large"
+EMBED_MAX_TOKENS = 512
+# Tokenizer modelu czatu (budżet kontekstu w chat.py)
+LLM_TOKENIZER_NAME = "speakleash/bielik-7b-instruct-v0.1"
+LLM_CONTEXT_TOKENS = 2048
+
+# Przedziały histogramu długości (w tokenach)
+HISTOGRAM_EDGES = [32, 64, 128, 256, 512, 1024, 2048]
+
+
+class LengthStats:
+    """
+    Strumieniowe statystyki długości: licznik wartości zamiast listy, więc pamięć zależy
+    od liczby różnych długości, a nie od liczby chunków.
+    """
+
+    def __init__(self):
+        self.counts: Counter = Counter()
+        self.total = 0
+        self.n = 0
+
+    def add(self, length: int):
+        self.counts[length] += 1
+        self.total += length
+        self.n += 1
+
+    def percentile(self, q: float) -> int:
+        target = q * (self.n - 1)
+        seen = 0
+        for length in sorted(self.counts):
+            seen += self.counts[length]
+            if seen > target:
+                return length
+        return 0
+
+    def over(self, limit: int) -> int:
+        return sum(count for length, count in self.counts.items() if length > limit)
+
+    def histogram(self) -> List[int]:
+        buckets = [0] * (len(HISTOGRAM_EDGES) + 1)
+        for length, count in self.counts.items():
+            idx = next((i for i, edge in enumerate(HISTOGRAM_EDGES) if length <= edge), len(HISTOGRAM_EDGES))
+            buckets[idx] += count
+        return buckets
+
+    def summary(self) -> Dict[str, Any]:
+        if not self.n:
+            return {"count": 0}
+        return {
+            "count": self.n,
+            "mean": round(self.total / self.n, 1),
+            "p50": self.percentile(0.5),
+            "p95": self.percentile(0.95),
+            "max": max(self.counts),
+            "histogram": self.histogram(),
+        }
+
 
-def analyze_database():
+def _histogram_labels() -> List[str]:
+    lows = [0] + HISTOGRAM_EDGES
+    return [f"{lo + 1}-{hi}" for lo, hi in zip(lows, HISTOGRAM_EDGES)] + [f">{HISTOGRAM_EDGES[-1]}"]
+
+
+def _print_table(title: str, stats: Dict[str, LengthStats]):
+    print(f"\n--- {title} ---")
+    labels = _histogram_labels()
+    print(f"{'typ':<20}{'n':>7}{'śr.':>8}{'p50':>6}{'p95':>6}{'max':>6}  " + " ".join(f"{l:>9}" for l in labels))
+    for node_type in sorted(stats):
+        s = stats[node_type].summary()
+        print(f"{node_type:<20}{s['count']:>7}{s['mean']:>8}{s['p50']:>6}{s['p95']:>6}{s['max']:>6}  "
+              + " ".join(f"{c:>9}" for c in s["histogram"]))
+
+
+def _dir_size(path: str) -> int:
+    return sum(os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(path) for f in files)
+
+
+def analyze_database(page_size: int = DEFAULT_PAGE_SIZE, json_output: str = None):
     print("--- 🕵️‍♂️ Rozpoczynam Analizę Bazy Danych ChromaDB ---")
 
     try:
-        # Używamy tej samej "linijki" (tokenizera) co model RAG
-        print(f"Ładuję tokenizer: {TOKENIZER_NAME}...")
-        tokenizer = AutoTokenizer.from_pretrained(TOKENIZER_NAME)
-        print("Tokenizer załadowany.")
+        # Tokenizery obu modeli, które faktycznie czytają te chunki (wersje "fast" - batchowe)
+        print(f"Ładuję tokenizery: {EMBED_MODEL_NAME} oraz {LLM_TOKENIZER_NAME}...")
+        embed_tokenizer = AutoTokenizer.from_pretrained(EMBED_MODEL_NAME, use_fast=True)
+        llm_tokenizer = AutoTokenizer.from_pretrained(LLM_TOKENIZER_NAME, use_fast=True)
+        print("Tokenizery załadowane.")
 
         # Łączymy się z *istniejącą* bazą danych
         print(f"Ładuję bazę danych z: {DB_PATH}...")
         db = chromadb.PersistentClient(path=DB_PATH)
-        collection = db.get_collection("bomba_lore")
-        print("Baza danych załadowana.")
-
-        # Pobieramy WSZYSTKIE dokumenty z bazy
-        print("Pobieram *wszystkie* fragmenty z bazy (to może chwilę potrwać)...")
-        results = collection.get(include=["documents"])
-        documents = results['documents']
-        total_chunks = len(documents)
+        collection = db.get_collection(COLLECTION_NAME)
+        total_chunks = collection.count()
+        print(f"Baza danych załadowana ({total_chunks} fragmentów).")
 
         if total_chunks == 0:
             print("BŁĄD: Baza danych jest pusta!")
             return
 
-        print(f"Pobrano {total_chunks} fragmentów. Analizuję długość każdego z nich...")
+        embed_stats: Dict[str, LengthStats] = {}
+        llm_stats: Dict[str, LengthStats] = {}
+        all_embed = LengthStats()
+        all_llm = LengthStats()
+        text_bytes = 0
+        metadata_bytes = 0
+        processed = 0
 
-        # Mierzymy długość każdego fragmentu
-        lengths = []
-        for doc in documents:
-            # Używamy .encode(), a nie .tokenize(), aby dostać listę ID tokenów
-            tokens = tokenizer.encode(doc, add_special_tokens=False)
-            lengths.append(len(tokens))
+        # Strony po `page_size` - w pamięci jest naraz tylko jedna strona
+        print(f"Analizuję fragmenty stronami po {page_size}...")
+        for page in iter_collection(collection, include=["documents", "metadatas"], page_size=page_size):
+            documents = [doc or "" for doc in page["documents"]]
+            metadatas = [meta or {} for meta in page["metadatas"]]
 
-        # Analiza statystyczna
-        max_len = max(lengths)
-        min_len = min(lengths)
-        avg_len = sum(lengths) / total_chunks
+            # Embedding widzi tekst razem z metadanymi (jak w build_rag_index.py), LLM - tekst w kontekście
+            embed_texts = [
+                metadata_dict_to_node(meta, text=doc).get_content(metadata_mode=MetadataMode.EMBED)
+                for doc, meta in zip(documents, metadatas)
+            ]
+            embed_lengths = embed_tokenizer(embed_texts, add_special_tokens=True)["input_ids"]
+            llm_lengths = llm_tokenizer(documents, add_special_tokens=False)["input_ids"]
 
-        # Szukamy "potwornych fragmentów"
-        over_512 = sum(1 for l in lengths if l > 512)
-        over_1024 = sum(1 for l in lengths if l > 1024)
-        over_2048 = sum(1 for l in lengths if l > 2048) # To są te, które psują nam czat
+            for meta, doc, e_ids, l_ids in zip(metadatas, documents, embed_lengths, llm_lengths):
+                node_type = meta.get("type", "unknown")
+                embed_stats.setdefault(node_type, LengthStats()).add(len(e_ids))
+                llm_stats.setdefault(node_type, LengthStats()).add(len(l_ids))
+                all_embed.add(len(e_ids))
+                all_llm.add(len(l_ids))
+                text_bytes += len(doc.encode("utf-8"))
+                metadata_bytes += len(json.dumps(meta, ensure_ascii=False).encode("utf-8"))
 
-        print("\n" + "="*50)
+            processed += len(documents)
+            print(f"  ...{processed}/{total_chunks}", end="\r")
+
+        # Szacunek pamięci indeksu: wektory float32 + graf HNSW + teksty i metadane
+        sample = collection.get(limit=1, include=["embeddings"])
+        dim = len(sample["embeddings"][0]) if len(sample["embeddings"]) else 0
+        vector_bytes = total_chunks * dim * 4
+        # M (sąsiedzi na węzeł) z metadanych kolekcji; warstwa 0 ma 2*M sąsiadów (int32)
+        hnsw_m = collection_hnsw(collection)["hnsw:M"]
+        hnsw_bytes = total_chunks * hnsw_m * 2 * 4
+
+        truncated = {t: s.over(EMBED_MAX_TOKENS) for t, s in embed_stats.items()}
+
+        print("\n" + "=" * 50)
         print("--- WYNIKI ANALIZY BAZY DANYCH (chroma_db) ---")
         print(f"Ilość wszystkich fragmentów (chunków): {total_chunks}")
-        print(f"Średnia długość fragmentu: {avg_len:.2f} tokenów")
-        print(f"Minimalna długość fragmentu: {min_len} tokenów")
-        print(f"!!! MAKSYMALNA długość fragmentu: {max_len} tokenów !!!")
+        _print_table(f"Tokeny embeddingu ({EMBED_MODEL_NAME}, tekst + metadane)", embed_stats)
+        _print_table(f"Tokeny LLM ({LLM_TOKENIZER_NAME}, sam tekst)", llm_stats)
+        print("-" * 50)
+        print(f"Ucięte przy embeddingu (> {EMBED_MAX_TOKENS} tokenów): {sum(truncated.values())} "
+              + ", ".join(f"{t}: {n}" for t, n in sorted(truncated.items()) if n))
+        print(f"Dłuższe niż kontekst czatu (> {LLM_CONTEXT_TOKENS} tokenów LLM): {all_llm.over(LLM_CONTEXT_TOKENS)}")
+        print(f"!!! MAKSYMALNA długość fragmentu: {max(all_llm.counts)} tokenów LLM, "
+              f"{max(all_embed.counts)} tokenów embeddingu !!!")
         print("-" * 50)
-        print(f"Fragmenty dłuższe niż 512 tokenów: {over_512}")
-        print(f"Fragmenty dłuższe niż 1024 tokeny: {over_1024}")
-        print(f"Fragmenty dłuższe niż 2048 tokenów: {over_2048}")
-        print("="*50)
+        print(f"Pamięć indeksu (szacunek): wektory {vector_bytes / 2**20:.1f} MiB (dim {dim}), "
+              f"HNSW (M = {hnsw_m}) ~{hnsw_bytes / 2**20:.1f} MiB, teksty {text_bytes / 2**20:.1f} MiB, "
+              f"metadane {metadata_bytes / 2**20:.1f} MiB")
+        print(f"Rozmiar katalogu {DB_PATH} na dysku: {_dir_size(DB_PATH) / 2**20:.1f} MiB")
+        print("=" * 50)
+
+        if json_output:
+            report = {
+                "total_chunks": total_chunks,
+                "histogram_labels": _histogram_labels(),
+                "embed_tokens": {t: s.summary() for t, s in embed_stats.items()},
+                "llm_tokens": {t: s.summary() for t, s in llm_stats.items()},
+                "embed_truncated": truncated,
+                "memory_bytes": {"vectors": vector_bytes, "hnsw": hnsw_bytes,
+                                 "texts": text_bytes, "metadata": metadata_bytes},
+            }
+            with open(json_output, "w", encoding="utf-8") as f:
+                json.dump(report, f, ensure_ascii=False, indent=2)
+            print(f"Raport JSON: {json_output}")
 
     except Exception as e:
         print(f"Wystąpił błąd podczas analizy: {e}", file=sys.stderr)
 
+
 if __name__ == "__main__":
-    analyze_database()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Profil długości chunków i pamięci kolekcji bomba_lore.")
+    parser.add_argument("--page-size", type=int, default=DEFAULT_PAGE_SIZE,
+                        help="Ile fragmentów pobierać i tokenizować naraz (ogranicza pamięć).")
+    parser.add_argument("--json", dest="json_output", help="Zapisz raport także jako JSON.")
+    args = parser.parse_args()
+
+    analyze_database(page_size=args.page_size, json_output=args.json_output)
@@ -0,0 +1,96 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from typing import Any, Optional
+
+# --- KONFIGURACJA ---
+GEMINI_CACHE_ENABLED = os.getenv("GEMINI_CACHE", "1") == "1"
+GEMINI_CACHE_FILE = os.getenv("GEMINI_CACHE_FILE", os.path.join(".gemini_cache", "responses.sqlite"))
+GEMINI_CACHE_MAX_MB = float(os.getenv("GEMINI_CACHE_MAX_MB", "512"))
+# Po przekroczeniu limitu usuwamy najdawniej używane wpisy do tego ułamka limitu
+EVICT_TO_FRACTION = 0.9
+
+
+def cache_key(model: str, prompt: str, payload: str, schema: Any = None, config: Any = None) -> str:
+    """
+    Klucz treściowy: hash (model, prompt, dane wejściowe, schemat, konfiguracja generowania).
+    Zmiana któregokolwiek elementu daje nowy klucz; identyczne wejście - zawsze ten sam.
+    """
+    if schema is not None and hasattr(schema, "model_json_schema"):
+        schema = schema.model_json_schema()
+    material = json.dumps(
+        {"model": model, "prompt": prompt, "payload": payload, "schema": schema, "config": config},
+        sort_keys=True, ensure_ascii=False, default=str,
+    )
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """
+    Lokalny magazyn surowych odpowiedzi API (SQLite, treść skompresowana zlib).
+    Bezpieczny dla wątków; po przekroczeniu `max_bytes` usuwa najdawniej używane wpisy (LRU).
+    """
+
+    def __init__(self, path: str = GEMINI_CACHE_FILE, max_bytes: int = int(GEMINI_CACHE_MAX_MB * 2**20)):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, value BLOB NOT NULL, size INTEGER NOT NULL, last_access REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS responses_last_access ON responses(last_access)")
+        self._db.commit()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            row = self._db.execute("SELECT value FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self._db.execute("UPDATE responses SET last_access = ? WHERE key = ?", (time.time(), key))
+            self._db.commit()
+            self.hits += 1
+        return zlib.decompress(row[0]).decode("utf-8")
+
+    def put(self, key: str, value: str):
+        blob = zlib.compress(value.encode("utf-8"), 6)
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO responses (key, value, size, last_access) VALUES (?, ?, ?, ?)",
+                (key, blob, len(blob), time.time()),
+            )
+            self._evict()
+            self._db.commit()
+
+    def _evict(self):
+        total = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        target = self.max_bytes * EVICT_TO_FRACTION
+        for key, size in self._db.execute("SELECT key, size FROM responses ORDER BY last_access").fetchall():
+            if total <= target:
+                break
+            self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+            total -= size
+
+    def summary(self) -> str:
+        with self._lock:
+            count, total = self._db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+        return (f"Cache odpowiedzi: {self.hits} trafień, {self.misses} chybień | "
+                f"{count} wpisów, {total / 2**20:.1f}/{self.max_bytes / 2**20:.0f} MiB ({self.path})")
+
+
+def open_cache() -> Optional[ResponseCache]:
+    """
+    Zwraca wspólny cache albo None, jeśli wyłączono go przez GEMINI_CACHE=0.
+    """
+    return ResponseCache() if GEMINI_CACHE_ENABLED else None
@@ -0,0 +1,166 @@
+import json
+import os
+import random
+import threading
+import time
+import urllib.error
+import urllib.request
+from typing import Callable, List, Optional, TypeVar
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# --- KONFIGURACJA ---
+# Limity konta Gemini (domyślnie Free Tier dla gemini-2.5-flash); na płatnym planie podnieś przez env
+GEMINI_RPM = float(os.getenv("GEMINI_RPM", "10"))
+GEMINI_TPM = float(os.getenv("GEMINI_TPM", "250000"))
+GEMINI_MAX_WORKERS = int(os.getenv("GEMINI_MAX_WORKERS", "4"))
+# Adres lokalnego zastępnika API (testy offline); pusty = prawdziwe Gemini
+GEMINI_BASE_URL = os.getenv("GEMINI_BASE_URL", "")
+
+MAX_RETRIES = 6
+BACKOFF_BASE_S = 2.0
+BACKOFF_MAX_S = 60.0
+# Kody, przy których warto ponowić: limit zapytań i błędy po stronie serwera
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+# Zgrubny przelicznik znaków na tokeny dla polskiego tekstu
+CHARS_PER_TOKEN = 4
+
+T = TypeVar("T")
+
+
+class HTTPStatusError(Exception):
+    def __init__(self, code: int, message: str = ""):
+        super().__init__(f"HTTP {code}: {message}")
+        self.code = code
+
+
+def estimate_tokens(text: str) -> int:
+    return max(1, len(text) // CHARS_PER_TOKEN)
+
+
+class RateLimiter:
+    """
+    Dwa kubełki tokenów (zapytania/min i tokeny/min) współdzielone przez wątki robocze.
+    `acquire` blokuje, dopóki w obu kubełkach nie ma miejsca - zamiast stałego `time.sleep` po każdym pliku.
+    `clock` i `sleep` można podmienić (testy bez czekania).
+    """
+
+    def __init__(self, requests_per_minute: float = GEMINI_RPM, tokens_per_minute: float = GEMINI_TPM,
+                 clock: Callable[[], float] = time.monotonic, sleep: Callable[[float], None] = time.sleep):
+        self.rpm = requests_per_minute
+        self.tpm = tokens_per_minute
+        self._clock = clock
+        self._sleep = sleep
+        self._requests = requests_per_minute
+        self._tokens = tokens_per_minute
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = self._clock()
+        elapsed = now - self._updated
+        self._updated = now
+        self._requests = min(self.rpm, self._requests + elapsed * self.rpm / 60.0)
+        self._tokens = min(self.tpm, self._tokens + elapsed * self.tpm / 60.0)
+
+    def acquire(self, tokens: int = 1):
+        # Pojedyncze zapytanie większe niż cały kubełek i tak musi przejść
+        tokens = min(tokens, self.tpm)
+        while True:
+            with self._lock:
+                self._refill()
+                if self._requests >= 1 and self._tokens >= tokens:
+                    self._requests -= 1
+                    self._tokens -= tokens
+                    return
+                wait = max((1 - self._requests) * 60.0 / self.rpm, (tokens - self._tokens) * 60.0 / self.tpm)
+            self._sleep(max(wait, 0.05))
+
+
+def _status_code(error: Exception) -> Optional[int]:
+    # google-generativeai (api_core), google-genai (errors.APIError) i HTTPStatusError trzymają kod w `.code`
+    code = getattr(error, "code", None) or getattr(error, "status_code", None)
+    if callable(code):  # grpc zwraca kod jako metodę
+        return None
+    try:
+        return int(code) if code is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+def call_with_retry(fn: Callable[[], T], limiter: Optional[RateLimiter] = None, tokens: int = 1,
+                    max_retries: int = MAX_RETRIES, sleep: Callable[[float], None] = time.sleep) -> T:
+    """
+    Wywołuje `fn` pod kontrolą limitera i ponawia przy 429/5xx z wykładniczym backoffem z jitterem.
+    Inne błędy (np. blokada safety, zły JSON) przechodzą od razu do wywołującego.
+    """
+    attempt = 0
+    while True:
+        if limiter is not None:
+            limiter.acquire(tokens)
+        try:
+            return fn()
+        except Exception as e:
+            if attempt >= max_retries or _status_code(e) not in RETRYABLE_STATUS:
+                raise
+            # "Full jitter": losowe opóźnienie z przedziału [0, min(max, base * 2^n)]
+            delay = random.uniform(0, min(BACKOFF_MAX_S, BACKOFF_BASE_S * 2 ** attempt))
+            attempt += 1
+            print(f"\nGemini: błąd {_status_code(e)}, ponawiam za {delay:.1f} s (próba {attempt}/{max_retries}).")
+            sleep(delay)
+
+
+# --- KLIENCI (wymienni: prawdziwe API albo lokalny zastępnik) ---
+
+class GeminiTextClient:
+    """
+    Cienka nakładka na `google.generativeai`: tekst na wejściu, tekst na wyjściu.
+    """
+
+    def __init__(self, model_name: str, safety_settings: List[dict], api_key: str):
+        import google.generativeai as genai
+
+        genai.configure(api_key=api_key)
+        self.model = genai.GenerativeModel(model_name, safety_settings=safety_settings)
+
+    def generate(self, prompt: str) -> str:
+        return self.model.generate_content(prompt).text
+
+
+class LocalHTTPClient:
+    """
+    Zastępnik API do testów: POST {"model", "prompt"} pod `base_url`, odpowiedź {"text": ...}.
+    Kody HTTP serwera (np. 429) przechodzą jako HTTPStatusError, więc retry działa jak z prawdziwym API.
+    """
+
+    def __init__(self, base_url: str, model_name: str, timeout_s: float = 120.0):
+        self.url = base_url.rstrip("/") + "/generate"
+        self.model_name = model_name
+        self.timeout_s = timeout_s
+
+    def generate(self, prompt: str) -> str:
+        body = json.dumps({"model": self.model_name, "prompt": prompt}, ensure_ascii=False).encode("utf-8")
+        request = urllib.request.Request(self.url, data=body, headers={"Content-Type": "application/json"})
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout_s) as response:
+                return json.loads(response.read().decode("utf-8"))["text"]
+        except urllib.error.HTTPError as e:
+            raise HTTPStatusError(e.code, e.reason) from e
+
+
+def make_text_client(model_name: str, safety_settings: List[dict]):
+    """
+    Zwraca lokalny zastępnik, jeśli ustawiono GEMINI_BASE_URL, w przeciwnym razie klienta Gemini.
+    Brak klucza API kończy program z komunikatem (jak wcześniej w skryptach).
+    """
+    if GEMINI_BASE_URL:
+        print(f"Używam lokalnego zastępnika API: {GEMINI_BASE_URL}")
+        return LocalHTTPClient(GEMINI_BASE_URL, model_name)
+
+    api_key = os.getenv("GEMINI_API_KEY")
+    if not api_key:
+        print("BŁĄD: Nie znaleziono zmiennej środowiskowej GEMINI_API_KEY.")
+        raise SystemExit(1)
+    return GeminiTextClient(model_name, safety_settings, api_key)
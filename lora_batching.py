@@ -0,0 +1,103 @@
+import random
+
+# How examples are put into batches:
+#   "pad"             - random batches padded to the longest example (original behaviour)
+#   "group_by_length" - batches of similar length, so little padding is needed
+#   "packing"         - examples concatenated into one row; position_ids restart at every
+#                       example so attention never crosses example boundaries (needs flash-attn)
+BATCHING_MODES = ("pad", "group_by_length", "packing")
+
+
+def simulate_batches(lengths, batch_size, group_by_length, seed):
+    """
+    Reproduces how the sampler batches examples, to estimate padding before training.
+    Length grouping mirrors transformers' LengthGroupedSampler (sorted megabatches of 50 batches).
+    """
+    order = list(range(len(lengths)))
+    random.Random(seed).shuffle(order)
+    if group_by_length:
+        megabatch = 50 * batch_size
+        order = [
+            idx
+            for start in range(0, len(order), megabatch)
+            for idx in sorted(order[start:start + megabatch], key=lambda i: lengths[i], reverse=True)
+        ]
+    return [order[start:start + batch_size] for start in range(0, len(order), batch_size)]
+
+
+def padding_report(lengths, batch_size, seed):
+    """
+    Prints real vs. padded token counts per batching mode and returns {mode: padding ratio}.
+    """
+    real_tokens = sum(lengths)
+    ratios = {}
+    for mode in BATCHING_MODES:
+        if mode == "packing":
+            padded_tokens = real_tokens  # flattened rows carry no padding at all
+        else:
+            batches = simulate_batches(lengths, batch_size, group_by_length=(mode == "group_by_length"), seed=seed)
+            padded_tokens = sum(max(lengths[i] for i in batch) * len(batch) for batch in batches)
+        ratios[mode] = 1 - real_tokens / padded_tokens
+        print(f"  {mode:<16} tokens processed: {padded_tokens:>9}  padding: {ratios[mode]:6.1%}")
+    return ratios
+
+
+def token_budget_batches(lengths, budget, seed):
+    """
+    Packed batches with a hard cap: shuffled examples are added to a row until the next one would
+    push it over `budget` real tokens. An example longer than the budget on its own cannot be
+    packed without breaking the cap, so it raises ValueError (tokenization truncates to the
+    model's max length, which must not exceed the budget).
+    """
+    too_long = [i for i, length in enumerate(lengths) if length > budget]
+    if too_long:
+        raise ValueError(f"{len(too_long)} examples exceed the packing budget of {budget} tokens "
+                         f"(first: #{too_long[0]}, {lengths[too_long[0]]} tokens); truncate them to the budget")
+
+    order = list(range(len(lengths)))
+    random.Random(seed).shuffle(order)
+    batches, current, used = [], [], 0
+    for idx in order:
+        if current and used + lengths[idx] > budget:
+            batches.append(current)
+            current, used = [], 0
+        current.append(idx)
+        used += lengths[idx]
+    if current:
+        batches.append(current)
+    return batches
+
+
+class TokenBudgetBatchSampler:
+    """
+    Batch sampler over token_budget_batches, reshuffled every epoch.
+    The number of examples per batch varies; the number of tokens never exceeds the budget.
+    """
+
+    def __init__(self, lengths, budget, seed):
+        self.lengths = list(lengths)
+        self.budget = budget
+        self.seed = seed
+        self.set_epoch(0)
+
+    def set_epoch(self, epoch):
+        self.batches = token_budget_batches(self.lengths, self.budget, self.seed + epoch)
+
+    def __iter__(self):
+        return iter(self.batches)
+
+    def __len__(self):
+        return len(self.batches)
+
+
+def check_single_bos(input_ids_batch, bos_token_id):
+    """
+    The prompt template writes <s> itself and is tokenized with add_special_tokens=False,
+    so every row must start with exactly one BOS token - not zero (template not parsed as a
+    special token) and not two (tokenizer added its own as well).
+    """
+    if bos_token_id is None:
+        return
+    for row, ids in enumerate(input_ids_batch):
+        if not ids or ids[0] != bos_token_id or ids[1:2] == [bos_token_id]:
+            raise ValueError(f"Row {row} does not start with exactly one BOS token ({bos_token_id}): {ids[:4]}")
@@ -0,0 +1,113 @@
+import hashlib
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from bm25_index import normalize_tokens
+
+# --- KONFIGURACJA ---
+# Długość shingli (n-gramy słów); krótkie cytaty porównujemy po pojedynczych słowach
+SHINGLE_SIZE = 3
+# 64 permutacje MinHash = 16 pasm LSH po 4 wiersze -> próg kandydatów ok. Jaccard 0.5
+MINHASH_PERMUTATIONS = 64
+LSH_BANDS = 16
+# Kandydatów z LSH potwierdzamy dokładnym podobieństwem Jaccarda zbiorów shingli
+JACCARD_THRESHOLD = 0.8
+
+_MERSENNE_PRIME = (1 << 31) - 1
+_rng = np.random.default_rng(20240611)  # stałe ziarno = te same grupy w każdym przebiegu
+_PERM_A = _rng.integers(1, _MERSENNE_PRIME, size=MINHASH_PERMUTATIONS, dtype=np.uint64)
+_PERM_B = _rng.integers(0, _MERSENNE_PRIME, size=MINHASH_PERMUTATIONS, dtype=np.uint64)
+
+
+def shingles(text: str, size: int = SHINGLE_SIZE) -> frozenset:
+    """
+    Zbiór n-gramów słów po normalizacji (małe litery, bez diakrytyków i interpunkcji).
+    """
+    tokens = normalize_tokens(text)
+    if len(tokens) < size:
+        return frozenset([" ".join(tokens)]) if tokens else frozenset()
+    return frozenset(" ".join(tokens[i:i + size]) for i in range(len(tokens) - size + 1))
+
+
+def shingle_hashes(text: str) -> List[int]:
+    """
+    Odcisk tekstu: posortowane 31-bitowe hashe shingli. Wystarcza do MinHash i do Jaccarda,
+    więc można go zapisać (manifest) zamiast tekstu i nie parsować pliku ponownie.
+    """
+    return sorted(
+        int.from_bytes(hashlib.blake2b(s.encode("utf-8"), digest_size=4).digest(), "little") % _MERSENNE_PRIME
+        for s in shingles(text)
+    )
+
+
+def minhash_signature(hashed_shingles: Sequence[int]) -> np.ndarray:
+    hashes = np.array(hashed_shingles, dtype=np.uint64)
+    # (a * x + b) mod p dla wszystkich permutacji naraz; iloczyny mieszczą się w uint64 (p < 2^31)
+    permuted = (hashes[None, :] * _PERM_A[:, None] + _PERM_B[:, None]) % _MERSENNE_PRIME
+    return permuted.min(axis=1)
+
+
+def _jaccard(a: frozenset, b: frozenset) -> float:
+    return len(a & b) / len(a | b)
+
+
+def find_duplicate_groups(texts: Sequence[str], speakers: Optional[Sequence[Optional[str]]] = None,
+                          threshold: float = JACCARD_THRESHOLD) -> List[List[int]]:
+    """
+    Grupuje prawie identyczne teksty (MinHash + LSH, potwierdzone dokładnym Jaccardem).
+    Zwraca listy indeksów posortowane rosnąco; pierwszy indeks grupy jest jej reprezentantem.
+    Teksty przypisane dwóm różnym mówcom (`speakers`) nigdy nie trafiają do jednej grupy.
+    """
+    return find_duplicate_groups_hashed([shingle_hashes(text) for text in texts], speakers, threshold)
+
+
+def find_duplicate_groups_hashed(fingerprints: Sequence[Sequence[int]],
+                                 speakers: Optional[Sequence[Optional[str]]] = None,
+                                 threshold: float = JACCARD_THRESHOLD) -> List[List[int]]:
+    """
+    Jak `find_duplicate_groups`, ale na gotowych odciskach z `shingle_hashes`.
+    """
+    speakers = speakers or [None] * len(fingerprints)
+    shingle_sets = [frozenset(hashes) for hashes in fingerprints]
+    rows = MINHASH_PERMUTATIONS // LSH_BANDS
+
+    buckets: Dict[Tuple[int, bytes], List[int]] = {}
+    for idx, shingle_set in enumerate(shingle_sets):
+        if not shingle_set:
+            continue
+        signature = minhash_signature(list(shingle_set))
+        for band in range(LSH_BANDS):
+            key = (band, signature[band * rows:(band + 1) * rows].tobytes())
+            buckets.setdefault(key, []).append(idx)
+
+    candidate_pairs = set()
+    for members in buckets.values():
+        for i, left in enumerate(members):
+            for right in members[i + 1:]:
+                candidate_pairs.add((left, right))
+
+    # Union-find; korzeń = najmniejszy indeks, zbiór mówców trzymany per grupa
+    parent = list(range(len(fingerprints)))
+    group_speakers = [{s} if s else set() for s in speakers]
+
+    def find(i: int) -> int:
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for left, right in sorted(candidate_pairs):
+        root_l, root_r = find(left), find(right)
+        if root_l == root_r or _jaccard(shingle_sets[left], shingle_sets[right]) < threshold:
+            continue
+        if len(group_speakers[root_l] | group_speakers[root_r]) > 1:
+            continue
+        root, child = min(root_l, root_r), max(root_l, root_r)
+        parent[child] = root
+        group_speakers[root] |= group_speakers[child]
+
+    groups: Dict[int, List[int]] = {}
+    for idx in range(len(fingerprints)):
+        groups.setdefault(find(idx), []).append(idx)
+    return [members for members in groups.values() if len(members) > 1]
@@ -0,0 +1,400 @@
+import argparse
+import json
+import os
+import shutil
+import sys
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from bm25_index import filter_metadata, matches_where
+from chroma_utils import content_hash, iter_collection
+
+# --- KONFIGURACJA ---
+DB_DIRECTORY = "./chroma_db"
+COLLECTION_NAME = "bomba_lore"
+QUANTIZED_DIR = os.path.join(DB_DIRECTORY, "quantized")
+# Ilu kandydatów z pierwszego (skwantyzowanego) przejścia przeliczamy dokładnie
+RESCORE_SHORTLIST = 40
+# Przeszukujemy macierz kodów porcjami, żeby nie rozpakowywać jej całej do float32
+SEARCH_CHUNK_ROWS = 8192
+
+QUANTIZATION_MODES = ("int8", "binary")
+# Skąd rescoring bierze wektory pełnej precyzji:
+#   mmap      - kopia float16 zapisana obok kodów (w RAM tylko strony kandydatów, na dysku pół float32)
+#   chroma    - collection.get(embeddings): Chroma wczytuje cały segment float32 do RAM
+#   recompute - embedding tekstów kandydatów na nowo (bez dodatkowych wektorów, ale wolno)
+# Kopię do mmap zapisujemy tylko, gdy to źródło jest wybrane (RAG_RESCORE_SOURCE, domyślnie "mmap").
+RESCORE_SOURCES = ("mmap", "chroma", "recompute")
+RESCORE_SOURCE = os.getenv("RAG_RESCORE_SOURCE", "mmap")
+if RESCORE_SOURCE not in RESCORE_SOURCES:
+    raise ValueError(f"RAG_RESCORE_SOURCE musi być jednym z: {', '.join(RESCORE_SOURCES)}")
+# Zbiór wzorcowy benchmark_retrieval.py - domyślne zapytania raportu (prawdziwe pytania, nie zapisane wektory)
+GOLD_QUERIES_FILE = os.path.join("benchmarks", "gold_queries.jsonl")
+# Liczba jedynek w każdym bajcie - do odległości Hamminga
+_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint16)
+
+
+def quantize_int8(vectors: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Symetryczna kwantyzacja skalarna per wektor: v ~= codes * scale.
+    """
+    scales = np.abs(vectors).max(axis=1) / 127.0
+    scales[scales == 0] = 1.0
+    codes = np.clip(np.rint(vectors / scales[:, None]), -127, 127).astype(np.int8)
+    return codes, scales.astype(np.float32)
+
+
+def quantize_binary(vectors: np.ndarray) -> np.ndarray:
+    """
+    Kwantyzacja binarna: 1 bit (znak) na wymiar, 32x mniej niż float32.
+    """
+    return np.packbits(vectors > 0, axis=1)
+
+
+class QuantizedIndex:
+    """
+    Skwantyzowane kopie wektorów kolekcji (int8 lub binarne) do pierwszego przejścia wyszukiwania.
+    Pliki .npy są mapowane w pamięci (mmap), więc do RAM trafiają tylko czytane strony.
+    """
+
+    def __init__(self, mode: str, dim: int, ids: List[str], doc_meta: List[Dict[str, Any]],
+                 codes: np.ndarray, scales: Optional[np.ndarray] = None, vectors: Optional[np.ndarray] = None,
+                 source_hash: Optional[str] = None):
+        self.mode = mode
+        self.dim = dim
+        self.ids = ids
+        self.doc_meta = doc_meta
+        self.codes = codes
+        self.scales = scales
+        # Kopia wektorów do rescoringu (mmap); None, jeśli jej nie zapisano
+        self.vectors = vectors
+        # chroma_utils.content_hash kolekcji, z której powstały kody (porównywany z manifestem)
+        self.source_hash = source_hash
+        self._rows = {node_id: row for row, node_id in enumerate(ids)}
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @property
+    def nbytes(self) -> int:
+        return self.codes.nbytes + (self.scales.nbytes if self.scales is not None else 0)
+
+    @property
+    def vectors_nbytes(self) -> int:
+        return self.vectors.nbytes if self.vectors is not None else 0
+
+    # --- Budowa / zapis / odczyt ---
+
+    @classmethod
+    def build_from_collection(cls, collection, mode: str, output_dir: str = QUANTIZED_DIR,
+                              rescore_copy: bool = RESCORE_SOURCE == "mmap") -> "QuantizedIndex":
+        """
+        Przegląda kolekcję stronami i zapisuje kody bezpośrednio do plików mmap (stała pamięć).
+        `rescore_copy` dopisuje kopię float16 do rescoringu z mmap.
+        """
+        if mode not in QUANTIZATION_MODES:
+            raise ValueError(f"Nieznany tryb kwantyzacji: {mode}")
+
+        total = collection.count()
+        if os.path.exists(output_dir):
+            shutil.rmtree(output_dir)
+        os.makedirs(output_dir)
+
+        ids: List[str] = []
+        doc_meta: List[Dict[str, Any]] = []
+        doc_hashes: List[Optional[str]] = []
+        codes = scales = floats = None
+        dim = 0
+        row = 0
+        for page in iter_collection(collection, include=["embeddings", "metadatas"]):
+            vectors = np.asarray(page["embeddings"], dtype=np.float32)
+            if codes is None:
+                dim = vectors.shape[1]
+                code_dim = dim if mode == "int8" else (dim + 7) // 8
+                code_dtype = np.int8 if mode == "int8" else np.uint8
+                if rescore_copy:
+                    floats = np.lib.format.open_memmap(
+                        os.path.join(output_dir, "vectors.npy"), mode="w+", dtype=np.float16, shape=(total, dim)
+                    )
+                codes = np.lib.format.open_memmap(
+                    os.path.join(output_dir, "codes.npy"), mode="w+", dtype=code_dtype, shape=(total, code_dim)
+                )
+                if mode == "int8":
+                    scales = np.lib.format.open_memmap(
+                        os.path.join(output_dir, "scales.npy"), mode="w+", dtype=np.float32, shape=(total,)
+                    )
+
+            n = len(vectors)
+            if floats is not None:
+                floats[row:row + n] = vectors
+            if mode == "int8":
+                codes[row:row + n], scales[row:row + n] = quantize_int8(vectors)
+            else:
+                codes[row:row + n] = quantize_binary(vectors)
+            row += n
+
+            ids.extend(page["ids"])
+            for meta in page["metadatas"]:
+                meta = meta or {}
+                doc_meta.append(filter_metadata(meta))
+                doc_hashes.append(meta.get("doc_hash"))
+
+        if codes is None:
+            raise RuntimeError("Kolekcja jest pusta - nie ma czego kwantyzować.")
+        codes.flush()
+        for array in (floats, scales):
+            if array is not None:
+                array.flush()
+
+        with open(os.path.join(output_dir, "meta.json"), 'w', encoding='utf-8') as f:
+            json.dump({"mode": mode, "dim": dim, "ids": ids, "doc_meta": doc_meta,
+                       "source_hash": content_hash(zip(ids, doc_hashes))}, f, ensure_ascii=False)
+
+        return cls.load(output_dir)
+
+    @classmethod
+    def load(cls, directory: str = QUANTIZED_DIR) -> "QuantizedIndex":
+        with open(os.path.join(directory, "meta.json"), 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        codes = np.load(os.path.join(directory, "codes.npy"), mmap_mode="r")
+        scales = None
+        if meta["mode"] == "int8":
+            scales = np.load(os.path.join(directory, "scales.npy"), mmap_mode="r")
+        vectors_path = os.path.join(directory, "vectors.npy")
+        vectors = np.load(vectors_path, mmap_mode="r") if os.path.exists(vectors_path) else None
+        return cls(meta["mode"], meta["dim"], meta["ids"], meta["doc_meta"], codes, scales, vectors,
+                   meta.get("source_hash"))
+
+    # --- Wyszukiwanie ---
+
+    def _scores(self, query: np.ndarray) -> np.ndarray:
+        scores = np.empty(len(self.ids), dtype=np.float32)
+        if self.mode == "int8":
+            for start in range(0, len(self.ids), SEARCH_CHUNK_ROWS):
+                chunk = self.codes[start:start + SEARCH_CHUNK_ROWS].astype(np.float32)
+                scores[start:start + len(chunk)] = (chunk @ query) * self.scales[start:start + len(chunk)]
+        else:
+            query_bits = quantize_binary(query[None, :])[0]
+            for start in range(0, len(self.ids), SEARCH_CHUNK_ROWS):
+                chunk = self.codes[start:start + SEARCH_CHUNK_ROWS]
+                hamming = _POPCOUNT[np.bitwise_xor(chunk, query_bits)].sum(axis=1)
+                # Mniejsza odległość Hamminga = większe podobieństwo
+                scores[start:start + len(chunk)] = -hamming.astype(np.float32)
+        return scores
+
+    def search(self, query_embedding, top_k: int, where: Optional[Dict[str, Any]] = None) -> List[str]:
+        """
+        Pierwsze (przybliżone) przejście: zwraca ID najlepszych kandydatów.
+        """
+        scores = self._scores(np.asarray(query_embedding, dtype=np.float32))
+        if where:
+            mask = np.fromiter((matches_where(m, where) for m in self.doc_meta), dtype=bool, count=len(self.ids))
+            scores[~mask] = -np.inf
+        top_k = min(top_k, len(self.ids))
+        candidates = np.argpartition(-scores, top_k - 1)[:top_k]
+        candidates = candidates[np.argsort(-scores[candidates])]
+        return [self.ids[i] for i in candidates if np.isfinite(scores[i])]
+
+
+def _embed_texts(result: Dict[str, Any]) -> List[str]:
+    """
+    Tekst dokładnie taki, jaki embedował build_rag_index.py: treść z nagłówkiem metadanych (MetadataMode.EMBED).
+    """
+    from llama_index.core.schema import MetadataMode
+    from llama_index.core.vector_stores.utils import metadata_dict_to_node
+
+    return [
+        metadata_dict_to_node(meta or {}, text=doc or "").get_content(metadata_mode=MetadataMode.EMBED)
+        for doc, meta in zip(result["documents"], result["metadatas"])
+    ]
+
+
+def rescore(collection, query_embedding, candidate_ids: List[str], top_k: int,
+            embed_model=None, index: Optional[QuantizedIndex] = None) -> List[Tuple[str, float]]:
+    """
+    Dokładne podobieństwo (iloczyn skalarny znormalizowanych wektorów) dla krótkiej listy kandydatów.
+    Wektory pełnej precyzji pochodzą z kopii mmap indeksu (`index`), z ChromaDB albo - jeśli podano
+    `embed_model` - są liczone na nowo z tekstów (wtedy pełne wektory nie muszą być w pamięci w ogóle).
+    """
+    if not candidate_ids:
+        return []
+    if index is not None and index.vectors is not None:
+        ids = [node_id for node_id in candidate_ids if node_id in index._rows]
+        rows = [index._rows[node_id] for node_id in ids]
+        vectors = np.asarray(index.vectors[rows], dtype=np.float32)
+    elif embed_model is not None:
+        result = collection.get(ids=candidate_ids, include=["documents", "metadatas"])
+        ids = result["ids"]
+        vectors = np.asarray(embed_model.get_text_embedding_batch(_embed_texts(result)), dtype=np.float32)
+    else:
+        result = collection.get(ids=candidate_ids, include=["embeddings"])
+        ids = result["ids"]
+        vectors = np.asarray(result["embeddings"], dtype=np.float32)
+
+    query = np.asarray(query_embedding, dtype=np.float32)
+    similarities = vectors @ query
+    order = np.argsort(-similarities)[:top_k]
+    return [(ids[i], float(similarities[i])) for i in order]
+
+
+# --- RAPORT ---
+
+def _dir_size(path: str) -> int:
+    total = 0
+    for root, _, files in os.walk(path):
+        total += sum(os.path.getsize(os.path.join(root, f)) for f in files)
+    return total
+
+
+def exact_top_k(collection, queries: np.ndarray, top_k: int) -> List[List[str]]:
+    """
+    Dokładne top-k (brute force po wszystkich wektorach float32), liczone stronami.
+    """
+    best_scores = np.full((len(queries), top_k), -np.inf, dtype=np.float32)
+    best_ids = np.empty((len(queries), top_k), dtype=object)
+    for page in iter_collection(collection, include=["embeddings"]):
+        vectors = np.asarray(page["embeddings"], dtype=np.float32)
+        page_ids = np.asarray(page["ids"], dtype=object)
+        scores = queries @ vectors.T
+        merged_scores = np.concatenate([best_scores, scores], axis=1)
+        merged_ids = np.concatenate([best_ids, np.broadcast_to(page_ids, scores.shape)], axis=1)
+        order = np.argsort(-merged_scores, axis=1)[:, :top_k]
+        best_scores = np.take_along_axis(merged_scores, order, axis=1)
+        best_ids = np.take_along_axis(merged_ids, order, axis=1)
+    return [list(row) for row in best_ids]
+
+
+def read_report_questions(queries_file: Optional[str]) -> Optional[List[str]]:
+    """
+    Pytania do raportu: plik tekstowy (jedno na linię) albo, domyślnie, zbiór wzorcowy benchmarku.
+    None, jeśli nie ma żadnego z nich.
+    """
+    if queries_file:
+        with open(queries_file, 'r', encoding='utf-8') as f:
+            return [line.strip() for line in f if line.strip()]
+    if os.path.exists(GOLD_QUERIES_FILE):
+        with open(GOLD_QUERIES_FILE, 'r', encoding='utf-8') as f:
+            return [json.loads(line)["query"] for line in f if line.strip()]
+    return None
+
+
+def load_report_queries(collection, queries_file: Optional[str], sample_size: int) -> np.ndarray:
+    questions = read_report_questions(queries_file)
+    if questions:
+        from llama_index.embeddings.huggingface import HuggingFaceEmbedding
+        from rag_retrieval import EMBED_MODEL_NAME
+
+        print(f"Embedowanie {len(questions)} zapytań z {queries_file or GOLD_QUERIES_FILE}...")
+        embed_model = HuggingFaceEmbedding(model_name=EMBED_MODEL_NAME, device="cpu")
+        return np.asarray([embed_model.get_query_embedding(q) for q in questions], dtype=np.float32)
+
+    # Bez pytań: próbka zapisanych wektorów jako zapytania zastępcze. Każde trafia dokładnie
+    # w swój węzeł, więc recall jest zawyżony - do porównań lepiej zbudować zbiór wzorcowy
+    print(f"Brak pliku zapytań i {GOLD_QUERIES_FILE} (benchmark_retrieval.py) - zapytania zastępcze "
+          f"z zapisanych wektorów, recall będzie zawyżony.")
+    page = collection.get(include=["embeddings"], limit=sample_size)
+    return np.asarray(page["embeddings"], dtype=np.float32)
+
+
+def _rescore_ram_note(index: QuantizedIndex, rescore_source: str, float_bytes: int) -> str:
+    if rescore_source == "chroma":
+        return (f"UWAGA: rescoring z Chromy wczytuje cały segment float32 (~{float_bytes / 2**20:.1f} MiB) - "
+                f"oszczędność RAM dotyczy tylko źródeł mmap i recompute")
+    if rescore_source == "recompute":
+        return "rescoring bez wektorów float32 (embedding kandydatów na nowo)"
+    return (f"rescoring z kopii mmap: w RAM tylko strony kandydatów "
+            f"(~{RESCORE_SHORTLIST * index.dim * index.vectors.dtype.itemsize / 1024:.0f} KiB na zapytanie)")
+
+
+def report(collection, index: QuantizedIndex, queries_file: Optional[str], top_k: int, sample_size: int,
+           rescore_source: str = "mmap"):
+    if rescore_source == "mmap" and index.vectors is None:
+        print(f"Brak kopii wektorów w {QUANTIZED_DIR} - rescoring z Chromy. "
+              f"Przebuduj kody (--build) z RAG_RESCORE_SOURCE=mmap, żeby używać mmap.")
+        rescore_source = "chroma"
+    embed_model = None
+    if rescore_source == "recompute":
+        from llama_index.embeddings.huggingface import HuggingFaceEmbedding
+        from rag_retrieval import EMBED_MODEL_NAME
+        embed_model = HuggingFaceEmbedding(model_name=EMBED_MODEL_NAME, device="cpu")
+
+    n = len(index)
+    float_bytes = n * index.dim * 4
+    quantized_disk = _dir_size(QUANTIZED_DIR)
+    print("\n" + "=" * 50)
+    print(f"--- RAPORT KWANTYZACJI ({index.mode}, rescoring: {rescore_source}) ---")
+    print(f"Węzły: {n} | wymiar: {index.dim}")
+    print(f"Wektory float32 w RAM: {float_bytes / 2**20:.1f} MiB")
+    print(f"Kody {index.mode} w RAM:  {index.nbytes / 2**20:.1f} MiB "
+          f"({float_bytes / max(index.nbytes, 1):.1f}x mniej)")
+    print(_rescore_ram_note(index, rescore_source, float_bytes))
+    # Chroma trzyma swój segment float32 niezależnie od kodów - skwantyzowany indeks to dodatkowe
+    # miejsce na dysku, a oszczędność dotyczy RAM w czasie wyszukiwania
+    print(f"Dysk: skwantyzowany indeks {quantized_disk / 2**20:.1f} MiB "
+          f"(w tym kopia do rescoringu {index.vectors_nbytes / 2**20:.1f} MiB) - DODATKOWO do "
+          f"chroma_db {(_dir_size(DB_DIRECTORY) - quantized_disk) / 2**20:.1f} MiB, "
+          f"razem {_dir_size(DB_DIRECTORY) / 2**20:.1f} MiB")
+
+    queries = load_report_queries(collection, queries_file, sample_size)
+    exact = exact_top_k(collection, queries, top_k)
+
+    recall_first_pass = 0.0
+    recall_rescored = 0.0
+    latencies = []
+    for query, gold in zip(queries, exact):
+        gold_set = set(gold)
+        started = time.perf_counter()
+        shortlist = index.search(query, RESCORE_SHORTLIST)
+        rescored = [node_id for node_id, _ in rescore(
+            collection, query, shortlist, top_k, embed_model=embed_model,
+            index=index if rescore_source == "mmap" else None,
+        )]
+        latencies.append(time.perf_counter() - started)
+
+        recall_first_pass += len(gold_set & set(shortlist[:top_k])) / top_k
+        recall_rescored += len(gold_set & set(rescored)) / top_k
+
+    n_queries = max(len(queries), 1)
+    latencies.sort()
+    print("-" * 50)
+    print(f"Zapytania: {len(queries)} | top_k = {top_k} | shortlist = {RESCORE_SHORTLIST}")
+    print(f"Recall@{top_k} (tylko {index.mode}):      {recall_first_pass / n_queries:.3f}")
+    print(f"Recall@{top_k} ({index.mode} + rescoring): {recall_rescored / n_queries:.3f}")
+    print(f"Delta recall vs float32:          {recall_rescored / n_queries - 1.0:+.3f}")
+    if latencies:
+        print(f"Opóźnienie p50: {latencies[len(latencies) // 2] * 1000:.1f} ms")
+    print("=" * 50)
+
+
+if __name__ == "__main__":
+    import chromadb
+
+    parser = argparse.ArgumentParser(description="Skwantyzowane kopie wektorów bomba_lore + raport oszczędności.")
+    parser.add_argument("--build", choices=QUANTIZATION_MODES, help="Zbuduj kody w wybranym trybie.")
+    parser.add_argument("--report", action="store_true", help="Raport pamięci, dysku i recall vs float32.")
+    parser.add_argument("--queries", help=f"Plik z zapytaniami (jedno na linię) do pomiaru recall; "
+                                          f"domyślnie {GOLD_QUERIES_FILE}, jeśli istnieje.")
+    parser.add_argument("--top-k", type=int, default=3)
+    parser.add_argument("--rescore-source", choices=RESCORE_SOURCES, default=RESCORE_SOURCE,
+                        help="Skąd brać wektory pełnej precyzji do rescoringu w raporcie.")
+    parser.add_argument("--sample", type=int, default=200,
+                        help="Ile zapisanych wektorów użyć jako zapytań, gdy nie ma pliku zapytań.")
+    args = parser.parse_args()
+
+    db = chromadb.PersistentClient(path=DB_DIRECTORY)
+    chroma_collection = db.get_collection(COLLECTION_NAME)
+
+    if args.build:
+        print(f"Kwantyzacja {chroma_collection.count()} wektorów ({args.build})...")
+        quantized = QuantizedIndex.build_from_collection(chroma_collection, args.build)
+        print(f"Zapisano kody do {QUANTIZED_DIR}")
+    elif os.path.exists(QUANTIZED_DIR):
+        quantized = QuantizedIndex.load(QUANTIZED_DIR)
+    else:
+        print(f"BŁĄD: Brak kodów w {QUANTIZED_DIR}. Użyj --build int8|binary.", file=sys.stderr)
+        sys.exit(1)
+
+    if args.report:
+        report(chroma_collection, quantized, args.queries, args.top_k, args.sample, args.rescore_source)
@@ -0,0 +1,443 @@
+import json
+import math
+import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Tuple
+
+import chromadb
+from llama_index.core import QueryBundle
+from llama_index.core.retrievers import BaseRetriever
+from llama_index.core.schema import NodeWithScore
+from llama_index.core.vector_stores import VectorStoreQuery
+from llama_index.core.vector_stores.utils import metadata_dict_to_node
+from llama_index.vector_stores.chroma import ChromaVectorStore
+from llama_index.embeddings.huggingface import HuggingFaceEmbedding
+
+from bm25_index import BM25Index, episode_flag, normalize_tokens
+from chroma_utils import HNSW_SEARCH_EF, collection_hnsw
+from quantized_index import QUANTIZED_DIR, RESCORE_SHORTLIST, RESCORE_SOURCE, QuantizedIndex, rescore
+
+# --- KONFIGURACJA ---
+DB_DIRECTORY = "./chroma_db"
+COLLECTION_NAME = "bomba_lore"
+EMBED_MODEL_NAME = "sdadas/mmlw-retrieval-roberta-large"
+# Indeks BM25 i katalog lore zapisywane przez build_rag_index.py obok bazy Chroma
+BM25_INDEX_FILE = os.path.join(DB_DIRECTORY, "bm25_index.json.gz")
+LORE_CATALOG_FILE = os.path.join(DB_DIRECTORY, "lore_catalog.json")
+# Manifest build_rag_index.py - stąd hash treści, z którym porównujemy skwantyzowane kody
+MANIFEST_FILE = os.path.join(DB_DIRECTORY, "index_manifest.json")
+
+SIMILARITY_TOP_K = 3
+# Ilu kandydatów bierze każda ścieżka (gęsta i leksykalna) przed fuzją
+CANDIDATE_TOP_K = 10
+# Stała Reciprocal Rank Fusion (wartość z oryginalnej pracy Cormack et al.)
+RRF_K = 60
+
+# Reranking cross-encoderem (opcjonalny, na CPU)
+USE_RERANKER = os.getenv("RAG_RERANK", "0") == "1"
+RERANK_MODEL_NAME = "sdadas/polish-reranker-base-ranknet"
+RERANK_MAX_LENGTH = 512
+# Ilu najlepszych kandydatów po fuzji trafia do cross-encodera
+RERANK_CANDIDATES = 12
+RERANK_LATENCY_BUDGET_MS = float(os.getenv("RAG_RERANK_BUDGET_MS", "250"))
+# Różnica podobieństwa cosinusowego top-1 vs top-2, przy której uznajemy wynik za pewny.
+# Obie ścieżki gęste podają wynik w tej samej skali: rescoring skwantyzowany liczy iloczyn
+# skalarny znormalizowanych wektorów (= cosinus), a wynik Chromy jest przeliczany z odległości
+# przez _chroma_cosine().
+RERANK_SKIP_MARGIN = 0.08
+
+# Pierwsze przejście po skwantyzowanych kopiach wektorów (quantized_index.py) zamiast HNSW Chromy
+USE_QUANTIZED_INDEX = os.getenv("RAG_QUANTIZED", "0") == "1"
+
+
+# --- ROUTER ZAPYTAŃ ---
+
+EPISODE_RE = re.compile(r"\b(?:odcin\w*|odc\.?|epizod\w*)\s*(?:nr\.?|numer)?\s*(\d+)", re.IGNORECASE)
+WHO_SAID_RE = re.compile(
+    r"\b(?:kto\s+(?:to\s+)?(?:powiedzia\w*|mówi\w*|rzek\w*|krzycza\w*|krzykn\w*|woła\w*)"
+    r"|czyj\w*\s+(?:to\s+)?(?:słowa|tekst\w*|cytat\w*|kwesti\w*))",
+    re.IGNORECASE,
+)
+PROFILE_RE = re.compile(r"\b(?:kim\s+(?:jest|był\w*)|jak\w*\s+(?:jest|był\w*)|opisz|cechy|charakter\w*)",
+                        re.IGNORECASE)
+QUOTE_RE = re.compile(r"\b(?:co\s+(?:mówi\w*|powiedzia\w*|gada\w*)|cytat\w*|teksty?\b)", re.IGNORECASE)
+
+
+@dataclass
+class QueryRoute:
+    """
+    Wynik routingu: filtr `where` w składni ChromaDB i krótki opis (do logów).
+    """
+    where: Optional[Dict[str, Any]]
+    label: str
+
+
+def _name_stem(token: str) -> str:
+    # Odcinamy końcówkę fleksyjną: "torpeda" -> "torpe" (pasuje do "Torpedy", "Torpedzie")
+    return token[:max(4, len(token) - 2)]
+
+
+class QueryRouter:
+    """
+    Lekki router regułowy: wykrywa numer odcinka, pytania "kto powiedział"
+    oraz postacie z katalogu i zamienia je na filtry metadanych.
+    """
+
+    def __init__(self, characters: List[str], episodes: List[str], episode_flags: bool = False):
+        self.episodes = set(episodes)
+        # Indeks z flagami odcinków: filtr obejmuje też duplikaty scalone z innych odcinków
+        self.episode_flags = episode_flags
+        self.characters = list(characters)
+        # Najdłuższe nazwy sprawdzamy najpierw ("Kapitan Bomba" przed "Bomba")
+        self._characters: List[Tuple[str, List[str]]] = sorted(
+            ((name, [_name_stem(t) for t in normalize_tokens(name)]) for name in characters),
+            key=lambda item: len(item[1]),
+            reverse=True,
+        )
+
+    @classmethod
+    def from_file(cls, path: str = LORE_CATALOG_FILE) -> "QueryRouter":
+        with open(path, 'r', encoding='utf-8') as f:
+            catalog = json.load(f)
+        return cls(catalog.get("characters", []), catalog.get("episodes", []), catalog.get("episode_flags", False))
+
+    def detect_character(self, question: str) -> Optional[str]:
+        tokens = normalize_tokens(question)
+        for name, stems in self._characters:
+            if stems and all(any(t.startswith(stem) for t in tokens) for stem in stems):
+                return name
+        return None
+
+    def route(self, question: str) -> QueryRoute:
+        conditions = []
+        labels = []
+
+        episode_match = EPISODE_RE.search(question)
+        if episode_match and (not self.episodes or episode_match.group(1) in self.episodes):
+            episode_id = episode_match.group(1)
+            conditions.append({episode_flag(episode_id): True} if self.episode_flags else {"episode_id": episode_id})
+            labels.append(f"odcinek {episode_id}")
+
+        if WHO_SAID_RE.search(question):
+            conditions.append({"type": "quote"})
+            labels.append("kto powiedział")
+        else:
+            character = self.detect_character(question)
+            if character and PROFILE_RE.search(question):
+                conditions.append({"type": "character_profile"})
+                conditions.append({"character": character})
+                labels.append(f"profil: {character}")
+            elif character and QUOTE_RE.search(question):
+                conditions.append({"type": "quote"})
+                conditions.append({"speaker": character})
+                labels.append(f"cytaty: {character}")
+
+        if not conditions:
+            return QueryRoute(where=None, label="bez filtra")
+        where = conditions[0] if len(conditions) == 1 else {"$and": conditions}
+        return QueryRoute(where=where, label=", ".join(labels))
+
+
+# --- RETRIEVER HYBRYDOWY ---
+
+def _chroma_cosine(similarity: float, space: str) -> float:
+    """
+    Odwraca przekształcenie ChromaVectorStore (similarity = exp(-odległość)) i zamienia odległość
+    Chromy na podobieństwo cosinusowe znormalizowanych wektorów: l2 to kwadrat odległości
+    euklidesowej (2 - 2cos), a cosine/ip to 1 - cos.
+    """
+    distance = -math.log(max(similarity, 1e-12))
+    return 1.0 - distance / 2.0 if space == "l2" else 1.0 - distance
+
+
+def _fetch_nodes(chroma_collection, node_ids: List[str]) -> Dict[str, NodeWithScore]:
+    """
+    Dociąga z ChromaDB węzły znalezione wyłącznie przez BM25.
+    """
+    if not node_ids:
+        return {}
+    result = chroma_collection.get(ids=node_ids, include=["documents", "metadatas"])
+    nodes = {}
+    for node_id, text, metadata in zip(result["ids"], result["documents"], result["metadatas"]):
+        node = metadata_dict_to_node(metadata, text=text)
+        nodes[node_id] = NodeWithScore(node=node, score=0.0)
+    return nodes
+
+
+class CrossEncoderReranker:
+    """
+    Reranking par (pytanie, kandydat) polskim cross-encoderem na CPU - jeden batch na zapytanie.
+    Pilnuje budżetu opóźnienia: na podstawie zmierzonego czasu na parę ogranicza liczbę kandydatów.
+    """
+
+    def __init__(self, model_name: str = RERANK_MODEL_NAME, latency_budget_ms: float = RERANK_LATENCY_BUDGET_MS):
+        print(f"Ładowanie cross-encodera (na CPU): {model_name}")
+        # Import tutaj - torch i sentence-transformers tylko wtedy, gdy reranker jest włączony
+        from sentence_transformers import CrossEncoder
+
+        self.model = CrossEncoder(model_name, device="cpu", max_length=RERANK_MAX_LENGTH)
+        self.latency_budget_s = latency_budget_ms / 1000.0
+        # Średnia krocząca czasu na parę; None = jeszcze nie mierzono
+        self.seconds_per_pair: Optional[float] = None
+
+    def max_pairs(self, requested: int) -> int:
+        if self.seconds_per_pair is None:
+            return requested
+        return min(requested, int(self.latency_budget_s / self.seconds_per_pair))
+
+    def rerank(self, query: str, candidates: List[NodeWithScore]) -> List[NodeWithScore]:
+        started = time.perf_counter()
+        pairs = [(query, candidate.node.get_content()) for candidate in candidates]
+        scores = self.model.predict(pairs, batch_size=len(pairs), show_progress_bar=False)
+
+        per_pair = (time.perf_counter() - started) / len(pairs)
+        self.seconds_per_pair = per_pair if self.seconds_per_pair is None else \
+            0.7 * self.seconds_per_pair + 0.3 * per_pair
+
+        reranked = [NodeWithScore(node=c.node, score=float(score)) for c, score in zip(candidates, scores)]
+        return sorted(reranked, key=lambda item: item.score, reverse=True)
+
+
+@dataclass
+class _SearchResult:
+    ranking: List[str]
+    fused: Dict[str, float]
+    nodes: Dict[str, NodeWithScore]
+    dense_hits: List[Tuple[str, float]]
+    lexical_hits: List[Tuple[str, float]]
+
+
+class HybridRetriever(BaseRetriever):
+    """
+    Łączy wyszukiwanie gęste (embeddingi) i leksykalne (BM25) przez Reciprocal Rank Fusion.
+    Nazwy własne z serialu ("Kurvinox", "RKS Huwdu") trafia BM25, parafrazy - embeddingi.
+    Bez modelu embeddingów działa jako czysto leksykalny fallback.
+    Jeśli podano router, obie ścieżki przeszukują tylko węzły pasujące do filtra metadanych.
+    Opcjonalny reranker przestawia szerszą listę kandydatów, zanim zostanie przycięta do top_k.
+    """
+
+    def __init__(self, chroma_collection, vector_store: Optional[ChromaVectorStore], embed_model,
+                 bm25: Optional[BM25Index], router: Optional[QueryRouter] = None,
+                 top_k: int = SIMILARITY_TOP_K, candidate_k: int = CANDIDATE_TOP_K, rrf_k: int = RRF_K,
+                 quantized: Optional[QuantizedIndex] = None, rescore_source: str = RESCORE_SOURCE,
+                 reranker: Optional[CrossEncoderReranker] = None, rerank_candidates: int = RERANK_CANDIDATES):
+        super().__init__()
+        self.chroma_collection = chroma_collection
+        # Metryka HNSW - potrzebna, żeby sprowadzić wyniki Chromy do podobieństwa cosinusowego
+        self.hnsw_space = collection_hnsw(chroma_collection)["hnsw:space"]
+        self.vector_store = vector_store
+        self.embed_model = embed_model
+        self.bm25 = bm25
+        self.quantized = quantized
+        self.rescore_source = rescore_source
+        self.router = router
+        self.reranker = reranker
+        self.rerank_candidates = rerank_candidates
+        self.top_k = top_k
+        self.candidate_k = candidate_k
+        self.rrf_k = rrf_k
+        self.last_route: Optional[QueryRoute] = None
+        self.last_rerank: str = "wyłączony"
+        # Czasy etapów ostatniego zapytania (benchmark_retrieval.py, logi)
+        self.last_timings: Dict[str, float] = {}
+        # Czasy ładowania składników (ustawia load_retriever)
+        self.load_timings: Dict[str, float] = {}
+
+    def _search(self, query: str, query_embedding: Optional[List[float]],
+                where: Optional[Dict[str, Any]]) -> _SearchResult:
+        nodes: Dict[str, NodeWithScore] = {}
+        dense_hits: List[Tuple[str, float]] = []
+        lexical_hits: List[Tuple[str, float]] = []
+
+        if query_embedding is not None and self.quantized is not None:
+            shortlist = self.quantized.search(query_embedding, max(RESCORE_SHORTLIST, self.candidate_k), where)
+            dense_hits = rescore(
+                self.chroma_collection, query_embedding, shortlist, self.candidate_k,
+                embed_model=self.embed_model if self.rescore_source == "recompute" else None,
+                index=self.quantized if self.rescore_source == "mmap" else None,
+            )
+        elif query_embedding is not None:
+            result = self.vector_store.query(
+                VectorStoreQuery(query_embedding=query_embedding, similarity_top_k=self.candidate_k),
+                where=where,
+            )
+            for node, similarity in zip(result.nodes or [], result.similarities or []):
+                nodes[node.node_id] = NodeWithScore(node=node, score=similarity)
+                dense_hits.append((node.node_id, _chroma_cosine(similarity, self.hnsw_space)))
+
+        if self.bm25 is not None:
+            lexical_hits = self.bm25.search(query, self.candidate_k, where=where)
+
+        fused: Dict[str, float] = {}
+        for hits in (dense_hits, lexical_hits):
+            for rank, (node_id, _) in enumerate(hits):
+                fused[node_id] = fused.get(node_id, 0.0) + 1.0 / (self.rrf_k + rank + 1)
+
+        ranking = sorted(fused, key=fused.get, reverse=True)
+        return _SearchResult(ranking, fused, nodes, dense_hits, lexical_hits)
+
+    def _rerank_pool_size(self, result: _SearchResult) -> int:
+        """
+        Ilu kandydatów oddać rerankerowi (0 = pomiń reranking) i dlaczego.
+        """
+        if self.reranker is None:
+            self.last_rerank = "wyłączony"
+            return 0
+
+        # Skrót "pewny wynik": obie ścieżki zgodne co do zwycięzcy albo wyraźna przewaga w embeddingach
+        dense, lexical = result.dense_hits, result.lexical_hits
+        if dense and lexical and dense[0][0] == lexical[0][0]:
+            self.last_rerank = "pominięty (gęsty i BM25 zgodne)"
+            return 0
+        if len(dense) >= 2 and dense[0][1] - dense[1][1] >= RERANK_SKIP_MARGIN:
+            self.last_rerank = "pominięty (wyraźny zwycięzca)"
+            return 0
+
+        pool = self.reranker.max_pairs(min(self.rerank_candidates, len(result.ranking)))
+        if pool <= self.top_k:
+            self.last_rerank = "pominięty (budżet opóźnienia)"
+            return 0
+        self.last_rerank = f"{pool} kandydatów"
+        return pool
+
+    def _retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        query = query_bundle.query_str
+        started = time.perf_counter()
+        query_embedding = None
+        if self.embed_model is not None:
+            query_embedding = self.embed_model.get_query_embedding(query)
+        embedded = time.perf_counter()
+
+        route = self.router.route(query) if self.router else QueryRoute(where=None, label="bez routera")
+        self.last_route = route
+
+        result = self._search(query, query_embedding, route.where)
+        fused, nodes = result.fused, result.nodes
+        rerank_pool = self._rerank_pool_size(result)
+        best_ids = result.ranking[:max(self.top_k, rerank_pool)]
+
+        if route.where is not None and len(best_ids) < self.top_k:
+            # Filtr okazał się zbyt wąski - uzupełniamy wynikami bez filtra
+            extra = self._search(query, query_embedding, None)
+            for node_id in extra.ranking:
+                if len(best_ids) >= self.top_k:
+                    break
+                if node_id not in fused:
+                    best_ids.append(node_id)
+                    fused[node_id] = extra.fused[node_id]
+                    if node_id in extra.nodes:
+                        nodes[node_id] = extra.nodes[node_id]
+
+        nodes.update(_fetch_nodes(self.chroma_collection, [i for i in best_ids if i not in nodes]))
+        candidates = [
+            NodeWithScore(node=nodes[node_id].node, score=fused[node_id])
+            for node_id in best_ids if node_id in nodes
+        ]
+
+        searched = time.perf_counter()
+        if rerank_pool:
+            candidates = self.reranker.rerank(query, candidates)
+
+        self.last_timings = {
+            "embed_s": embedded - started,
+            "search_s": searched - embedded,
+            "rerank_s": time.perf_counter() - searched,
+        }
+        return candidates[:self.top_k]
+
+
+def _indexed_content_hash() -> Optional[str]:
+    if not os.path.exists(MANIFEST_FILE):
+        return None
+    with open(MANIFEST_FILE, 'r', encoding='utf-8') as f:
+        return json.load(f).get("content_hash")
+
+
+def _timed(fn, *args, **kwargs):
+    started = time.perf_counter()
+    return fn(*args, **kwargs), time.perf_counter() - started
+
+
+def load_retriever(use_embeddings: bool = True, top_k: int = SIMILARITY_TOP_K,
+                   use_router: bool = True, use_reranker: bool = USE_RERANKER) -> HybridRetriever:
+    """
+    Łączy się z bazą ChromaDB i buduje retriever RAG (embeddingi na CPU + BM25 z dysku).
+    Tylko czyta bazę - parametry HNSW (także search_ef) zmieniają build_rag_index.py i tune_hnsw.py --apply.
+    Modele (embeddingi, reranker) ładują się w tle, równolegle z otwieraniem bazy i indeksów.
+    Czasy etapów trafiają do `retriever.load_timings`.
+    """
+    pool = ThreadPoolExecutor(max_workers=2)
+    embed_future = None
+    if use_embeddings:
+        print(f"Ładowanie modelu embeddingów (na CPU): {EMBED_MODEL_NAME}")
+        embed_future = pool.submit(_timed, HuggingFaceEmbedding, model_name=EMBED_MODEL_NAME, device="cpu")
+    reranker_future = pool.submit(_timed, CrossEncoderReranker) if use_reranker else None
+    pool.shutdown(wait=False)
+
+    stores_started = time.perf_counter()
+    print(f"Ładowanie bazy wektorowej RAG z: {DB_DIRECTORY}")
+    db = chromadb.PersistentClient(path=DB_DIRECTORY)
+    chroma_collection = db.get_collection(COLLECTION_NAME)
+    hnsw_params = collection_hnsw(chroma_collection)
+    print(f"HNSW: metryka {hnsw_params['hnsw:space']}, M = {hnsw_params['hnsw:M']}, "
+          f"search_ef = {hnsw_params['hnsw:search_ef']}")
+    if os.getenv("RAG_HNSW_SEARCH_EF") and HNSW_SEARCH_EF != hnsw_params["hnsw:search_ef"]:
+        # Zmienna opisuje budowę indeksu; czytelnik nie zmienia współdzielonej kolekcji
+        print(f"RAG_HNSW_SEARCH_EF = {HNSW_SEARCH_EF} nie obowiązuje w kolekcji - zastosuj go przez "
+              f"build_rag_index.py --incremental albo tune_hnsw.py --apply.")
+
+    bm25 = None
+    if os.path.exists(BM25_INDEX_FILE):
+        bm25 = BM25Index.load(BM25_INDEX_FILE)
+        print(f"Indeks BM25 załadowany ({len(bm25)} węzłów).")
+    else:
+        print(f"Brak indeksu BM25 ({BM25_INDEX_FILE}) - tylko wyszukiwanie wektorowe.")
+
+    router = None
+    if use_router and os.path.exists(LORE_CATALOG_FILE):
+        router = QueryRouter.from_file(LORE_CATALOG_FILE)
+        print(f"Router zapytań: {len(router.characters)} postaci, {len(router.episodes)} odcinków.")
+
+    quantized = None
+    if use_embeddings and USE_QUANTIZED_INDEX:
+        if os.path.exists(QUANTIZED_DIR):
+            quantized = QuantizedIndex.load(QUANTIZED_DIR)
+            # Sama liczba węzłów nie wystarcza: przebudowa przyrostowa może zmienić treść przy tej samej liczbie
+            if quantized.source_hash is None or quantized.source_hash != _indexed_content_hash():
+                print(f"Kody w {QUANTIZED_DIR} nie pasują do treści indeksu (manifest) - używam HNSW Chromy. "
+                      f"Przebuduj kody: quantized_index.py --build {quantized.mode}.")
+                quantized = None
+            else:
+                print(f"Skwantyzowany indeks {quantized.mode} załadowany "
+                      f"({quantized.nbytes / 2**20:.1f} MiB, rescoring: {RESCORE_SOURCE}).")
+                if RESCORE_SOURCE == "mmap" and quantized.vectors is None:
+                    print(f"Brak kopii wektorów w {QUANTIZED_DIR} - rescoring z Chromy (cały segment float32 "
+                          f"w RAM). Przebuduj kody: quantized_index.py --build {quantized.mode}.")
+        else:
+            print(f"Brak kodów w {QUANTIZED_DIR} - uruchom quantized_index.py --build int8|binary.")
+
+    vector_store = None
+    if use_embeddings and quantized is None:
+        vector_store = ChromaVectorStore(chroma_collection=chroma_collection)
+    elif not use_embeddings and bm25 is None:
+        raise RuntimeError("Bez modelu embeddingów potrzebny jest indeks BM25 - uruchom build_rag_index.py.")
+    load_timings = {"stores_s": time.perf_counter() - stores_started}
+
+    embed_model = None
+    if embed_future is not None:
+        embed_model, load_timings["embed_model_s"] = embed_future.result()
+    reranker = None
+    if reranker_future is not None:
+        reranker, load_timings["reranker_s"] = reranker_future.result()
+
+    print(f"Inicjalizacja retrievera RAG z top_k = {top_k} "
+          f"(gęsty: {'tak' if embed_model else 'nie'}, BM25: {'tak' if bm25 else 'nie'}, "
+          f"reranker: {'tak' if reranker else 'nie'})")
+    retriever = HybridRetriever(chroma_collection, vector_store, embed_model, bm25, router, top_k=top_k,
+                                quantized=quantized, reranker=reranker)
+    retriever.load_timings = load_timings
+    print("✅ Baza RAG gotowa.")
+    return retriever
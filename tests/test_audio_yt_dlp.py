@@ -0,0 +1,87 @@
+import functools
+import importlib.util
+import os
+import threading
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+pytest.importorskip("yt_dlp")
+pytest.importorskip("dotenv")
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class _QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def audio_module(tmp_path, monkeypatch):
+    """
+    Świeżo załadowany audio_yt-dlp.py (konfiguracja czytana z env przy imporcie), bez ciasteczek.
+    """
+    monkeypatch.setenv("AUDIO_SET", str(tmp_path / "audio"))
+    monkeypatch.setenv("YTDLP_ARCHIVE", str(tmp_path / "audio" / "download_archive.txt"))
+    monkeypatch.setenv("YTDLP_COOKIES_BROWSER", "")
+    spec = importlib.util.spec_from_file_location("audio_yt_dlp", os.path.join(REPO_DIR, "audio_yt-dlp.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture
+def file_server(tmp_path):
+    served_dir = tmp_path / "served"
+    served_dir.mkdir()
+    (served_dir / "odcinek01.m4a").write_bytes(os.urandom(64 * 1024))
+    server = ThreadingHTTPServer(("127.0.0.1", 0), functools.partial(_QuietHandler, directory=str(served_dir)))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_port}"
+    server.shutdown()
+
+
+def test_second_run_skips_archived_download(audio_module, file_server, tmp_path):
+    link = f"{file_server}/odcinek01.m4a"
+
+    assert audio_module.audio_yt_dlp(link, keep_native=True, workers=1) == 0
+    downloaded = [name for name in os.listdir(tmp_path / "audio") if name != "download_archive.txt"]
+    assert len(downloaded) == 1
+    assert audio_module._read_archive() == {"generic odcinek01"}
+
+    os.remove(tmp_path / "audio" / downloaded[0])
+    assert audio_module.audio_yt_dlp(link, keep_native=True, workers=1) == 0
+    assert os.listdir(tmp_path / "audio") == ["download_archive.txt"]
+
+
+def test_flat_playlist_prefilter_drops_archived_entries(audio_module, monkeypatch, tmp_path):
+    os.makedirs(tmp_path / "audio")
+    with open(audio_module.DOWNLOAD_ARCHIVE, "w", encoding="utf-8") as f:
+        f.write("youtube aaa\n")
+
+    class FlatPlaylist:
+        # Płaska playlista jak z extract_flat="in_playlist": same ID i adresy, bez pobierania
+        def __init__(self, opts):
+            assert opts["extract_flat"] == "in_playlist"
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *exc):
+            return False
+
+        def extract_info(self, link, download):
+            assert download is False
+            return {"entries": [
+                {"ie_key": "Youtube", "id": "aaa", "url": "https://youtu.be/aaa"},
+                None,
+                {"ie_key": "Youtube", "id": "bbb", "url": "https://youtu.be/bbb"},
+                {"id": "ccc", "webpage_url": "https://example.com/ccc"},
+            ]}
+
+    monkeypatch.setattr(audio_module, "YoutubeDL", FlatPlaylist)
+
+    items = audio_module.list_items("https://www.youtube.com/playlist?list=x", audio_module._ydl_opts(True))
+
+    assert items == ["https://youtu.be/bbb", "https://example.com/ccc"]
@@ -0,0 +1,63 @@
+from bm25_index import QUOTED_TEXT_RE, BM25Index, episode_flag, filter_metadata, matches_where, tokenize
+
+DOCS = [
+    ("q1", "Kurvinox powiedział: \"Torpeda, strzelaj!\"", {"type": "quote", "speaker": "Kurvinox", "episode_id": "S01E01"}),
+    ("q2", "Titus: \"Kurvinoxa znowu nie ma na mostku\"", {"type": "quote", "speaker": "Titus", "episode_id": "S01E02"}),
+    ("f1", "Fakt: Udasha pilotuje statek Bombardiera", {"type": "lore_fact", "episode_id": "S01E02"}),
+]
+
+
+def test_tokenize_strips_diacritics_stopwords_and_inflection():
+    assert tokenize("Kurvinoxów nie ma na mostku, łódź") == ["kurvin", "ma", "mostku", "lodz"]
+    assert tokenize("Kurvinox")[0] == tokenize("Kurvinoxa")[0]
+
+
+def test_search_ranks_matching_documents_and_respects_where():
+    index = BM25Index.build(DOCS)
+
+    # "Kurvinox" i "Kurvinoxa" mają wspólny prefiks, więc trafiają oba cytaty
+    assert {doc_id for doc_id, _ in index.search("Kurvinox", top_k=5)} == {"q1", "q2"}
+    assert index.search("Udasha statek", top_k=5)[0][0] == "f1"
+    assert index.search("Kurvinox", top_k=5, where={"speaker": "Titus"})[0][0] == "q2"
+    assert [doc_id for doc_id, _ in index.search("statek", top_k=5, where={"type": {"$in": ["quote"]}})] == []
+    assert index.search("zupełnie obce słowo", top_k=5) == []
+
+
+def test_matches_where_operators():
+    meta = {"type": "quote", "episode_id": "S01E02"}
+
+    assert matches_where(meta, None)
+    assert matches_where(meta, {"$and": [{"type": "quote"}, {"episode_id": {"$eq": "S01E02"}}]})
+    assert matches_where(meta, {"$or": [{"type": "lore_fact"}, {"episode_id": {"$in": ["S01E02"]}}]})
+    assert not matches_where(meta, {"$and": [{"type": "quote"}, {"episode_id": "S01E01"}]})
+
+
+def test_save_load_round_trip(tmp_path):
+    index = BM25Index.build(DOCS)
+    path = str(tmp_path / "bm25.json.gz")
+
+    index.save(path)
+    loaded = BM25Index.load(path)
+
+    assert loaded.doc_ids == index.doc_ids
+    assert loaded.postings == index.postings
+    assert loaded.doc_meta == index.doc_meta
+    for query in ("Kurvinox", "Udasha statek"):
+        assert loaded.search(query, top_k=3) == index.search(query, top_k=3)
+
+
+def test_episode_flags_filter_merged_duplicates():
+    # Cytat scalony z odcinków 1 i 7 - reprezentant ma episode_id "1", ale flagi obu odcinków
+    merged = {"type": "quote", "episode_id": "1", "episode_ids": "1,7", "ep_1": True, "ep_7": True, "title": "x"}
+    index = BM25Index.build([("q", "Torpeda, strzelaj!", merged), ("f", "Torpeda w odcinku siódmym", {"ep_3": True})])
+
+    assert filter_metadata(merged) == {"type": "quote", "episode_id": "1", "ep_1": True, "ep_7": True}
+    assert [doc_id for doc_id, _ in index.search("Torpeda", top_k=5, where={episode_flag("7"): True})] == ["q"]
+    assert [doc_id for doc_id, _ in index.search("Torpeda", top_k=5, where={episode_flag("3"): True})] == ["f"]
+
+
+def test_quoted_text_ignores_quotes_inside_context():
+    text = 'Kurvinox powiedział: "Torpeda, "ognia"!" (Kontekst: do "Titusa" na mostku)'
+
+    assert QUOTED_TEXT_RE.search(text).group(1) == 'Torpeda, "ognia"!'
+    assert QUOTED_TEXT_RE.search('Cytat z uniwersum: "Strzelaj"').group(1) == "Strzelaj"
@@ -0,0 +1,87 @@
+import pytest
+
+# Moduł importuje klienta Gemini i pydantic na poziomie modułu
+pytest.importorskip("google.genai")
+pytest.importorskip("pydantic")
+pytest.importorskip("tqdm")
+pytest.importorskip("dotenv")
+
+from build_encyclopedia import (AttributedQuote, CharacterAction, EpisodeAnalysis, LoreFact,  # noqa: E402
+                                QuotesAnalysis, merge_analyses, split_into_windows)
+
+
+def _segments(end_s, length_s=10.0):
+    return [{"start": float(t), "end": float(t + length_s), "text": f"seg {t}"}
+            for t in range(0, int(end_s), int(length_s))]
+
+
+def _bounds(window):
+    return window[0]["start"], window[-1]["end"]
+
+
+def test_windows_overlap_and_last_partial_window():
+    windows = split_into_windows(_segments(700), window_s=300, overlap_s=30)
+
+    # Krok 270 s: [0, 300), [270, 570), [540, 840) - ostatnie okno jest niepełne (odcinek kończy się na 700 s)
+    assert [_bounds(w) for w in windows] == [(0.0, 300.0), (270.0, 570.0), (540.0, 700.0)]
+    # Segmenty ze strefy nakładania (270-300 s) są w obu sąsiednich oknach
+    overlap = [seg["start"] for seg in windows[0] if seg in windows[1]]
+    assert overlap == [270.0, 280.0, 290.0]
+
+
+def test_segment_crossing_window_boundary_lands_in_both_windows():
+    segments = [{"start": 0.0, "end": 10.0, "text": "a"},
+                {"start": 295.0, "end": 305.0, "text": "granica"},
+                {"start": 400.0, "end": 410.0, "text": "b"}]
+    windows = split_into_windows(segments, window_s=300, overlap_s=30)
+
+    assert len(windows) == 2
+    assert all(any(seg["text"] == "granica" for seg in w) for w in windows)
+
+
+def test_short_episode_is_single_window_and_empty_is_no_windows():
+    assert len(split_into_windows(_segments(300), window_s=300, overlap_s=30)) == 1
+    assert split_into_windows([], window_s=300, overlap_s=30) == []
+
+
+def _analysis(synopsis, characters=(), facts=(), quotes=(), gems=(), vocabulary=()):
+    return EpisodeAnalysis(
+        episode_id="7", title="Odcinek testowy", synopsis=synopsis,
+        character_actions=list(characters), lore_facts=list(facts),
+        quotes=QuotesAnalysis(episode_vocabulary=list(vocabulary), attributed_quotes=list(quotes),
+                              unattributed_gems=list(gems)),
+    )
+
+
+def test_merge_deduplicates_across_windows():
+    first = _analysis(
+        "Bomba leci na misję.",
+        characters=[CharacterAction(name="Kapitan Bomba", role_in_episode="Dowodzi.", traits_exhibited=["agresja"])],
+        facts=[LoreFact(category="Species", fact="Kurvinoxy mają kieszonkę.")],
+        quotes=[AttributedQuote(speaker="Torpeda", text="Ja pierdolę!", confidence="Medium", context=None)],
+        gems=["Ja pierdolę", "Kosmos to nie przelewki"],
+        vocabulary=["kurwa"],
+    )
+    second = _analysis(
+        "Bomba leci na misję.",
+        characters=[CharacterAction(name="kapitan bomba", role_in_episode="Dowodzi", traits_exhibited=["Agresja", "chciwość"])],
+        facts=[LoreFact(category="species", fact="Kurvinoxy mają kieszonkę")],
+        quotes=[AttributedQuote(speaker="Kapitan Bomba", text="ja pierdolę", confidence="High", context=None)],
+        gems=["Kosmos to nie przelewki!"],
+        vocabulary=["Kurwa", "napierdalać"],
+    )
+
+    merged = merge_analyses([first, second])
+
+    assert merged.synopsis == "Bomba leci na misję."
+    assert len(merged.character_actions) == 1
+    assert merged.character_actions[0].role_in_episode == "Dowodzi."
+    assert merged.character_actions[0].traits_exhibited == ["agresja", "chciwość"]
+    assert len(merged.lore_facts) == 1
+    assert merged.quotes.episode_vocabulary == ["kurwa", "napierdalać"]
+    # Ten sam cytat z dwóch okien: wygrywa przypisanie z pewnością High
+    assert [(q.speaker, q.confidence) for q in merged.quotes.attributed_quotes] == [("Kapitan Bomba", "High")]
+    # "Gem" przypisany w innym oknie znika, pozostałe są zdeduplikowane
+    assert merged.quotes.unattributed_gems == ["Kosmos to nie przelewki"]
+    # Wejście nie jest modyfikowane
+    assert first.character_actions[0].traits_exhibited == ["agresja"]
@@ -0,0 +1,89 @@
+import threading
+import time
+
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from chat_server import LockedCalls, _merge_cache, _sample, _select_rows
+
+
+def _cache(batch, length, fill):
+    # Jedna warstwa, jedna głowa, wymiar 1 - wartość mówi, z której sekwencji pochodzi wpis
+    k = torch.full((batch, 1, length, 1), float(fill))
+    return ((k, k.clone()),)
+
+
+def test_sample_uses_per_row_temperature_and_top_p():
+    torch.manual_seed(0)
+    logits = torch.tensor([[0.0, 3.0, 2.9], [0.0, 3.0, 2.9], [0.0, 3.0, 2.9]])
+    # Wiersz 0: zachłannie; wiersz 1: top-p tak małe, że zostaje tylko najlepszy token;
+    # wiersz 2: wysoka temperatura i pełne top-p - losuje też inne tokeny
+    temperatures = torch.tensor([0.0, 1.0, 5.0])
+    top_ps = torch.tensor([1.0, 0.01, 1.0])
+
+    draws = torch.stack([_sample(logits, temperatures, top_ps) for _ in range(200)])
+
+    assert (draws[:, 0] == 1).all()
+    assert (draws[:, 1] == 1).all()
+    assert set(draws[:, 2].tolist()) == {0, 1, 2}
+
+
+def test_merge_cache_left_pads_the_shorter_sequence():
+    cache, mask = _cache(1, 3, fill=1), torch.ones((1, 3), dtype=torch.long)
+    new_cache, new_mask = _cache(1, 5, fill=2), torch.ones((1, 5), dtype=torch.long)
+
+    merged, merged_mask = _merge_cache(cache, mask, new_cache, new_mask)
+
+    (k, v), = merged
+    assert k.shape == v.shape == (2, 1, 5, 1)
+    assert merged_mask.tolist() == [[0, 0, 1, 1, 1], [1, 1, 1, 1, 1]]
+    assert k[0, 0, :, 0].tolist() == [0, 0, 1, 1, 1]
+    assert k[1, 0, :, 0].tolist() == [2, 2, 2, 2, 2]
+
+
+def test_select_rows_trims_columns_that_are_padding_in_every_kept_row():
+    cache, mask = _cache(1, 2, fill=1), torch.ones((1, 2), dtype=torch.long)
+    new_cache, new_mask = _cache(1, 5, fill=2), torch.ones((1, 5), dtype=torch.long)
+    merged, merged_mask = _merge_cache(cache, mask, new_cache, new_mask)
+
+    # Zostaje krótsza sekwencja - jej trzy kolumny lewego paddingu znikają
+    kept, kept_mask = _select_rows(merged, merged_mask, torch.tensor([0]))
+
+    (k, v), = kept
+    assert kept_mask.tolist() == [[1, 1]]
+    assert k.shape == v.shape == (1, 1, 2, 1)
+    assert k[0, 0, :, 0].tolist() == [1, 1]
+
+    # Zostaje dłuższa - nic do przycięcia
+    kept, kept_mask = _select_rows(merged, merged_mask, torch.tensor([1]))
+    assert kept_mask.shape == (1, 5)
+
+
+def test_locked_calls_serializes_only_the_wrapped_calls():
+    inside, overlaps = [], []
+
+    class FakeTokenizer:
+        eos_token_id = 2
+
+        def __call__(self, text):
+            inside.append(text)
+            if len(inside) > 1:
+                overlaps.append(text)
+            time.sleep(0.01)
+            inside.remove(text)
+            return {"input_ids": [1]}
+
+        def decode(self, ids):
+            return "x"
+
+    tokenizer = LockedCalls(FakeTokenizer(), ("decode",))
+    threads = [threading.Thread(target=tokenizer, args=(f"t{i}",)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert overlaps == []
+    assert tokenizer.eos_token_id == 2
+    assert tokenizer.decode([1]) == "x"
@@ -0,0 +1,54 @@
+from types import SimpleNamespace
+
+import pytest
+
+from chroma_utils import collection_hnsw, content_hash, hnsw_metadata, hnsw_structure, set_search_ef
+
+
+def test_collection_hnsw_prefers_configuration_over_metadata():
+    legacy = SimpleNamespace(metadata={"hnsw:space": "cosine", "hnsw:M": 32, "opis": "x"})
+    current = SimpleNamespace(
+        metadata={"hnsw:space": "cosine", "hnsw:search_ef": 10},
+        configuration={"hnsw": {"space": "cosine", "max_neighbors": 32, "ef_construction": 200, "ef_search": 80}},
+    )
+
+    assert collection_hnsw(legacy) == {"hnsw:space": "cosine", "hnsw:M": 32,
+                                       "hnsw:construction_ef": 100, "hnsw:search_ef": 10}
+    assert collection_hnsw(current) == hnsw_metadata("cosine", 32, 200, 80)
+    assert hnsw_structure(collection_hnsw(current)) == hnsw_structure(hnsw_metadata("cosine", 32, 200, 10))
+
+
+def test_content_hash_ignores_page_order_but_not_edits():
+    entries = [("a", "h1"), ("b", "h2"), ("c", None)]
+
+    assert content_hash(entries) == content_hash(reversed(entries))
+    assert content_hash(entries) != content_hash([("a", "h1"), ("b", "h2-zmieniony"), ("c", None)])
+    assert content_hash(entries) != content_hash(entries[:2])
+
+
+def test_set_search_ef_sends_only_ef_search():
+    calls = []
+    collection = SimpleNamespace(metadata=hnsw_metadata("cosine", 16, 100, 10), modify=lambda **kw: calls.append(kw))
+
+    assert set_search_ef(collection, 10)
+    assert set_search_ef(collection, 64)
+    assert calls == [{"configuration": {"hnsw": {"ef_search": 64}}}]
+
+
+def test_search_ef_survives_reopening_persistent_client(tmp_path):
+    chromadb = pytest.importorskip("chromadb")
+    from chromadb.api.client import SharedSystemClient
+
+    path = str(tmp_path / "db")
+    collection = chromadb.PersistentClient(path=path).create_collection(
+        "bomba_lore", metadata=hnsw_metadata("cosine", 16, 100, 10))
+    collection.add(ids=[str(i) for i in range(20)], embeddings=[[float(i), 1.0, 0.5] for i in range(20)])
+
+    assert set_search_ef(collection, 64)
+    # Nowy klient w tym samym procesie dostałby z pamięci już załadowane segmenty
+    SharedSystemClient.clear_system_cache()
+    reopened = chromadb.PersistentClient(path=path).get_collection("bomba_lore")
+
+    assert collection_hnsw(reopened)["hnsw:search_ef"] == 64
+    assert collection_hnsw(reopened)["hnsw:space"] == "cosine"
+    assert len(reopened.query(query_embeddings=[[3.0, 1.0, 0.5]], n_results=5)["ids"][0]) == 5
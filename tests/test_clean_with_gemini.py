@@ -0,0 +1,56 @@
+import pytest
+
+pytest.importorskip("tqdm")
+pytest.importorskip("dotenv")
+
+from clean_with_gemini import from_numbered_lines, to_numbered_lines  # noqa: E402
+
+SEGMENTS = [
+    {"start": 0.0, "end": 1.5, "text": "Kurwa,  dziadnięty   kosmita"},
+    {"start": 1.5, "end": 3.0, "text": "Torpeda\nstrzelaj: teraz!"},
+    {"start": 3.0, "end": 4.2, "text": "Udasha, chodź tu"},
+]
+
+
+def test_round_trip_keeps_timestamps_and_order():
+    payload = to_numbered_lines(SEGMENTS)
+
+    assert payload.splitlines() == [
+        "1|Kurwa, dziadnięty kosmita",
+        "2|Torpeda strzelaj: teraz!",
+        "3|Udasha, chodź tu",
+    ]
+    restored = from_numbered_lines(payload, SEGMENTS)
+    assert [seg["text"] for seg in restored] == [line.split("|", 1)[1] for line in payload.splitlines()]
+    assert [(seg["start"], seg["end"]) for seg in restored] == [(s["start"], s["end"]) for s in SEGMENTS]
+
+
+def test_reordered_and_colon_separated_lines_are_matched_by_number():
+    response = "```\n3: Janusza, chodź tu\n1|Kurwa, dziabnięty kosmita\n 2 : Torpeda strzelaj: teraz!\n```"
+
+    restored = from_numbered_lines(response, SEGMENTS)
+
+    assert [seg["text"] for seg in restored] == [
+        "Kurwa, dziabnięty kosmita",
+        "Torpeda strzelaj: teraz!",
+        "Janusza, chodź tu",
+    ]
+    assert [seg["start"] for seg in restored] == [0.0, 1.5, 3.0]
+
+
+def test_dropped_line_is_rejected():
+    with pytest.raises(ValueError, match="brakujące: \\[2\\]"):
+        from_numbered_lines("1|Kurwa\n3|Janusza", SEGMENTS)
+
+
+def test_duplicated_or_extra_line_is_rejected():
+    with pytest.raises(ValueError, match="powtórzony"):
+        from_numbered_lines("1|a\n2|b\n2|b\n3|c", SEGMENTS)
+    with pytest.raises(ValueError, match="nadmiarowe: \\[4\\]"):
+        from_numbered_lines("1|a\n2|b\n3|c\n4|d", SEGMENTS)
+
+
+def test_merged_lines_are_rejected_instead_of_shifting_text():
+    # Model skleił linijki 2 i 3 - bez walidacji tekst przesunąłby się na złe znaczniki czasu
+    with pytest.raises(ValueError):
+        from_numbered_lines("1|Kurwa\n2|Torpeda strzelaj: teraz! Janusza, chodź tu", SEGMENTS)
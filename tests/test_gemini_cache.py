@@ -0,0 +1,40 @@
+from gemini_cache import ResponseCache, cache_key
+
+
+def test_cache_key_depends_on_every_input():
+    base = cache_key("gemini-2.5-flash", "Popraw transkrypcję", "1|tekst", {"type": "object"}, {"temperature": 0})
+
+    assert base == cache_key("gemini-2.5-flash", "Popraw transkrypcję", "1|tekst", {"type": "object"}, {"temperature": 0})
+    assert base != cache_key("gemini-2.5-pro", "Popraw transkrypcję", "1|tekst", {"type": "object"}, {"temperature": 0})
+    assert base != cache_key("gemini-2.5-flash", "Popraw transkrypcję", "2|tekst", {"type": "object"}, {"temperature": 0})
+    assert base != cache_key("gemini-2.5-flash", "Popraw transkrypcję", "1|tekst", {"type": "array"}, {"temperature": 0})
+    assert base != cache_key("gemini-2.5-flash", "Popraw transkrypcję", "1|tekst", {"type": "object"}, {"temperature": 1})
+
+
+def test_put_get_round_trip_survives_reopen(tmp_path):
+    path = str(tmp_path / "responses.sqlite")
+    cache = ResponseCache(path)
+
+    assert cache.get("brak") is None
+    cache.put("klucz", "Odpowiedź z polskimi znakami: żółć")
+    assert cache.get("klucz") == "Odpowiedź z polskimi znakami: żółć"
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    assert ResponseCache(path).get("klucz") == "Odpowiedź z polskimi znakami: żółć"
+
+
+def test_eviction_drops_least_recently_used(tmp_path):
+    cache = ResponseCache(str(tmp_path / "responses.sqlite"), max_bytes=10**9)
+    # Wpisy o zbliżonym rozmiarze po kompresji: limit 2,5 wpisu wymusza usunięcie dwóch najstarszych
+    values = {key: (key * 2000).encode().hex() for key in ("a", "b", "c")}
+    for key, value in values.items():
+        cache.put(key, value)
+    cache.get("a")  # "a" staje się najświeższy, najstarszy jest teraz "b"
+
+    entry_size = cache._db.execute("SELECT MAX(size) FROM responses").fetchone()[0]
+    cache.max_bytes = int(entry_size * 2.5)
+    cache.put("d", values["c"] + "d")
+
+    assert cache.get("b") is None
+    assert cache.get("a") == values["a"]
+    assert cache.get("d") is not None
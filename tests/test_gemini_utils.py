@@ -0,0 +1,157 @@
+import json
+import os
+import re
+import subprocess
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+pytest.importorskip("dotenv")
+
+from gemini_utils import BACKOFF_BASE_S, HTTPStatusError, RateLimiter, call_with_retry  # noqa: E402
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class FakeClock:
+    """
+    Zegar i sleep dla RateLimiter: sleep przesuwa czas zamiast czekać.
+    """
+
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+def test_request_bucket_blocks_until_refilled():
+    clock = FakeClock()
+    limiter = RateLimiter(requests_per_minute=2, tokens_per_minute=10_000, clock=clock, sleep=clock.sleep)
+
+    limiter.acquire()
+    limiter.acquire()
+    assert clock.sleeps == []
+
+    limiter.acquire()  # kubełek pusty: 1 zapytanie wraca po 60 / 2 = 30 s
+    assert sum(clock.sleeps) == pytest.approx(30.0)
+
+
+def test_token_bucket_refills_with_elapsed_time():
+    clock = FakeClock()
+    limiter = RateLimiter(requests_per_minute=1000, tokens_per_minute=1000, clock=clock, sleep=clock.sleep)
+
+    limiter.acquire(tokens=600)
+    clock.now += 6.0  # +100 tokenów
+    limiter.acquire(tokens=500)
+    assert clock.sleeps == []
+
+    limiter.acquire(tokens=300)  # brakuje 300 tokenów = 18 s
+    assert sum(clock.sleeps) == pytest.approx(18.0)
+
+
+def test_request_larger_than_bucket_still_passes():
+    clock = FakeClock()
+    limiter = RateLimiter(requests_per_minute=10, tokens_per_minute=100, clock=clock, sleep=clock.sleep)
+
+    limiter.acquire(tokens=5000)
+    assert clock.sleeps == []
+
+
+def _flaky(errors, result="ok"):
+    calls = []
+
+    def fn():
+        calls.append(1)
+        if len(calls) <= len(errors):
+            raise errors[len(calls) - 1]
+        return result
+    return fn, calls
+
+
+def test_retries_rate_limit_and_server_errors_with_backoff():
+    sleeps = []
+    fn, calls = _flaky([HTTPStatusError(429), HTTPStatusError(503)])
+
+    assert call_with_retry(fn, sleep=sleeps.append) == "ok"
+    assert len(calls) == 3
+    assert len(sleeps) == 2
+    assert all(0 <= delay <= BACKOFF_BASE_S * 2 ** n for n, delay in enumerate(sleeps))
+
+
+@pytest.mark.parametrize("error", [HTTPStatusError(400), ValueError("zły JSON")])
+def test_other_errors_are_raised_immediately(error):
+    sleeps = []
+    fn, calls = _flaky([error])
+
+    with pytest.raises(type(error)):
+        call_with_retry(fn, sleep=sleeps.append)
+    assert len(calls) == 1
+    assert sleeps == []
+
+
+def test_gives_up_after_max_retries():
+    fn, calls = _flaky([HTTPStatusError(500)] * 10)
+
+    with pytest.raises(HTTPStatusError):
+        call_with_retry(fn, max_retries=2, sleep=lambda _: None)
+    assert len(calls) == 3
+
+
+class _GeminiStandIn(BaseHTTPRequestHandler):
+    """
+    Zastępnik API dla LocalHTTPClient: pierwsze zapytanie dostaje 429, kolejne - poprawione linijki.
+    """
+    requests = []
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        self.requests.append(body)
+        if len(self.requests) == 1:
+            self.send_error(429, "Too Many Requests")
+            return
+        lines = [line.replace("dziadnięty", "dziabnięty") for line in body["prompt"].splitlines()
+                 if re.match(r"^\d+\|", line)]
+        payload = json.dumps({"text": "\n".join(lines)}, ensure_ascii=False).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, *args):
+        pass
+
+
+def test_clean_with_gemini_runs_offline_against_stand_in(tmp_path):
+    pytest.importorskip("tqdm")
+    segments = [{"start": 0.0, "end": 1.5, "text": "Kurwa, dziadnięty kosmita"},
+                {"start": 1.5, "end": 3.0, "text": "Torpeda, strzelaj"}]
+    (tmp_path / "transcriptions").mkdir()
+    for name in ("ep1.json", "ep2.json"):
+        (tmp_path / "transcriptions" / name).write_text(json.dumps(segments, ensure_ascii=False), encoding="utf-8")
+
+    _GeminiStandIn.requests = []
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _GeminiStandIn)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        env = {**os.environ, "GEMINI_BASE_URL": f"http://127.0.0.1:{server.server_port}",
+               "GEMINI_CACHE": "0", "GEMINI_RPM": "600", "GEMINI_MAX_WORKERS": "2"}
+        result = subprocess.run([sys.executable, os.path.join(REPO_DIR, "clean_with_gemini.py")],
+                                cwd=tmp_path, env=env, capture_output=True, text=True, timeout=60)
+    finally:
+        server.shutdown()
+
+    assert result.returncode == 0, result.stdout + result.stderr
+    assert len(_GeminiStandIn.requests) == 3  # 429 + ponowienie + drugi plik
+    for name in ("ep1.json", "ep2.json"):
+        cleaned = json.loads((tmp_path / "transcriptions_clean" / name).read_text(encoding="utf-8"))
+        assert [seg["text"] for seg in cleaned] == ["Kurwa, dziabnięty kosmita", "Torpeda, strzelaj"]
+        assert [(seg["start"], seg["end"]) for seg in cleaned] == [(0.0, 1.5), (1.5, 3.0)]
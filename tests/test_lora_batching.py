@@ -0,0 +1,60 @@
+import random
+
+import pytest
+
+from lora_batching import TokenBudgetBatchSampler, check_single_bos, padding_report, token_budget_batches
+
+BUDGET = 2 * 2048  # TOKENS_PER_FORWARD w train_lora.py
+
+
+def _lengths(n=500, seed=0):
+    rng = random.Random(seed)
+    # Głównie krótkie odpowiedzi w stylu cytatów, kilka długich do limitu modelu
+    return [rng.choice([rng.randint(20, 120)] * 9 + [rng.randint(1000, 2048)]) for _ in range(n)]
+
+
+def test_rows_never_exceed_budget_and_cover_every_example_once():
+    lengths = _lengths()
+    sampler = TokenBudgetBatchSampler(lengths, BUDGET, seed=42)
+
+    for epoch in range(3):
+        sampler.set_epoch(epoch)
+        batches = list(sampler)
+        assert len(batches) == len(sampler)
+        assert all(sum(lengths[i] for i in batch) <= BUDGET for batch in batches)
+        assert sorted(i for batch in batches for i in batch) == list(range(len(lengths)))
+
+
+def test_epochs_are_reshuffled_deterministically():
+    lengths = _lengths()
+    sampler = TokenBudgetBatchSampler(lengths, BUDGET, seed=42)
+    first = list(sampler)
+    sampler.set_epoch(1)
+
+    assert list(sampler) != first
+    assert token_budget_batches(lengths, BUDGET, seed=42) == first
+
+
+def test_example_exactly_at_budget_gets_own_row_and_longer_is_rejected():
+    assert token_budget_batches([BUDGET, 10, 10], BUDGET, seed=0).count([0]) == 1
+
+    with pytest.raises(ValueError, match="exceed the packing budget"):
+        token_budget_batches([10, BUDGET + 1, 10], BUDGET, seed=0)
+
+
+def test_packing_has_no_padding_and_grouping_reduces_it(capsys):
+    ratios = padding_report(_lengths(), batch_size=2, seed=42)
+
+    assert ratios["packing"] == 0.0
+    assert ratios["group_by_length"] < ratios["pad"]
+    assert "tokens processed" in capsys.readouterr().out
+
+
+def test_check_single_bos():
+    check_single_bos([[1, 5, 6], [1, 7]], bos_token_id=1)
+    check_single_bos([[5, 6]], bos_token_id=None)
+
+    with pytest.raises(ValueError, match="Row 1"):
+        check_single_bos([[1, 5], [5, 6]], bos_token_id=1)
+    with pytest.raises(ValueError, match="Row 0"):
+        check_single_bos([[1, 1, 5]], bos_token_id=1)
@@ -0,0 +1,31 @@
+import pytest
+
+pytest.importorskip("numpy")
+
+from near_dedup import find_duplicate_groups, find_duplicate_groups_hashed, shingle_hashes  # noqa: E402
+
+QUOTE = "Torpeda, strzelaj do tego statku zanim nas rozwali na kawałki, kurwa mać"
+
+
+def test_near_identical_texts_are_grouped_with_first_as_representative():
+    texts = [
+        "Udasha pilotuje statek Bombardiera przez pas asteroid",
+        QUOTE,
+        QUOTE.replace("kurwa mać", "kurwa mać!").upper(),
+        "Zupełnie inny fakt o kapitanie i jego kawie",
+    ]
+
+    assert find_duplicate_groups(texts) == [[1, 2]]
+
+
+def test_different_speakers_are_never_merged():
+    assert find_duplicate_groups([QUOTE, QUOTE], speakers=["Kurvinox", "Titus"]) == []
+    assert find_duplicate_groups([QUOTE, QUOTE], speakers=["Kurvinox", None]) == [[0, 1]]
+
+
+def test_hashed_fingerprints_match_text_path():
+    texts = [QUOTE, "Krótki", QUOTE + " teraz"]
+    fingerprints = [shingle_hashes(text) for text in texts]
+
+    assert fingerprints[0] == sorted(fingerprints[0])
+    assert find_duplicate_groups_hashed(fingerprints) == find_duplicate_groups(texts)
@@ -1,24 +1,151 @@
+import argparse
+import hashlib
+import importlib.util
+import math
+import os
+import shutil
+import tempfile
 import torch
-from datasets import load_dataset
+from datasets import load_dataset, load_from_disk
+from torch.utils.data import DataLoader
 from unsloth import FastLanguageModel
 from trl import SFTTrainer
-from transformers import TrainingArguments
-from peft import LoraConfig
+from transformers import DataCollatorWithFlattening, TrainingArguments
+
+from lora_batching import (BATCHING_MODES, TokenBudgetBatchSampler, check_single_bos, padding_report,
+                           token_budget_batches)
 
 # --- Configuration ---
 MODEL_NAME = "speakleash/bielik-7b-instruct-v0.1"  # Base model
 DATASET_FILE = "data/LORA_STYL.jsonl"  # Your JSONL file
 ADAPTER_OUTPUT_DIR = "./lora_adapter"  # Where to save the trained adapter
+# Tokenized copies of the dataset (Arrow, memory-mapped), one per dataset/tokenizer/template combination
+TOKENIZED_CACHE_DIR = "data/tokenized_cache"
+MAX_SEQ_LENGTH = 2048
+BATCH_SIZE = 2
+GRADIENT_ACCUMULATION_STEPS = 8
+SEED = 42
+
+# Token budget of one forward pass in "pad" mode at the worst case (2 x 2048).
+# Packing fills the same budget with real tokens instead of padding, and never exceeds it.
+# Batching modes and the packing sampler live in lora_batching.py.
+TOKENS_PER_FORWARD = BATCH_SIZE * MAX_SEQ_LENGTH
 
 
-def run_training():
+class TokenBudgetSFTTrainer(SFTTrainer):
+    """
+    SFTTrainer whose training batches come from TokenBudgetBatchSampler instead of a fixed batch size.
+    """
+
+    def get_train_dataloader(self):
+        # DataCollatorWithFlattening only reads input_ids (and labels), the other columns are ignored
+        dataloader = DataLoader(
+            self.train_dataset,
+            batch_sampler=TokenBudgetBatchSampler(self.train_dataset["length"], TOKENS_PER_FORWARD, self.args.seed),
+            collate_fn=self.data_collator,
+            num_workers=self.args.dataloader_num_workers,
+            pin_memory=self.args.dataloader_pin_memory,
+        )
+        return self.accelerator.prepare(dataloader)
+
+
+# This creates a "chat-like" format.
+# It's crucial for the model to learn when to start and stop talking.
+# <s> and </s> are special tokens for Start and End of sequence.
+PROMPT_TEMPLATE = "<s>### Instrukcja:\n{instruction}\n\n### Odpowiedź:\n{output}</s>"
+
+
+def _file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 16), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _tokenizer_fingerprint(tokenizer):
+    # Fast tokenizers serialize their full state (vocab, merges, normalizer, added tokens)
+    backend = getattr(tokenizer, "backend_tokenizer", None)
+    if backend is not None:
+        return hashlib.sha256(backend.to_str().encode("utf-8")).hexdigest()
+    return f"{tokenizer.name_or_path}:{len(tokenizer)}"
+
+
+def tokenized_cache_path(tokenizer):
+    """
+    Cache key = dataset content + tokenizer state + prompt template + max length.
+    Any change to one of them produces a new directory, so a stale copy is never reused.
+    """
+    key_material = "|".join([
+        _file_sha256(DATASET_FILE), _tokenizer_fingerprint(tokenizer), PROMPT_TEMPLATE, str(MAX_SEQ_LENGTH),
+    ])
+    return os.path.join(TOKENIZED_CACHE_DIR, hashlib.sha256(key_material.encode("utf-8")).hexdigest()[:16])
+
+
+def load_tokenized_dataset(tokenizer):
+    """
+    Returns the tokenized dataset (input_ids, attention_mask, length) from the Arrow cache,
+    building it on the first run. load_from_disk memory-maps the Arrow files, so parallel
+    hyperparameter runs share one copy through the page cache instead of each holding it in RAM.
+    """
+    cache_path = tokenized_cache_path(tokenizer)
+    if os.path.exists(cache_path):
+        print(f"Loading tokenized dataset from cache: {cache_path}")
+        return load_from_disk(cache_path)
+
+    def formatting_prompts_func(example):
+        return {"text": PROMPT_TEMPLATE.format(instruction=example["instruction"], output=example["output"])}
+
+    def tokenize_func(batch):
+        # The template already contains <s> and </s>, so no extra special tokens are added.
+        encoded = tokenizer(batch["text"], add_special_tokens=False, truncation=True, max_length=MAX_SEQ_LENGTH)
+        # The template's <s> must come out as exactly one BOS token - neither missing nor doubled
+        check_single_bos(encoded["input_ids"], tokenizer.bos_token_id)
+        encoded["length"] = [len(ids) for ids in encoded["input_ids"]]
+        return encoded
+
+    print(f"Loading and formatting dataset from {DATASET_FILE}...")
+    dataset = load_dataset("json", data_files=DATASET_FILE, split="train")
+
+    # Apply the formatting function to every example in the dataset
+    dataset = dataset.map(formatting_prompts_func, remove_columns=["instruction", "output"])
+    print("Dataset processed and formatted.")
+    print(f"Example of a formatted prompt:\n{dataset[0]['text']}")
+    dataset = dataset.map(tokenize_func, batched=True, remove_columns=["text"])
+
+    # Write to a unique temporary directory first, so an interrupted run never leaves a half-written
+    # cache and parallel runs building the same key never write into each other's files
+    os.makedirs(TOKENIZED_CACHE_DIR, exist_ok=True)
+    tmp_path = tempfile.mkdtemp(dir=TOKENIZED_CACHE_DIR, prefix=os.path.basename(cache_path) + ".tmp-")
+    try:
+        dataset.save_to_disk(tmp_path)
+        try:
+            os.replace(tmp_path, cache_path)
+            print(f"Tokenized dataset cached in: {cache_path}")
+        except OSError:
+            if not os.path.exists(cache_path):
+                raise
+            # Another run finished the same cache first: use its copy, discard ours
+            print(f"Tokenized dataset was cached by another run, using: {cache_path}")
+    finally:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+    return load_from_disk(cache_path)
+
+
+def run_training(batching="pad"):
     """
     Main function to load the model, dataset, and run the SFT training.
     """
+    if batching == "packing" and importlib.util.find_spec("flash_attn") is None:
+        # Without flash-attn varlen kernels position_ids are ignored and packed examples would attend to each other
+        print("WARNING: flash-attn is not installed, packing would leak attention across examples. "
+              "Falling back to group_by_length.")
+        batching = "group_by_length"
     print(f"--- Starting LoRA Training ---")
     print(f"Model: {MODEL_NAME}")
     print(f"Dataset: {DATASET_FILE}")
     print(f"Output: {ADAPTER_OUTPUT_DIR}")
+    print(f"Batching: {batching}")
 
     # --- Step 1: Load Model with Unsloth (4-bit QLoRA) ---
     # This is the core of Unsloth's magic.
@@ -27,7 +154,7 @@ def run_training():
     # max_seq_length can be adjusted, but 2048 is a safe default.
     model, tokenizer = FastLanguageModel.from_pretrained(
         model_name=MODEL_NAME,
-        max_seq_length=2048,
+        max_seq_length=MAX_SEQ_LENGTH,
         dtype=None,  # None lets Unsloth pick the best dtype (e.g., bfloat16 if available)
         load_in_4bit=True,
     )
@@ -51,32 +178,39 @@ def run_training():
     print("PEFT LoRA configuration applied.")
 
     # --- Step 3: Load and Prepare the Dataset ---
-
-    # We need to format our JSONL data into a single string
-    # that the model understands as a prompt.
-    def formatting_prompts_func(example):
-        # This creates a "chat-like" format.
-        # It's crucial for the model to learn when to start and stop talking.
-        # <s> and </s> are special tokens for Start and End of sequence.
-        text = f"<s>### Instrukcja:\n{example['instruction']}\n\n### Odpowiedź:\n{example['output']}</s>"
-        return {"text": text}
-
-    print(f"Loading and formatting dataset from {DATASET_FILE}...")
-    dataset = load_dataset("json", data_files=DATASET_FILE, split="train")
-
-    # Apply the formatting function to every example in the dataset
-    dataset = dataset.map(formatting_prompts_func, remove_columns=["instruction", "output"])
-    print("Dataset processed and formatted.")
+    # We need to format our JSONL data into a single string that the model understands as a prompt,
+    # then tokenize it. Both steps are cached on disk (see load_tokenized_dataset).
+    # Token lengths drive the padding report and the packing batch size.
+    dataset = load_tokenized_dataset(tokenizer)
     print(f"Total training examples: {len(dataset)}")
-    print(f"Example of a formatted prompt:\n{dataset[0]['text']}")
+    lengths = dataset["length"]
+    print(f"Tokens: {sum(lengths)} total, mean {sum(lengths) / len(lengths):.0f}, max {max(lengths)}")
+    print("Padding estimate per batching mode:")
+    padding_ratios = padding_report(lengths, BATCH_SIZE, SEED)
+
+    batch_size, accumulation = BATCH_SIZE, GRADIENT_ACCUMULATION_STEPS
+    trainer_class, trainer_extra = SFTTrainer, {}
+    if batching == "packing":
+        # Rows are capped at TOKENS_PER_FORWARD real tokens, so VRAM stays at the pad-mode worst case;
+        # accumulation keeps roughly the same number of examples per optimizer step
+        rows = token_budget_batches(lengths, TOKENS_PER_FORWARD, SEED)
+        examples_per_row = len(lengths) / len(rows)
+        batch_size = max(1, round(examples_per_row))  # only used for logging, the sampler decides
+        accumulation = max(1, math.ceil(BATCH_SIZE * GRADIENT_ACCUMULATION_STEPS / examples_per_row))
+        trainer_class = TokenBudgetSFTTrainer
+        # Concatenates a batch into one row, restarts position_ids per example, masks boundary labels
+        trainer_extra["data_collator"] = DataCollatorWithFlattening()
+        print(f"Packing up to {TOKENS_PER_FORWARD} tokens per row ({examples_per_row:.1f} examples on average) "
+              f"x {accumulation} accumulation steps.")
 
     # --- Step 4: Define Training Arguments ---
     # These parameters control the training process.
     # They are CRITICAL for fitting on 8GB VRAM.
     training_args = TrainingArguments(
         output_dir=ADAPTER_OUTPUT_DIR,
-        per_device_train_batch_size=2,  # Batch size. 2 is aggressive for 8GB VRAM.
-        gradient_accumulation_steps=8,  # Simulates a larger batch size (2 * 8 = 16)
+        per_device_train_batch_size=batch_size,  # Batch size. 2 is aggressive for 8GB VRAM (unpacked).
+        gradient_accumulation_steps=accumulation,  # Simulates a larger batch size (2 * 8 = 16)
+        group_by_length=(batching == "group_by_length"),  # Batch examples of similar length together
         warmup_steps=10,  # How many steps to "warm up" the learning rate
         num_train_epochs=1,  # We'll train for 1 full pass over the 477 examples
         learning_rate=2e-4,  # Standard learning rate for LoRA
@@ -86,28 +220,37 @@ def run_training():
         optim="adamw_8bit",  # 8-bit optimizer to save more VRAM
         weight_decay=0.01,
         lr_scheduler_type="linear",
-        seed=42,
+        seed=SEED,
 	    report_to="none",
         save_strategy="epoch",  # Save checkpoint at the end of the epoch
     )
 
     # --- Step 5: Initialize the Trainer ---
     # SFTTrainer (Supervised Fine-tuning Trainer) handles all the complexity.
-    trainer = SFTTrainer(
+    trainer = trainer_class(
         model=model,
         tokenizer=tokenizer,
         train_dataset=dataset,
-        dataset_text_field="text",  # Tell the trainer to use our "text" field
-        max_seq_length=2048,
+        max_seq_length=MAX_SEQ_LENGTH,
         args=training_args,
-        packing=False,  # We're not packing sequences
+        packing=False,  # TRL's own packing has no attention boundaries; see BATCHING_MODES instead
+        dataset_kwargs={"skip_prepare_dataset": True},  # Already tokenized above
+        **trainer_extra,
     )
     print("Trainer initialized. Starting training...")
 
     # --- Step 6: RUN TRAINING ---
-    trainer.train()
+    train_result = trainer.train()
 
     print("\n--- Training Complete! ---")
+    runtime = train_result.metrics["train_runtime"]
+    real_tokens = sum(lengths) * training_args.num_train_epochs
+    print(f"Padding ratio ({batching}): {padding_ratios[batching]:.1%} "
+          f"(pad mode: {padding_ratios['pad']:.1%}, both estimated before training)")
+    # Only the mode that ran is measured; a before/after comparison needs one run per mode
+    print(f"Measured throughput of this run only (--batching {batching}): "
+          f"{real_tokens / runtime:.0f} real tokens/s over {runtime:.0f} s. "
+          f"Rerun with another --batching value to compare.")
 
     # --- Step 7: Save the Final Adapter ---
     # This saves the small adapter files (e.g., adapter_model.safetensors)
@@ -118,4 +261,9 @@ def run_training():
 
 # This block runs only when you execute the script directly
 if __name__ == "__main__":
-    run_training()
+    parser = argparse.ArgumentParser(description="LoRA fine-tuning on the style dataset.")
+    parser.add_argument("--batching", choices=BATCHING_MODES, default="pad",
+                        help="How to batch examples: pad (original), group_by_length, or packing.")
+    args = parser.parse_args()
+
+    run_training(batching=args.batching)
@@ -1,9 +1,17 @@
+import argparse
+import multiprocessing
 import os
 import sys
 import json
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+import ctranslate2
+import numpy as np
 from dotenv import load_dotenv
 from tqdm import tqdm
-from faster_whisper import WhisperModel
+from faster_whisper import BatchedInferencePipeline, WhisperModel, decode_audio
 
 
 # --- FIX DLA WINDOWSA ---
@@ -45,50 +53,324 @@ load_dotenv()
 TRANSCRIPTION_OUTPUT_DIR = os.getenv('TRANSCRIPTION_OUTPUT_DIR', 'transcriptions')
 AUDIO_SET = os.getenv('AUDIO_SET', 'audio')
 
-# Upewnij się, że folder wyjściowy istnieje
-if not os.path.exists(TRANSCRIPTION_OUTPUT_DIR):
-    os.makedirs(TRANSCRIPTION_OUTPUT_DIR)
+# --- KONFIGURACJA SILNIKA ---
+MODEL_SIZE = os.getenv('WHISPER_MODEL', 'large-v3')
+# "auto" = CUDA, jeśli jest dostępna, w przeciwnym razie CPU
+DEVICE = os.getenv('WHISPER_DEVICE', 'auto')
+COMPUTE_TYPE = os.getenv('WHISPER_COMPUTE_TYPE', 'auto')
+# Ile fragmentów VAD dekodować naraz (BatchedInferencePipeline); 1 = klasyczne, sekwencyjne transcribe
+BATCH_SIZE = int(os.getenv('WHISPER_BATCH_SIZE', '0')) or None
+BEAM_SIZE = int(os.getenv('WHISPER_BEAM_SIZE', '5'))
+LANGUAGE = "pl"
+# Formaty przyjmowane z audio_yt-dlp.py (mp3 po transkodowaniu albo natywny strumień)
+AUDIO_EXTENSIONS = (".mp3", ".opus", ".m4a", ".webm", ".ogg", ".aac", ".wav", ".flac")
+SAMPLE_RATE = 16000
 
-print(f"Szukam plików w: {AUDIO_SET}")
-files = [f for f in os.listdir(AUDIO_SET) if f.endswith(".mp3")]
-print(f"Znaleziono {len(files)} plików MP3.")
+# Segmenty dopisywane na bieżąco; gotowy .json powstaje dopiero po zakończeniu pliku
+PARTIAL_SUFFIX = ".partial.jsonl"
+FSYNC_EVERY_SEGMENTS = 20
 
-# Sortowanie alfabetyczne jest bezpieczniejsze dla nazw z yt-dlp
-files.sort()
+# Prefetch: wątki dekodujące kolejne pliki do 16 kHz mono float32, podczas gdy model pracuje
+DECODE_WORKERS = int(os.getenv('WHISPER_DECODE_WORKERS', '2'))
+# Ile zdekodowanych plików może być naraz w RAM, łącznie z transkrybowanym (min. 1 = bez wyprzedzenia)
+PREFETCH_DEPTH = int(os.getenv('WHISPER_PREFETCH_DEPTH', '2'))
+# Opcjonalny cache zdekodowanego audio (.npy); pusty = wyłączony
+AUDIO_CACHE_DIR = os.getenv('WHISPER_AUDIO_CACHE_DIR', '')
 
-model_size = "large-v3"
-print(f"Inicjalizacja modelu: {model_size}...")
-# compute_type="int8" jest bezpieczniejszy dla 8GB VRAM niż int8_float16
-model = WhisperModel(model_size, device="cuda", compute_type="int8")
-print("Model gotowy.")
+# Stan procesu roboczego (tryb wielu workerów na CPU): każdy ma własny model
+_worker_state: Dict[str, Any] = {}
 
-print("Rozpoczynam transkrypcję...")
-for filename in tqdm(files):
-    input_path = os.path.join(AUDIO_SET, filename)
-    output_filename = filename.replace(".mp3", ".json")
-    output_path = os.path.join(TRANSCRIPTION_OUTPUT_DIR, output_filename)
 
-    # Jeśli plik już istnieje, pomiń go (przydatne przy restarcie)
-    if os.path.exists(output_path):
-        continue
+def resolve_device(device: str = DEVICE) -> str:
+    if device != "auto":
+        return device
+    return "cuda" if ctranslate2.get_cuda_device_count() > 0 else "cpu"
 
-    try:
-        segments, info = model.transcribe(input_path, beam_size=5, language="pl", vad_filter=True)
 
-        transcript_data = []
+def resolve_compute_type(device: str, compute_type: str = COMPUTE_TYPE) -> str:
+    """
+    int8 na obu urządzeniach: na GPU jest bezpieczniejszy dla 8GB VRAM niż int8_float16,
+    na CPU to najszybszy wariant. Gdy CPU nie wspiera int8, spadamy do float32.
+    """
+    if compute_type != "auto":
+        return compute_type
+    supported = ctranslate2.get_supported_compute_types(device)
+    return "int8" if "int8" in supported else "float32"
+
+
+def default_batch_size(device: str) -> int:
+    return 16 if device == "cuda" else 8
+
+
+def load_engine(device: str, compute_type: str, batch_size: int, cpu_threads: int = 0):
+    """
+    Zwraca model gotowy do `transcribe`: przy batch_size > 1 opakowany w BatchedInferencePipeline,
+    który dzieli audio na fragmenty VAD i dekoduje je paczkami.
+    """
+    model = WhisperModel(MODEL_SIZE, device=device, compute_type=compute_type, cpu_threads=cpu_threads)
+    return BatchedInferencePipeline(model=model) if batch_size > 1 else model
+
+
+def transcribe_segments(engine, audio, batch_size: int, offset: float = 0.0,
+                        beam_size: int = BEAM_SIZE) -> Tuple[Iterator[dict], float]:
+    """
+    Zwraca (leniwy generator segmentów, długość_audio_w_sekundach).
+    `audio` to ścieżka albo tablica 16 kHz; `offset` przesuwa znaczniki czasu (wznowienie od środka pliku).
+    """
+    options = dict(beam_size=beam_size, language=LANGUAGE, vad_filter=True)
+    if batch_size > 1:
+        options["batch_size"] = batch_size
+    segments, info = engine.transcribe(audio, **options)
+
+    def generate():
         # Pętla generująca tekst
         for segment in segments:
-            transcript_data.append({
-                "start": segment.start,
-                "end": segment.end,
+            yield {
+                "start": segment.start + offset,
+                "end": segment.end + offset,
                 "text": segment.text.strip()
-            })
+            }
+    return generate(), info.duration
+
+
+def load_audio(filename: str, cache_dir: str = AUDIO_CACHE_DIR) -> np.ndarray:
+    """
+    Dekoduje plik do 16 kHz mono float32. Z `cache_dir` kolejne przebiegi (np. z innymi
+    ustawieniami modelu) czytają gotową tablicę .npy (mmap) zamiast ponownie dekodować.
+    """
+    input_path = os.path.join(AUDIO_SET, filename)
+    if not cache_dir:
+        return decode_audio(input_path, sampling_rate=SAMPLE_RATE)
+
+    cache_path = os.path.join(cache_dir, os.path.splitext(filename)[0] + ".npy")
+    if os.path.exists(cache_path) and os.path.getmtime(cache_path) >= os.path.getmtime(input_path):
+        return np.load(cache_path, mmap_mode="r")
+
+    audio = decode_audio(input_path, sampling_rate=SAMPLE_RATE)
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = cache_path + ".tmp.npy"
+    np.save(tmp_path, audio)
+    os.replace(tmp_path, cache_path)
+    return audio
+
+
+def prefetch_audio(filenames: List[str], cache_dir: str = AUDIO_CACHE_DIR, decode_workers: int = DECODE_WORKERS,
+                   depth: int = PREFETCH_DEPTH) -> Iterator[Tuple[str, Any]]:
+    """
+    Producent/konsument: pula wątków dekoduje z wyprzedzeniem, a model bierze pliki po kolei.
+    `depth` to limit zdekodowanych plików w pamięci łącznie z tym, który model właśnie
+    transkrybuje: w trakcie jego transkrypcji czeka/dekoduje się najwyżej `depth - 1` kolejnych.
+    Następny plik trafia do dekodowania dopiero, gdy konsument poprosi o kolejny (skończył
+    poprzedni) - na chwilę, zanim pętla konsumenta podmieni zmienną, poprzednia tablica i świeżo
+    rozpoczęte dekodowanie mogą współistnieć. Zwraca (nazwa, tablica audio albo wyjątek dekodowania).
+    """
+    ahead = max(depth, 1) - 1
+    with ThreadPoolExecutor(max_workers=decode_workers, thread_name_prefix="decode") as pool:
+        queue = deque()
+        names = iter(filenames)
+
+        def submit_next():
+            next_name = next(names, None)
+            if next_name is not None:
+                queue.append((next_name, pool.submit(load_audio, next_name, cache_dir)))
+
+        submit_next()
+        for _ in range(ahead):
+            submit_next()
+
+        while queue:
+            filename, future = queue.popleft()
+            try:
+                result = future.result()
+            except Exception as e:
+                result = e
+            yield filename, result
+            # Konsument skończył z tym plikiem - zwalniamy naszą referencję i zajmujemy zwolnione miejsce
+            del result
+            submit_next()
+
+
+def output_path_for(filename: str) -> str:
+    return os.path.join(TRANSCRIPTION_OUTPUT_DIR, os.path.splitext(filename)[0] + ".json")
+
+
+def partial_path_for(filename: str) -> str:
+    return os.path.join(TRANSCRIPTION_OUTPUT_DIR, os.path.splitext(filename)[0] + PARTIAL_SUFFIX)
+
 
-        # Zapis do pliku JSON
-        with open(output_path, "w", encoding="utf-8") as f:
-            json.dump(transcript_data, f, ensure_ascii=False, indent=2)
+def _source_signature(input_path: str) -> Dict[str, Any]:
+    stat = os.stat(input_path)
+    return {"source": os.path.basename(input_path), "size": stat.st_size, "model": MODEL_SIZE}
+
+
+def read_partial(partial_path: str, signature: Dict[str, Any]) -> List[dict]:
+    """
+    Wczytuje segmenty z pliku częściowego. Pierwsza linijka to nagłówek (plik źródłowy, model);
+    jeśli nie pasuje, zaczynamy od nowa. Urwana ostatnia linijka (awaria w trakcie zapisu) jest pomijana.
+    """
+    if not os.path.exists(partial_path):
+        return []
+    segments = []
+    with open(partial_path, "r", encoding="utf-8") as f:
+        lines = f.read().splitlines()
+    try:
+        if not lines or json.loads(lines[0]) != signature:
+            return []
+    except json.JSONDecodeError:
+        return []
+    for line in lines[1:]:
+        try:
+            segments.append(json.loads(line))
+        except json.JSONDecodeError:
+            break
+    return segments
+
+
+def _finalize(partial_path: str, output_path: str, segments: List[dict]):
+    """
+    Atomowy zapis gotowej transkrypcji: .tmp + os.replace, dopiero potem usunięcie pliku częściowego.
+    Wyjściowy .json istnieje więc tylko wtedy, gdy jest kompletny.
+    """
+    tmp_path = output_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(segments, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, output_path)
+    os.remove(partial_path)
+
+
+def process_file(engine, filename: str, batch_size: int, audio: Optional[np.ndarray] = None,
+                 cache_dir: str = AUDIO_CACHE_DIR) -> Tuple[str, Optional[float], float]:
+    """
+    Transkrybuje plik strumieniowo: każdy segment trafia od razu do pliku .partial.jsonl,
+    a po przerwaniu praca jest wznawiana od końca ostatniego zapisanego segmentu.
+    `audio` to tablica zdekodowana wcześniej (prefetch); bez niej plik jest dekodowany tutaj.
+    Zwraca (nazwa, sekundy_audio albo None przy błędzie, czas_pracy).
+    """
+    started = time.perf_counter()
+    input_path = os.path.join(AUDIO_SET, filename)
+    partial_path = partial_path_for(filename)
+    try:
+        signature = _source_signature(input_path)
+        done = read_partial(partial_path, signature)
+        resume_from = done[-1]["end"] if done else 0.0
+
+        if audio is None:
+            audio = load_audio(filename, cache_dir)
+        if resume_from:
+            print(f"Wznawiam {filename} od {resume_from:.1f} s ({len(done)} segmentów z poprzedniego przebiegu).")
+            audio = audio[int(resume_from * SAMPLE_RATE):]
+        segments, duration = transcribe_segments(engine, audio, batch_size, offset=resume_from)
+
+        # Nagłówek + dotychczasowe segmenty przepisujemy od nowa - odcina to ewentualną urwaną linijkę
+        with open(partial_path, "w", encoding="utf-8") as f:
+            f.write(json.dumps(signature, ensure_ascii=False) + "\n")
+            for segment in done:
+                f.write(json.dumps(segment, ensure_ascii=False) + "\n")
+            for i, segment in enumerate(segments, start=1):
+                f.write(json.dumps(segment, ensure_ascii=False) + "\n")
+                f.flush()
+                if i % FSYNC_EVERY_SEGMENTS == 0:
+                    os.fsync(f.fileno())
+                done.append(segment)
+
+        _finalize(partial_path, output_path_for(filename), done)
+        return filename, duration, time.perf_counter() - started
 
     except Exception as e:
         print(f"Błąd przy pliku {filename}: {e}")
+        return filename, None, time.perf_counter() - started
+
+
+def _init_worker(device: str, compute_type: str, batch_size: int, cpu_threads: int, cache_dir: str):
+    _worker_state["engine"] = load_engine(device, compute_type, batch_size, cpu_threads)
+    _worker_state["batch_size"] = batch_size
+    _worker_state["cache_dir"] = cache_dir
+
+
+def _process_file_in_worker(filename: str):
+    return process_file(_worker_state["engine"], filename, _worker_state["batch_size"],
+                        cache_dir=_worker_state["cache_dir"])
+
+
+def main(device: str = DEVICE, compute_type: str = COMPUTE_TYPE, batch_size: Optional[int] = BATCH_SIZE,
+         workers: int = 1, audio_cache_dir: str = AUDIO_CACHE_DIR):
+    # Upewnij się, że folder wyjściowy istnieje
+    if not os.path.exists(TRANSCRIPTION_OUTPUT_DIR):
+        os.makedirs(TRANSCRIPTION_OUTPUT_DIR)
+
+    print(f"Szukam plików w: {AUDIO_SET}")
+    # Sortowanie alfabetyczne jest bezpieczniejsze dla nazw z yt-dlp
+    files = sorted(f for f in os.listdir(AUDIO_SET) if f.lower().endswith(AUDIO_EXTENSIONS))
+    # Ten sam odcinek w dwóch formatach dałby ten sam plik .json - bierzemy pierwszy
+    by_stem = {}
+    for filename in files:
+        by_stem.setdefault(os.path.splitext(filename)[0], filename)
+    files = sorted(by_stem.values())
+    print(f"Znaleziono {len(files)} plików audio.")
+    # Jeśli gotowy plik już istnieje, pomiń go; pliki .partial.jsonl są wznawiane
+    pending = [f for f in files if not os.path.exists(output_path_for(f))]
+
+    device = resolve_device(device)
+    compute_type = resolve_compute_type(device, compute_type)
+    batch_size = batch_size or default_batch_size(device)
+    if device == "cuda" and workers > 1:
+        print("Kilka workerów na jednym GPU zduplikowałoby model w VRAM - używam 1.")
+        workers = 1
+    cpu_threads = max(1, (os.cpu_count() or 1) // workers) if device == "cpu" else 0
+
+    print(f"Inicjalizacja modelu: {MODEL_SIZE} | {device.upper()} / {compute_type} | "
+          f"batch {batch_size} | workery: {workers}")
+
+    print("Rozpoczynam transkrypcję...")
+    audio_total = 0.0
+    started = time.perf_counter()
+    pbar = tqdm(total=len(pending))
+
+    def record(result):
+        nonlocal audio_total
+        filename, duration, _ = result
+        pbar.update(1)
+        if duration is not None:
+            audio_total += duration
+            pbar.set_postfix(x_realtime=f"{audio_total / (time.perf_counter() - started):.1f}")
+
+    if workers > 1:
+        ctx = multiprocessing.get_context("spawn")
+        with ctx.Pool(workers, initializer=_init_worker,
+                      initargs=(device, compute_type, batch_size, cpu_threads, audio_cache_dir)) as pool:
+            for result in pool.imap_unordered(_process_file_in_worker, pending):
+                record(result)
+    else:
+        engine = load_engine(device, compute_type, batch_size, cpu_threads)
+        print("Model gotowy.")
+        # Dekodowanie kolejnych plików w tle, ukryte za inferencją bieżącego
+        for filename, audio in prefetch_audio(pending, audio_cache_dir):
+            if isinstance(audio, Exception):
+                print(f"Błąd dekodowania pliku {filename}: {audio}")
+                record((filename, None, 0.0))
+                continue
+            record(process_file(engine, filename, batch_size, audio, audio_cache_dir))
+    pbar.close()
+
+    elapsed = time.perf_counter() - started
+    if audio_total:
+        print(f"Przepustowość: {audio_total:.0f} s audio w {elapsed:.0f} s "
+              f"({audio_total / elapsed:.1f} s audio / s, {audio_total / 3600:.1f} h materiału).")
+    print("Zakończono!")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Transkrypcja odcinków (faster-whisper).")
+    parser.add_argument("--device", default=DEVICE, choices=["auto", "cuda", "cpu"])
+    parser.add_argument("--compute-type", default=COMPUTE_TYPE,
+                        help="np. int8, int8_float16, float16, float32 (auto = int8, jeśli wspierany).")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE,
+                        help="Fragmenty VAD dekodowane naraz (domyślnie 16 na GPU, 8 na CPU; 1 = bez batchowania).")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Liczba procesów na CPU, każdy z własnym modelem i częścią rdzeni.")
+    parser.add_argument("--audio-cache-dir", default=AUDIO_CACHE_DIR,
+                        help="Katalog na zdekodowane audio (.npy); kolejne przebiegi pomijają dekodowanie.")
+    args = parser.parse_args()
 
-print("Zakończono!")
\ No newline at end of file
+    main(device=args.device, compute_type=args.compute_type, batch_size=args.batch_size, workers=args.workers,
+         audio_cache_dir=args.audio_cache_dir)
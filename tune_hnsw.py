@@ -0,0 +1,168 @@
+import argparse
+import itertools
+import json
+import os
+import sys
+import time
+from typing import Any, Dict, List, Optional
+
+import chromadb
+import numpy as np
+
+from chroma_utils import (HNSW_SPACE, HNSW_SPACES, collection_hnsw, hnsw_metadata, hnsw_structure,
+                          iter_collection, set_search_ef)
+from quantized_index import exact_top_k, load_report_queries
+
+# --- KONFIGURACJA ---
+DB_DIRECTORY = "./chroma_db"
+COLLECTION_NAME = "bomba_lore"
+RESULTS_DIR = os.path.join("benchmarks", "results")
+# Siatka przeszukiwania (domyślne Chromy: M = 16, construction_ef = 100, search_ef = 10)
+M_GRID = (8, 16, 32)
+CONSTRUCTION_EF_GRID = (64, 100, 200)
+SEARCH_EF_GRID = (10, 20, 40, 80, 160)
+TARGET_RECALL = 0.95
+# Jak w rag_retrieval.CANDIDATE_TOP_K - tyle kandydatów bierze ścieżka gęsta
+TOP_K = 10
+SAMPLE_QUERIES = 200
+
+
+def _build_trial_collection(client, source, params: Dict[str, Any], name: str):
+    """
+    Kopia wektorów kolekcji źródłowej w kolekcji tymczasowej z podanymi parametrami HNSW.
+    Zwraca (kolekcja, czas budowy w sekundach).
+    """
+    trial = client.create_collection(name, metadata=params)
+    started = time.perf_counter()
+    for page in iter_collection(source, include=["embeddings"]):
+        trial.add(ids=page["ids"], embeddings=page["embeddings"])
+    return trial, time.perf_counter() - started
+
+
+def _measure(trial, queries: np.ndarray, exact: List[List[str]], top_k: int) -> Dict[str, float]:
+    recall = 0.0
+    latencies = []
+    for query, gold in zip(queries, exact):
+        started = time.perf_counter()
+        result = trial.query(query_embeddings=[query.tolist()], n_results=top_k, include=["distances"])
+        latencies.append(time.perf_counter() - started)
+        recall += len(set(gold) & set(result["ids"][0])) / top_k
+    latencies.sort()
+    return {
+        "recall": round(recall / max(len(queries), 1), 4),
+        "p50_ms": round(latencies[len(latencies) // 2] * 1000, 3),
+        "p95_ms": round(latencies[min(len(latencies) - 1, int(0.95 * len(latencies)))] * 1000, 3),
+    }
+
+
+def sweep(source, queries: np.ndarray, space: str, target_recall: float, top_k: int,
+          m_grid=M_GRID, construction_ef_grid=CONSTRUCTION_EF_GRID,
+          search_ef_grid=SEARCH_EF_GRID) -> List[Dict[str, Any]]:
+    """
+    Mierzy recall@k względem dokładnego brute force oraz opóźnienie zapytań dla siatki parametrów.
+    Dla danej pary (M, construction_ef) większy search_ef jest tylko wolniejszy,
+    więc po osiągnięciu docelowego recall kolejne wartości są pomijane.
+    """
+    # Wzorzec: dokładne top-k iloczynem skalarnym. Embeddingi są znormalizowane,
+    # więc ranking jest ten sam dla l2, cosine i ip.
+    print(f"Dokładne top-{top_k} (brute force) dla {len(queries)} zapytań...")
+    exact = exact_top_k(source, queries, top_k)
+
+    client = chromadb.EphemeralClient()
+    n = source.count()
+    dim = queries.shape[1]
+    trials = []
+    for m, construction_ef in itertools.product(m_grid, construction_ef_grid):
+        for search_ef in sorted(search_ef_grid):
+            # Załadowany segment HNSW nie widzi zmiany search_ef aż do ponownego otwarcia bazy
+            # (set_search_ef), a klienci w jednym procesie dzielą segmenty - więc każdy punkt
+            # siatki to osobna kolekcja
+            params = hnsw_metadata(space, m, construction_ef, max(search_ef, top_k))
+            name = f"hnsw_sweep_{m}_{construction_ef}_{search_ef}"
+            trial, build_seconds = _build_trial_collection(client, source, params, name)
+            try:
+                metrics = _measure(trial, queries, exact, top_k)
+            finally:
+                client.delete_collection(name)
+
+            row = {
+                "space": space, "M": m, "construction_ef": construction_ef, "search_ef": params["hnsw:search_ef"],
+                **metrics,
+                "build_s": round(build_seconds, 2),
+                # Wektory float32 + graf (warstwa 0: 2*M sąsiadów int32)
+                "index_mib": round(n * (dim * 4 + m * 2 * 4) / 2**20, 1),
+            }
+            trials.append(row)
+            print(f"  M={m:<3} construction_ef={construction_ef:<4} search_ef={row['search_ef']:<4} "
+                  f"recall@{top_k} {row['recall']:.3f} | p50 {row['p50_ms']:.2f} ms | "
+                  f"p95 {row['p95_ms']:.2f} ms | budowa {row['build_s']:.1f} s")
+            if row["recall"] >= target_recall:
+                break
+    return trials
+
+
+def cheapest(trials: List[Dict[str, Any]], target_recall: float) -> Optional[Dict[str, Any]]:
+    """
+    Najtańszy wariant spełniający docelowy recall: najniższe p95, potem pamięć i czas budowy.
+    """
+    passing = [t for t in trials if t["recall"] >= target_recall]
+    if not passing:
+        return None
+    return min(passing, key=lambda t: (t["p95_ms"], t["index_mib"], t["build_s"]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Dobór parametrów HNSW kolekcji bomba_lore (recall vs opóźnienie).")
+    parser.add_argument("--target-recall", type=float, default=TARGET_RECALL)
+    parser.add_argument("--top-k", type=int, default=TOP_K)
+    parser.add_argument("--space", choices=HNSW_SPACES, default=HNSW_SPACE)
+    parser.add_argument("--m", type=int, nargs="+", default=list(M_GRID))
+    parser.add_argument("--construction-ef", type=int, nargs="+", default=list(CONSTRUCTION_EF_GRID))
+    parser.add_argument("--search-ef", type=int, nargs="+", default=list(SEARCH_EF_GRID))
+    parser.add_argument("--queries", help="Plik z zapytaniami (jedno na linię); domyślnie próbka zapisanych wektorów.")
+    parser.add_argument("--sample", type=int, default=SAMPLE_QUERIES)
+    parser.add_argument("--apply", action="store_true",
+                        help="Zapisz wybrany search_ef w kolekcji (jeśli metryka, M i construction_ef się zgadzają).")
+    parser.add_argument("--output", help="Plik wynikowy JSON (domyślnie benchmarks/results/hnsw_sweep-<czas>.json).")
+    args = parser.parse_args()
+
+    db = chromadb.PersistentClient(path=DB_DIRECTORY)
+    collection = db.get_collection(COLLECTION_NAME)
+    print(f"Kolekcja: {collection.count()} węzłów | obecne HNSW: {collection_hnsw(collection)}")
+
+    queries = load_report_queries(collection, args.queries, args.sample)
+    trials = sweep(collection, queries, args.space, args.target_recall, args.top_k,
+                   args.m, args.construction_ef, args.search_ef)
+    best = cheapest(trials, args.target_recall)
+
+    output = args.output or os.path.join(RESULTS_DIR, f"hnsw_sweep-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump({"target_recall": args.target_recall, "top_k": args.top_k, "queries": len(queries),
+                   "trials": trials, "best": best}, f, ensure_ascii=False, indent=2)
+    print(f"Wyniki zapisane: {output}")
+
+    print("\n" + "=" * 50)
+    if best is None:
+        print(f"Żaden wariant nie osiągnął recall@{args.top_k} >= {args.target_recall}. "
+              f"Rozszerz siatkę (--m, --construction-ef, --search-ef).")
+        sys.exit(1)
+    print(f"Najtańszy wariant z recall@{args.top_k} >= {args.target_recall}: "
+          f"M = {best['M']}, construction_ef = {best['construction_ef']}, search_ef = {best['search_ef']} "
+          f"(recall {best['recall']:.3f}, p95 {best['p95_ms']:.2f} ms)")
+    print(f"  RAG_HNSW_SPACE={best['space']} RAG_HNSW_M={best['M']} "
+          f"RAG_HNSW_CONSTRUCTION_EF={best['construction_ef']} RAG_HNSW_SEARCH_EF={best['search_ef']}")
+    print("=" * 50)
+
+    if args.apply:
+        wanted = hnsw_metadata(best["space"], best["M"], best["construction_ef"], best["search_ef"])
+        if hnsw_structure(collection_hnsw(collection)) != hnsw_structure(wanted):
+            print("Metryka/M/construction_ef różnią się od kolekcji - ustaw powyższe zmienne "
+                  "i przebuduj indeks (build_rag_index.py).")
+        elif set_search_ef(collection, best["search_ef"]):
+            print(f"Zapisano hnsw:search_ef = {best['search_ef']} w kolekcji {COLLECTION_NAME} "
+                  f"(obowiązuje od następnego uruchomienia czatu/retrievera).")
+
+
+if __name__ == "__main__":
+    main()